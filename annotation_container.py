@@ -0,0 +1,171 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import argparse
+import json
+import logging
+import os
+import struct
+import numpy as np
+from contour_store import ContourStore
+
+# File layout: 8-byte magic, little-endian uint64 header length, JSON header,
+# then the raw arrays, each starting on a 64-byte boundary so they can be
+# memory-mapped in place.
+MAGIC = b"VEA1\0\0\0\0"
+ALIGNMENT = 64
+CONTAINER_NAME = "annotations.vea"
+
+
+def frame_number_from_path(annotation_path):
+    """Frame number encoded in an annotation file name such as frame_0012.json."""
+    return int(os.path.basename(annotation_path).split('_')[1].split('.')[0])
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class AnnotationContainer:
+    """One study's contours, frame indices and calibration in a single binary file."""
+
+    def __init__(self, store, pixel_to_mm_ratio=None, slice_thickness_mm=None, metadata=None):
+        self.store = store
+        self.pixel_to_mm_ratio = pixel_to_mm_ratio
+        self.slice_thickness_mm = slice_thickness_mm
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_json_files(cls, annotation_paths, pixel_to_mm_ratio=None, slice_thickness_mm=None, metadata=None):
+        """Read per-frame JSON annotations in the existing {"points": [...]} schema."""
+        annotations = {}
+        for annotation_path in annotation_paths:
+            with open(annotation_path, 'r') as f:
+                points = json.load(f)['points']
+            annotations[frame_number_from_path(annotation_path)] = np.array(points)
+        return cls(ContourStore.from_annotations(annotations), pixel_to_mm_ratio, slice_thickness_mm, metadata)
+
+    @classmethod
+    def from_json_dir(cls, annotation_dir, pixel_to_mm_ratio=None, slice_thickness_mm=None, metadata=None):
+        annotation_paths = sorted(os.path.join(annotation_dir, f)
+                                  for f in os.listdir(annotation_dir) if f.endswith(".json"))
+        return cls.from_json_files(annotation_paths, pixel_to_mm_ratio, slice_thickness_mm, metadata)
+
+    def save(self, path):
+        """Write the container atomically (to a temporary file that is then renamed)."""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.to_bytes())
+        os.replace(tmp_path, path)
+        logging.info(f"Saved {len(self.store)} contours to {path}")
+
+    def to_bytes(self):
+        """The container file's contents, zero-padded to a 64-byte boundary."""
+        arrays = {
+            "frame_indices": np.ascontiguousarray(self.store.frame_indices, dtype='<i8'),
+            "offsets": np.ascontiguousarray(self.store.offsets, dtype='<i8'),
+            "vertices": np.ascontiguousarray(self.store.vertices, dtype=self.store.vertices.dtype.newbyteorder('<')),
+        }
+        header = {
+            "version": 1,
+            "pixel_to_mm_ratio": self.pixel_to_mm_ratio,
+            "slice_thickness_mm": self.slice_thickness_mm,
+            "metadata": self.metadata,
+            "arrays": {},
+        }
+        # Array offsets depend on the header length, so size the header with
+        # placeholder offsets first; zero-padding absorbs any difference
+        for name, array in arrays.items():
+            header["arrays"][name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": 0}
+        data_start = _align(len(MAGIC) + 8 + len(json.dumps(header).encode()) + ALIGNMENT)
+        offset = data_start
+        for name, array in arrays.items():
+            header["arrays"][name]["offset"] = offset
+            offset = _align(offset + array.nbytes)
+        header_bytes = json.dumps(header).encode()
+        if len(MAGIC) + 8 + len(header_bytes) > data_start:
+            raise ValueError("Container header does not fit in its reserved space")
+
+        data = bytearray(offset)
+        data[:len(MAGIC)] = MAGIC
+        struct.pack_into('<Q', data, len(MAGIC), len(header_bytes))
+        data[len(MAGIC) + 8:len(MAGIC) + 8 + len(header_bytes)] = header_bytes
+        for name, array in arrays.items():
+            start = header["arrays"][name]["offset"]
+            data[start:start + array.nbytes] = array.tobytes()
+        return data
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Open a container; with mmap the arrays are mapped from the file, not read."""
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an annotation container")
+            header_length, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_length))
+            arrays = {}
+            for name, spec in header["arrays"].items():
+                shape = tuple(spec["shape"])
+                if mmap and int(np.prod(shape)) > 0:
+                    arrays[name] = np.memmap(path, dtype=spec["dtype"], mode='r', offset=spec["offset"], shape=shape)
+                else:
+                    f.seek(spec["offset"])
+                    count = int(np.prod(shape))
+                    arrays[name] = np.fromfile(f, dtype=spec["dtype"], count=count).reshape(shape)
+        store = ContourStore(arrays["frame_indices"], arrays["vertices"], arrays["offsets"])
+        return cls(store, header["pixel_to_mm_ratio"], header["slice_thickness_mm"], header["metadata"])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Parse a container held in memory (e.g. a request body); the arrays are views of data, not copies."""
+        data = memoryview(data)
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise ValueError("Data is not an annotation container")
+        header_length, = struct.unpack_from('<Q', data, len(MAGIC))
+        header = json.loads(bytes(data[len(MAGIC) + 8:len(MAGIC) + 8 + header_length]))
+        arrays = {}
+        for name, spec in header["arrays"].items():
+            shape = tuple(spec["shape"])
+            dtype = np.dtype(spec["dtype"])
+            count = int(np.prod(shape))
+            if spec["offset"] + count * dtype.itemsize > len(data):
+                raise ValueError(f"Container array {name} runs past the end of the data")
+            arrays[name] = np.frombuffer(data, dtype=dtype, count=count, offset=spec["offset"]).reshape(shape)
+        store = ContourStore(arrays["frame_indices"], arrays["vertices"], arrays["offsets"])
+        return cls(store, header["pixel_to_mm_ratio"], header["slice_thickness_mm"], header["metadata"])
+
+    def to_json_dir(self, annotation_dir):
+        """Write the contours back out as per-frame JSON files."""
+        os.makedirs(annotation_dir, exist_ok=True)
+        for frame_number, points in self.store.to_annotations().items():
+            with open(os.path.join(annotation_dir, f"frame_{frame_number:04d}.json"), 'w') as f:
+                json.dump({"points": points.tolist()}, f)
+
+
+def is_container(path):
+    return isinstance(path, str) and path.endswith(".vea")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert and inspect binary annotation containers.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert_parser = subparsers.add_parser("convert", help="Pack JSON annotation directories into containers")
+    convert_parser.add_argument("annotation_dirs", nargs="+", help="Directories of frame_XXXX.json files")
+    convert_parser.add_argument("--pixel-to-mm", type=float, default=None, help="Calibration to store")
+    convert_parser.add_argument("--slice-thickness", type=float, default=None, help="Slice thickness (mm) to store")
+    info_parser = subparsers.add_parser("info", help="Describe a container")
+    info_parser.add_argument("paths", nargs="+")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        for annotation_dir in args.annotation_dirs:
+            container = AnnotationContainer.from_json_dir(annotation_dir, args.pixel_to_mm, args.slice_thickness)
+            container_path = os.path.join(annotation_dir, CONTAINER_NAME)
+            container.save(container_path)
+            print(f"{container_path}: {len(container.store)} contours, {len(container.store.vertices)} points")
+    elif args.command == "info":
+        for path in args.paths:
+            container = AnnotationContainer.load(path)
+            print(f"{path}: {len(container.store)} contours, {len(container.store.vertices)} points, "
+                  f"frames {container.store.frame_indices[0]}-{container.store.frame_indices[-1]}, "
+                  f"pixel-to-mm {container.pixel_to_mm_ratio}, slice thickness {container.slice_thickness_mm} mm")
@@ -0,0 +1,60 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import tkinter as tk
+import logging
+
+
+class AppWindow:
+    """The application's single Tk root, kept for the whole session.
+
+    The frame selector and the annotator are views (tk.Frames) shown in it in
+    turn; show() swaps the current view out and wait() runs the event loop
+    until a view says it is done, without destroying and rebuilding the root.
+    Closing the window ends the session with SystemExit.
+    """
+
+    def __init__(self, title="VolumeEstimator3D"):
+        self.root = tk.Tk()
+        self.root.title(title)
+        self.root.withdraw()  # Only dialogs until the first view is shown
+        self.root.protocol("WM_DELETE_WINDOW", self.request_close)
+        self.closed = False
+        self._view = None
+        self._waiting = None
+
+    def show(self, view, title=None, geometry=""):
+        """Replace the current view; geometry "" lets the window fit the new view."""
+        if self._view is not None and self._view is not view and self._view.winfo_exists():
+            self._view.pack_forget()
+        self._view = view
+        if title:
+            self.root.title(title)
+        self.root.geometry(geometry)
+        view.pack(expand=True, fill="both")
+        self.root.deiconify()
+
+    def wait(self, variable):
+        """Process events until variable is written (e.g. by a view's Done button)."""
+        self._waiting = variable
+        try:
+            self.root.wait_variable(variable)
+        finally:
+            self._waiting = None
+        if self.closed:
+            self.destroy()
+            raise SystemExit("Application window closed")
+
+    def request_close(self):
+        logging.info("Application window closed by the user")
+        self.closed = True
+        if self._waiting is not None:
+            self._waiting.set(self._waiting.get())  # Wakes wait()
+        else:
+            self.destroy()
+
+    def destroy(self):
+        try:
+            self.root.destroy()
+        except tk.TclError:
+            pass  # Already destroyed
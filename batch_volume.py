@@ -0,0 +1,164 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Headless batch volume computation over already annotated studies.
+
+Usage:
+    python batch_volume.py studies.csv --results results.csv --workers 8
+
+The manifest is a CSV with one row per study, or a JSON file of the form
+{"defaults": {...}, "studies": [{...}, ...]}. Each study gives:
+    study               Folder containing the frame_XXXX.json annotations or an
+                        annotations.vea container, or the path of a .vea container
+    slice_thickness_mm  Slice thickness (falls back to the container, then the defaults/--slice-thickness)
+    pixel_to_mm_ratio   Calibration (falls back to the container, then the defaults/--pixel-to-mm)
+    name                Optional name for the results row (default: folder name)
+    total_frames        Optional, passed through to VolumeCalculator
+Relative study paths are resolved against the manifest's folder.
+
+This module must not import tkinter, so it runs on machines without a display.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+from volume_calculator import VolumeCalculator, RESULTS_HEADER
+from annotation_container import AnnotationContainer, CONTAINER_NAME, is_container
+
+BATCH_HEADER = RESULTS_HEADER + ['Status', 'Error']
+
+
+def load_manifest(manifest_path, default_thickness=None, default_ratio=None):
+    """Read the study manifest and return a list of fully resolved study dicts."""
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    defaults = {"slice_thickness_mm": default_thickness, "pixel_to_mm_ratio": default_ratio}
+
+    if manifest_path.endswith(".json"):
+        with open(manifest_path, 'r') as f:
+            data = json.load(f)
+        defaults.update({k: v for k, v in data.get("defaults", {}).items() if v is not None})
+        rows = data["studies"]
+    else:
+        with open(manifest_path, 'r', newline='') as f:
+            rows = list(csv.DictReader(f))
+
+    studies = []
+    for row in rows:
+        row = {k: v for k, v in row.items() if v not in (None, "")}
+        study_dir = os.path.join(base_dir, row["study"])
+        if is_container(study_dir) and os.path.basename(study_dir) != CONTAINER_NAME:
+            name = os.path.splitext(os.path.basename(study_dir))[0]
+        else:
+            name = os.path.basename(os.path.dirname(study_dir) if is_container(study_dir) else os.path.normpath(study_dir))
+        studies.append({
+            "name": row.get("name", name),
+            "study_dir": study_dir,
+            "slice_thickness_mm": row.get("slice_thickness_mm"),
+            "pixel_to_mm_ratio": row.get("pixel_to_mm_ratio"),
+            "defaults": defaults,
+            "total_frames": row.get("total_frames"),
+        })
+    return studies
+
+
+def study_inputs(study):
+    """(annotated_frames, slice_thickness_mm, pixel_to_mm_ratio) of a study from load_manifest.
+
+    annotated_frames is the study's container if it has one, else its JSON files.
+    """
+    study_dir = study["study_dir"]
+    if is_container(study_dir):
+        annotated_frames = study_dir
+    elif os.path.exists(os.path.join(study_dir, CONTAINER_NAME)):
+        annotated_frames = os.path.join(study_dir, CONTAINER_NAME)
+    else:
+        annotated_frames = sorted(os.path.join(study_dir, f) for f in os.listdir(study_dir) if f.endswith(".json"))
+        if not annotated_frames:
+            raise ValueError(f"No annotation JSONs in {study_dir}")
+
+    # Row values win, then the calibration stored in a container, then the defaults
+    slice_thickness_mm = study["slice_thickness_mm"]
+    pixel_to_mm_ratio = study["pixel_to_mm_ratio"]
+    if is_container(annotated_frames):
+        container = AnnotationContainer.load(annotated_frames)
+        if slice_thickness_mm is None:
+            slice_thickness_mm = container.slice_thickness_mm
+        if pixel_to_mm_ratio is None:
+            pixel_to_mm_ratio = container.pixel_to_mm_ratio
+    if slice_thickness_mm is None:
+        slice_thickness_mm = study["defaults"]["slice_thickness_mm"]
+    if pixel_to_mm_ratio is None:
+        pixel_to_mm_ratio = study["defaults"]["pixel_to_mm_ratio"]
+    if slice_thickness_mm is None or pixel_to_mm_ratio is None:
+        raise ValueError("Missing slice_thickness_mm or pixel_to_mm_ratio")
+    return annotated_frames, float(slice_thickness_mm), float(pixel_to_mm_ratio)
+
+
+def compute_study(study, output_root):
+    """Run VolumeCalculator for one study and return its results row (runs in a worker process)."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    row = [study["name"], None, None, None, None, None, None, study["slice_thickness_mm"], study["pixel_to_mm_ratio"], timestamp]
+    try:
+        annotated_frames, slice_thickness_mm, pixel_to_mm_ratio = study_inputs(study)
+        calculator = VolumeCalculator(
+            annotated_frames=annotated_frames,
+            output_dir=os.path.join(output_root, f"{study['name']}_calculated_{timestamp}"),
+            total_frames=int(study["total_frames"]) if study["total_frames"] is not None else None,
+            slice_thickness_mm=slice_thickness_mm,
+            pixel_to_mm_ratio=pixel_to_mm_ratio,
+        )
+        row[1:7] = calculator.run()
+        row[7:9] = [slice_thickness_mm, pixel_to_mm_ratio]
+        return row + ['ok', '']
+    except Exception as e:
+        return row + ['failed', f"{type(e).__name__}: {e}"]
+
+
+def run_batch(studies, results_csv, output_root, workers=None):
+    """Compute all studies on a process pool, streaming rows to results_csv as they finish.
+
+    Returns the number of failed studies; a failure never aborts the batch.
+    """
+    failures = 0
+    with open(results_csv, mode='w', newline='') as file, ProcessPoolExecutor(max_workers=workers) as pool:
+        writer = csv.writer(file)
+        writer.writerow(BATCH_HEADER)
+        futures = {pool.submit(compute_study, study, output_root): study for study in studies}
+        for done, future in enumerate(as_completed(futures), start=1):
+            row = future.result()
+            writer.writerow(row)
+            file.flush()
+            if row[-2] != 'ok':
+                failures += 1
+                logging.error(f"[{done}/{len(studies)}] {row[0]} failed: {row[-1]}")
+            else:
+                logging.info(f"[{done}/{len(studies)}] {row[0]}: {row[1]} mm^3")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute tumour volumes for annotated studies without the GUI.")
+    parser.add_argument("manifest", help="CSV or JSON manifest listing the studies")
+    parser.add_argument("--results", default=None, help="Results CSV (default: next to the manifest)")
+    parser.add_argument("--output-dir", default=None, help="Root for per-study output folders (default: next to the results)")
+    parser.add_argument("--slice-thickness", type=float, default=None, help="Default slice thickness in mm")
+    parser.add_argument("--pixel-to-mm", type=float, default=None, help="Default pixel-to-mm ratio")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    results_csv = args.results or os.path.join(
+        os.path.dirname(os.path.abspath(args.manifest)),
+        "tumour_volume_results_{}.csv".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+    output_root = args.output_dir or os.path.dirname(os.path.abspath(results_csv))
+
+    studies = load_manifest(args.manifest, args.slice_thickness, args.pixel_to_mm)
+    failures = run_batch(studies, results_csv, output_root, args.workers)
+    logging.info(f"Results saved to {results_csv} ({len(studies) - failures} ok, {failures} failed)")
+    sys.exit(1 if failures else 0)
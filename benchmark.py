@@ -0,0 +1,239 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Speed and accuracy benchmark on synthetic phantom videos, without the GUI.
+
+Usage:
+    python benchmark.py --width 1920 --height 1080 --frames 500 --output bench.json
+
+For each phantom (circle, square, variable circle) a video is rendered at the
+requested resolution, frame count and codec, with exact annotations for every
+sample_every-th frame. Each pipeline stage is timed and the computed volumes
+are compared with the analytic ones. Results are written as JSON so runs of
+different versions can be compared. The phantoms shipped in validation_videos/
+are also checked against the README volumes unless --skip-validation is given.
+"""
+
+from datetime import datetime
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from frame_cache import FrameCache
+from frame_extractor import FrameExtractor
+from frame_source import VideoFrameSource, open_frame_source
+from display_cache import scale_for_display
+from volume_calculator import VolumeCalculator
+from voxel_volume import validate
+
+SHAPES = ("circle", "square", "variable_circle")
+CONTOUR_POINTS = 720
+# Relative amplitude of the variable circle's radius over one period of the stack
+VARIABLE_AMPLITUDE = 0.4
+
+
+def phantom_radius(shape, frame, num_frames, size_px):
+    """Radius (or half edge, for the square) of the phantom on a frame, in pixels."""
+    if shape == "variable_circle":
+        return size_px * (1 + VARIABLE_AMPLITUDE * math.sin(2 * math.pi * frame / (num_frames - 1)))
+    return size_px
+
+
+def phantom_contour(shape, frame, num_frames, size_px, centre):
+    """Exact contour of the phantom as float (x, y) vertices."""
+    radius = phantom_radius(shape, frame, num_frames, size_px)
+    if shape == "square":
+        corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float64)
+        return centre + radius * corners
+    angles = np.linspace(0, 2 * np.pi, CONTOUR_POINTS, endpoint=False)
+    return centre + radius * np.stack([np.cos(angles), np.sin(angles)], axis=1)
+
+
+def analytic_volume_mm3(shape, num_frames, size_px, slice_thickness_mm, pixel_to_mm_ratio):
+    """Exact volume of the phantom between the first and last frame."""
+    length_mm = (num_frames - 1) * slice_thickness_mm
+    size_mm = size_px / pixel_to_mm_ratio
+    if shape == "square":
+        return (2 * size_mm) ** 2 * length_mm
+    if shape == "circle":
+        return math.pi * size_mm ** 2 * length_mm
+    # Mean of (1 + a sin)^2 over a full period is 1 + a^2 / 2
+    return math.pi * size_mm ** 2 * length_mm * (1 + VARIABLE_AMPLITUDE ** 2 / 2)
+
+
+def make_phantom_video(video_path, shape, width, height, num_frames, codec, size_px):
+    """Render the phantom as a filled white shape on black."""
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*codec), 30, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Codec {codec} is not available for {video_path}")
+    centre = np.array([width / 2, height / 2])
+    frame = np.zeros((height, width, 3), dtype=np.uint8)
+    for index in range(num_frames):
+        frame.fill(0)
+        contour = phantom_contour(shape, index, num_frames, size_px, centre)
+        cv2.fillPoly(frame, [np.round(contour * 16).astype(np.int32)], (255, 255, 255), cv2.LINE_AA, shift=4)
+        writer.write(frame)
+    writer.release()
+
+
+def make_annotations(annotation_dir, shape, width, height, num_frames, size_px, sample_every):
+    """Write exact contours for every sample_every-th frame (and the last) in the annotation JSON schema."""
+    os.makedirs(annotation_dir, exist_ok=True)
+    centre = np.array([width / 2, height / 2])
+    frames = sorted(set(range(0, num_frames, sample_every)) | {num_frames - 1})
+    for index in frames:
+        points = np.rint(phantom_contour(shape, index, num_frames, size_px, centre)).astype(int)
+        with open(os.path.join(annotation_dir, f"frame_{index:04d}.json"), 'w') as f:
+            json.dump({"points": points.tolist()}, f)
+    return sorted(os.path.join(annotation_dir, f) for f in os.listdir(annotation_dir) if f.endswith(".json"))
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def open_total_frames(video_path, frame_cache):
+    """Open the video as main.py does and return its frame count."""
+    with open_frame_source(video_path, frame_cache) as frame_source:
+        return frame_source.total_frames
+
+
+def load_and_scale(video_path):
+    """Decode every frame through a FrameSource and scale it for display, as scrubbing does."""
+    with VideoFrameSource(video_path) as frame_source:
+        for index, frame in frame_source.iter_frames():
+            scale_for_display(frame)
+        return frame_source.total_frames
+
+
+def benchmark_shape(shape, args, work_dir):
+    size_px = min(args.width, args.height) / 5  # Phantom spans ~2/5 of the short side
+    video_path = os.path.join(work_dir, f"{shape}.avi")
+    stages = {}
+
+    _, stages["render_s"] = timed(make_phantom_video, video_path, shape, args.width, args.height,
+                                  args.frames, args.codec, size_px)
+    # Extraction as main.py does it: open at once, fill the frame cache, then reopen from the cache
+    frame_cache = FrameCache(os.path.join(work_dir, f"{shape}_frame_cache"))
+    _, stages["open_cold_s"] = timed(open_total_frames, video_path, frame_cache)
+    frames, stages["extraction_s"] = timed(frame_cache.get_frames, video_path)
+    extracted = len(frames)
+    del frames
+    _, stages["extraction_warm_s"] = timed(frame_cache.get_frames, video_path)
+    _, stages["open_warm_s"] = timed(open_total_frames, video_path, frame_cache)
+    if args.legacy_png:
+        # PNG extraction of FrameExtractor, which main.py no longer uses; kept for comparison with old reports
+        _, stages["legacy_png_extraction_s"] = timed(
+            FrameExtractor(video_path, os.path.join(work_dir, f"{shape}_frames")).extract_frames)
+        if args.parallel:
+            _, stages["legacy_png_parallel_extraction_s"] = timed(
+                FrameExtractor(video_path, os.path.join(work_dir, f"{shape}_frames_parallel")).extract_frames, parallel=True)
+    loaded, stages["load_and_scale_s"] = timed(load_and_scale, video_path)
+
+    annotated_frames = make_annotations(os.path.join(work_dir, f"{shape}_annotations"), shape, args.width,
+                                        args.height, args.frames, size_px, args.sample_every)
+    expected = analytic_volume_mm3(shape, args.frames, size_px, args.slice_thickness, args.pixel_to_mm)
+    volumes = {}
+    for method in args.methods:
+        calculator = VolumeCalculator(annotated_frames, os.path.join(work_dir, f"{shape}_{method}"), args.frames,
+                                      args.slice_thickness, args.pixel_to_mm, volume_method=method)
+        metrics, stages[f"volume_{method}_s"] = timed(calculator.run)
+        volumes[method] = {"volume_mm3": metrics[0], "relative_error": (metrics[0] - expected) / expected}
+
+    return {
+        "shape": shape,
+        "frames_extracted": extracted,
+        "frames_loaded": loaded,
+        "frames_annotated": len(annotated_frames),
+        "extraction_fps": extracted / stages["extraction_s"] if stages["extraction_s"] else None,
+        "load_and_scale_fps": loaded / stages["load_and_scale_s"] if stages["load_and_scale_s"] else None,
+        "expected_volume_mm3": expected,
+        "volumes": volumes,
+        "stages": stages,
+    }
+
+
+def benchmark_validation(video_dir):
+    rows, elapsed = timed(validate, video_dir)
+    return {
+        "elapsed_s": elapsed,
+        "videos": [{"video": name, "volume_mm3": volume, "expected_volume_mm3": expected,
+                    "relative_error": error, "passed": passed} for name, volume, expected, error, passed in rows],
+    }
+
+
+def environment():
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        revision = None
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "revision": revision,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark extraction, frame loading and volume computation on synthetic phantoms.")
+    parser.add_argument("--shapes", nargs="+", choices=SHAPES, default=list(SHAPES))
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=480)
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--codec", default="MJPG", help="FourCC of the rendered videos (default: %(default)s)")
+    parser.add_argument("--sample-every", type=int, default=10, help="Annotate every n-th frame (default: %(default)s)")
+    parser.add_argument("--slice-thickness", type=float, default=1.0)
+    parser.add_argument("--pixel-to-mm", type=float, default=20.0)
+    parser.add_argument("--methods", nargs="+", choices=("trapezoid", "shape", "voxel"), default=["trapezoid", "shape", "voxel"])
+    parser.add_argument("--legacy-png", action="store_true", help="Also time the old PNG extraction of FrameExtractor")
+    parser.add_argument("--parallel", action="store_true", help="With --legacy-png, also time parallel PNG extraction")
+    parser.add_argument("--validation-dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "validation_videos"))
+    parser.add_argument("--skip-validation", action="store_true", help="Do not check the shipped validation videos")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated videos and frames")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+    work_dir = tempfile.mkdtemp(prefix="volume_benchmark_")
+    try:
+        results = []
+        for shape in args.shapes:
+            result = benchmark_shape(shape, args, work_dir)
+            results.append(result)
+            errors = ", ".join(f"{method} {v['relative_error']:+.3%}" for method, v in result["volumes"].items())
+            print(f"{shape:16s} cache fill {result['extraction_fps']:8.1f} fps  "
+                  f"open cold {result['stages']['open_cold_s'] * 1000:6.1f} ms  warm {result['stages']['open_warm_s'] * 1000:6.1f} ms  load+scale {result['load_and_scale_fps']:8.1f} fps  {errors}")
+        validation = None
+        if not args.skip_validation and os.path.isdir(args.validation_dir):
+            validation = benchmark_validation(args.validation_dir)
+            for video in validation["videos"]:
+                print(f"{video['video']:22s} voxel {video['relative_error']:+.3%}  {'ok' if video['passed'] else 'FAIL'}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "environment": environment(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "keep", "validation_dir", "skip_validation")},
+        "results": results,
+        "validation": validation,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
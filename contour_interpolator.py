@@ -0,0 +1,121 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import logging
+import os
+import numpy as np
+from contour_store import ContourStore
+from annotation_container import AnnotationContainer
+
+DEFAULT_NUM_POINTS = 128
+INTERPOLATED_NAME = "interpolated.vea"
+
+
+def resample_contours(store, num_points=DEFAULT_NUM_POINTS):
+    """Resample every closed contour to num_points points equally spaced along its perimeter.
+
+    Returns a (num_contours, num_points, 2) float array. All contours are
+    handled together on the flat vertex array, without a loop per contour.
+    """
+    vertices = store.vertices.astype(np.float64)
+    offsets = store.offsets
+    num_contours = len(store)
+    following = np.arange(1, len(vertices) + 1)
+    following[offsets[1:] - 1] = offsets[:-1]  # Each contour's last vertex connects to its first
+
+    segment = vertices[following] - vertices
+    segment_length = np.hypot(segment[:, 0], segment[:, 1])
+    # Arc length at the start of every segment, running across all contours
+    arc_start = np.concatenate([[0.0], np.cumsum(segment_length)[:-1]])
+    contour_start = arc_start[offsets[:-1]]
+    perimeter = np.add.reduceat(segment_length, offsets[:-1])
+
+    fractions = np.arange(num_points) / num_points
+    targets = contour_start[:, None] + fractions[None, :] * perimeter[:, None]
+    # side='right' skips zero-length segments; clipping keeps degenerate contours in range
+    index = np.searchsorted(arc_start, targets, side='right') - 1
+    index = np.clip(index, offsets[:-1, None], offsets[1:, None] - 1)
+    length = segment_length[index]
+    t = np.divide(targets - arc_start[index], length, out=np.zeros_like(targets), where=length > 0)
+    resampled = vertices[index] + t[..., None] * segment[index]
+    return resampled.reshape(num_contours, num_points, 2)
+
+
+def signed_areas(contours):
+    """Signed shoelace area of each (num_points, 2) contour in a (num_contours, num_points, 2) array."""
+    x = contours[..., 0]
+    y = contours[..., 1]
+    return 0.5 * np.sum(x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y, axis=1)
+
+
+def align_contours(contours):
+    """Give consecutive contours a common orientation and matching start points.
+
+    Every contour is turned to the same winding, then each one is rolled so its
+    points best correspond to the previous contour's (least squared distance
+    over all cyclic shifts, found for all pairs at once by FFT correlation).
+    """
+    contours = contours.copy()
+    reversed_winding = signed_areas(contours) < 0
+    contours[reversed_winding] = contours[reversed_winding, ::-1]
+    if len(contours) < 2:
+        return contours
+
+    num_points = contours.shape[1]
+    centred = contours - contours.mean(axis=1, keepdims=True)
+    spectra = np.fft.fft(centred, axis=1)
+    # correlation[k, s] = sum_i previous_i . current_(i+s)
+    correlation = np.fft.ifft(np.conj(spectra[:-1]) * spectra[1:], axis=1).real.sum(axis=2)
+    relative_shift = np.argmax(correlation, axis=1)
+    shift = np.concatenate([[0], np.cumsum(relative_shift)]) % num_points
+    rolled = (np.arange(num_points)[None, :] + shift[:, None]) % num_points
+    return np.take_along_axis(contours, rolled[..., None], axis=1)
+
+
+def interpolate_contours(store, num_points=DEFAULT_NUM_POINTS):
+    """Contours for every unannotated frame between the first and last annotated frames.
+
+    Annotated contours are resampled to num_points corresponding points and
+    each missing frame is a linear blend of its two neighbouring annotated
+    contours, evaluated for all frames in one vectorized step. Returns a
+    ContourStore holding only the interpolated frames.
+    """
+    annotated = store.frame_indices
+    if len(annotated) < 2:
+        return ContourStore([], np.empty((0, 2)), [0])
+    aligned = align_contours(resample_contours(store, num_points))
+
+    frames = np.arange(annotated[0], annotated[-1] + 1)
+    frames = frames[~np.isin(frames, annotated)]
+    if len(frames) == 0:
+        return ContourStore([], np.empty((0, 2)), [0])
+    lower = np.clip(np.searchsorted(annotated, frames, side='right') - 1, 0, len(annotated) - 2)
+    weight = (frames - annotated[lower]) / (annotated[lower + 1] - annotated[lower])
+    contours = (1 - weight)[:, None, None] * aligned[lower] + weight[:, None, None] * aligned[lower + 1]
+
+    offsets = np.arange(len(frames) + 1) * num_points
+    return ContourStore(frames, contours.reshape(-1, 2), offsets)
+
+
+def merge_stores(annotated, interpolated):
+    """One store with the annotated and interpolated contours in frame order."""
+    if len(interpolated) == 0:
+        return annotated
+    merged, _ = ContourStore.concatenate([annotated, interpolated])
+    order = np.argsort(merged.frame_indices, kind='stable')
+    lengths = np.diff(merged.offsets)[order]
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    # Source vertex of every output vertex: its contour's old start plus its position in the contour
+    source = np.arange(offsets[-1]) + np.repeat(merged.offsets[order] - offsets[:-1], lengths)
+    return ContourStore(merged.frame_indices[order], merged.vertices[source].astype(np.float64), offsets)
+
+
+def write_interpolated(store, output_dir, pixel_to_mm_ratio=None, slice_thickness_mm=None, num_points=DEFAULT_NUM_POINTS):
+    """Interpolate the missing frames of store and save them to output_dir; returns the interpolated store."""
+    interpolated = interpolate_contours(store, num_points)
+    os.makedirs(output_dir, exist_ok=True)
+    AnnotationContainer(interpolated, pixel_to_mm_ratio, slice_thickness_mm,
+                        metadata={"interpolated": True, "num_points": num_points}
+                        ).save(os.path.join(output_dir, INTERPOLATED_NAME))
+    logging.info(f"Interpolated {len(interpolated)} frames between {len(store)} annotated frames")
+    return interpolated
@@ -0,0 +1,114 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError as FutureTimeout
+import threading
+import logging
+import cv2
+import numpy as np
+
+# Lucas-Kanade settings: large enough windows to follow tissue between sampled frames
+LK_PARAMS = dict(winSize=(31, 31), maxLevel=4,
+                 criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01))
+
+
+class PropagationCancelled(Exception):
+    pass
+
+
+def propagate_contour(from_frame, to_frame, points, cancel_event=None):
+    """Move contour points from one BGR frame onto another with pyramidal Lucas-Kanade optical flow.
+
+    Points the flow loses follow the median motion of the points it kept.
+    Returns a list of integer (x, y) tuples clipped to the frame.
+    """
+    from_gray = cv2.cvtColor(from_frame, cv2.COLOR_BGR2GRAY)
+    to_gray = cv2.cvtColor(to_frame, cv2.COLOR_BGR2GRAY)
+    if cancel_event is not None and cancel_event.is_set():
+        raise PropagationCancelled()
+
+    start = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+    moved, status, _ = cv2.calcOpticalFlowPyrLK(from_gray, to_gray, start, None, **LK_PARAMS)
+    status = status.reshape(-1).astype(bool)
+    moved = moved.reshape(-1, 2)
+    start = start.reshape(-1, 2)
+    if status.any():
+        shift = np.median(moved[status] - start[status], axis=0)
+    else:
+        shift = np.zeros(2, dtype=np.float32)
+    moved[~status] = start[~status] + shift
+
+    height, width = to_gray.shape
+    moved = np.rint(moved)
+    moved[:, 0] = np.clip(moved[:, 0], 0, width - 1)
+    moved[:, 1] = np.clip(moved[:, 1], 0, height - 1)
+    return [(int(x), int(y)) for x, y in moved]
+
+
+class ContourPropagator:
+    """Drafts contours for upcoming frames on a background thread, off the Tk thread.
+
+    submit() queues a propagation of a saved contour to a later frame;
+    get_draft() returns the best finished draft for a frame and
+    pending_draft() the newest one still running, which the annotator can
+    pick up once it finishes. Later submissions for the same frame take
+    priority over earlier ones. The annotator only moves forward, so drafts
+    are never abandoned individually; shutdown() abandons all of them.
+    """
+
+    def __init__(self, frame_source):
+        self.frame_source = frame_source
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ContourPropagator")
+        self._jobs = {}  # to_frame -> [(future, cancel_event)], oldest first
+        self._lock = threading.Lock()
+
+    def submit(self, points, from_frame, to_frame):
+        """Start propagating points (traced on from_frame) onto to_frame."""
+        if not points:
+            return None
+        cancel_event = threading.Event()
+        future = self._pool.submit(self._propagate, list(points), from_frame, to_frame, cancel_event)
+        with self._lock:
+            self._jobs.setdefault(to_frame, []).append((future, cancel_event))
+        return future
+
+    def _propagate(self, points, from_frame, to_frame, cancel_event):
+        if cancel_event.is_set():
+            raise PropagationCancelled()
+        source = self.frame_source.get_frame(from_frame)
+        target = self.frame_source.get_frame(to_frame)
+        draft = propagate_contour(source, target, points, cancel_event)
+        logging.info(f"Propagated contour from frame {from_frame} to frame {to_frame}")
+        return draft
+
+    def get_draft(self, to_frame, timeout=0):
+        """Draft for to_frame, waiting up to timeout for the newest job, else the newest finished one."""
+        with self._lock:
+            jobs = list(self._jobs.get(to_frame, []))
+        for position, (future, _) in enumerate(reversed(jobs)):
+            try:
+                # Only the newest job is worth waiting for; older ones must already be done
+                return future.result(timeout=timeout if position == 0 else 0)
+            except (FutureTimeout, CancelledError, PropagationCancelled):
+                continue
+            except Exception:
+                logging.warning(f"Contour propagation to frame {to_frame} failed", exc_info=True)
+                continue
+        return None
+
+    def pending_draft(self, to_frame):
+        """Future of the newest job for to_frame if it has not finished yet, else None."""
+        with self._lock:
+            jobs = self._jobs.get(to_frame, [])
+            future = jobs[-1][0] if jobs else None
+        return future if future is not None and not future.done() else None
+
+    def shutdown(self):
+        """Abandon every draft and stop the worker without waiting for it."""
+        with self._lock:
+            for jobs in self._jobs.values():
+                for future, cancel_event in jobs:
+                    cancel_event.set()
+                    future.cancel()
+            self._jobs.clear()
+        self._pool.shutdown(wait=False)
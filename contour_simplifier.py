@@ -0,0 +1,201 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Error-bounded simplification of freehand contours.
+
+Usage:
+    python contour_simplifier.py study_annotations/ --tolerance-px 1.0 --report report.csv
+    python contour_simplifier.py annotations.vea --tolerance-mm 0.05 --dry-run
+
+Rewrites the frame_XXXX.json files of a folder (or an annotation container)
+in place and prints, per slice, the point counts and the area change.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import numpy as np
+from annotation_container import AnnotationContainer, frame_number_from_path, is_container
+from contour_store import ContourStore
+
+DEFAULT_TOLERANCE_PX = 1.0
+# Largest allowed |simplified area - raw area| / raw area
+DEFAULT_MAX_AREA_DEVIATION = 0.005
+
+
+def dedupe_points(points):
+    """Drop points equal to the one before them (and a closing copy of the first point)."""
+    points = np.asarray(points)
+    if len(points) < 2:
+        return points
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = points[keep]
+    if len(points) > 1 and np.array_equal(points[0], points[-1]):
+        points = points[:-1]
+    return points
+
+
+def polygon_area(points):
+    points = np.asarray(points, dtype=np.float64)
+    x, y = points[:, 0], points[:, 1]
+    return 0.5 * abs(np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y))
+
+
+def rdp_mask(points, epsilon):
+    """Ramer-Douglas-Peucker on an open polyline: mask of the points to keep.
+
+    Iterative, so long strokes cannot exhaust the recursion limit; the
+    distances of a whole span are computed in one vectorized step.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    spans = [(0, len(points) - 1)]
+    while spans:
+        start, end = spans.pop()
+        if end - start < 2:
+            continue
+        inner = points[start + 1:end] - points[start]
+        chord = points[end] - points[start]
+        chord_length = np.hypot(chord[0], chord[1])
+        if chord_length == 0:
+            distance = np.hypot(inner[:, 0], inner[:, 1])
+        else:
+            distance = np.abs(chord[0] * inner[:, 1] - chord[1] * inner[:, 0]) / chord_length
+        farthest = int(np.argmax(distance))
+        if distance[farthest] > epsilon:
+            split = start + 1 + farthest
+            keep[split] = True
+            spans.append((start, split))
+            spans.append((split, end))
+    return keep
+
+
+def simplify_closed(points, epsilon):
+    """RDP on a closed contour, split at its first point and the point farthest from it."""
+    points = np.asarray(points)
+    if len(points) <= 3 or epsilon <= 0:
+        return points
+    offsets = points.astype(np.float64) - points[0]
+    split = int(np.argmax(np.hypot(offsets[:, 0], offsets[:, 1])))
+    if split == 0:
+        return points[:1]
+    closed = np.concatenate([points, points[:1]])
+    keep = np.zeros(len(closed), dtype=bool)
+    keep[:split + 1] = rdp_mask(closed[:split + 1], epsilon)
+    keep[split:] |= rdp_mask(closed[split:], epsilon)
+    return closed[:-1][keep[:-1]]
+
+
+def simplify_contour(points, tolerance_px=DEFAULT_TOLERANCE_PX, max_area_deviation=DEFAULT_MAX_AREA_DEVIATION):
+    """Deduplicate and simplify a closed contour, keeping a subset of its original points.
+
+    The tolerance is halved until the simplified contour's area is within
+    max_area_deviation (relative) of the raw contour's; if no tolerance
+    achieves that, the deduplicated contour is returned, whose area is exact.
+    """
+    raw = np.asarray(points)
+    deduped = dedupe_points(raw)
+    if len(deduped) < 3:
+        return deduped
+    raw_area = polygon_area(raw)
+    epsilon = tolerance_px
+    while epsilon >= 1e-3:
+        simplified = simplify_closed(deduped, epsilon)
+        if len(simplified) >= 3 and abs(polygon_area(simplified) - raw_area) <= max_area_deviation * raw_area:
+            return simplified
+        epsilon /= 2
+    return deduped
+
+
+def simplify_annotation_files(annotation_paths, tolerance_px, max_area_deviation, dry_run=False):
+    """Simplify frame JSONs in place; returns one report row per file."""
+    report = []
+    for annotation_path in annotation_paths:
+        with open(annotation_path, 'r') as f:
+            data = json.load(f)
+        raw = np.asarray(data["points"])
+        if len(raw) < 3:
+            continue
+        simplified = simplify_contour(raw, tolerance_px, max_area_deviation)
+        report.append(report_row(frame_number_from_path(annotation_path), raw, simplified))
+        if not dry_run:
+            data["points"] = simplified.tolist()
+            tmp_path = f"{annotation_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, annotation_path)
+    return report
+
+
+def simplify_container(container_path, tolerance_px, max_area_deviation, dry_run=False):
+    """Simplify every contour of a .vea container, rewriting it unless dry_run; returns the report rows."""
+    container = AnnotationContainer.load(container_path, mmap=False)
+    simplified_contours = {}
+    report = []
+    for i, frame in enumerate(container.store.frame_indices):
+        raw = container.store.contour(i)
+        simplified = simplify_contour(raw, tolerance_px, max_area_deviation) if len(raw) >= 3 else raw
+        simplified_contours[int(frame)] = simplified
+        report.append(report_row(int(frame), raw, simplified))
+    if not dry_run:
+        container.store = ContourStore.from_annotations(simplified_contours)
+        container.save(container_path)
+    return report
+
+
+def report_row(frame, raw, simplified):
+    raw_area = polygon_area(raw)
+    area_delta = polygon_area(simplified) - raw_area
+    return {"frame": frame, "points_before": len(raw), "points_after": len(simplified),
+            "area_before_px2": raw_area, "area_delta_px2": area_delta,
+            "area_delta_pct": 100 * area_delta / raw_area if raw_area else 0.0}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simplify existing annotations within an area error bound.")
+    parser.add_argument("annotations", help="Folder of frame_XXXX.json annotations or a .vea container")
+    tolerance = parser.add_mutually_exclusive_group()
+    tolerance.add_argument("--tolerance-px", type=float, default=None, help=f"Simplification tolerance in pixels (default: {DEFAULT_TOLERANCE_PX})")
+    tolerance.add_argument("--tolerance-mm", type=float, default=None, help="Simplification tolerance in mm")
+    parser.add_argument("--pixel-to-mm", type=float, default=None, help="Pixel-to-mm ratio for --tolerance-mm (default: the container's)")
+    parser.add_argument("--max-area-deviation", type=float, default=DEFAULT_MAX_AREA_DEVIATION, help="Allowed relative area change per slice (default: %(default)s)")
+    parser.add_argument("--dry-run", action="store_true", help="Only report, leave the files unchanged")
+    parser.add_argument("--report", default=None, help="Also write the per-slice report to this CSV")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    tolerance_px = args.tolerance_px if args.tolerance_px is not None else DEFAULT_TOLERANCE_PX
+    if args.tolerance_mm is not None:
+        ratio = args.pixel_to_mm
+        if ratio is None and is_container(args.annotations):
+            ratio = AnnotationContainer.load(args.annotations).pixel_to_mm_ratio
+        if ratio is None:
+            parser.error("--tolerance-mm needs --pixel-to-mm (or a container with a calibration)")
+        tolerance_px = args.tolerance_mm * ratio
+
+    if is_container(args.annotations):
+        report = simplify_container(args.annotations, tolerance_px, args.max_area_deviation, args.dry_run)
+    else:
+        paths = sorted(os.path.join(args.annotations, f) for f in os.listdir(args.annotations)
+                       if f.startswith("frame_") and f.endswith(".json"))
+        report = simplify_annotation_files(paths, tolerance_px, args.max_area_deviation, args.dry_run)
+
+    for row in report:
+        print(f"frame {row['frame']:5d}  {row['points_before']:6d} -> {row['points_after']:5d} points  "
+              f"area {row['area_delta_pct']:+.3f}%")
+    before = sum(row["points_before"] for row in report)
+    after = sum(row["points_after"] for row in report)
+    if before:
+        print(f"{len(report)} slices: {before} -> {after} points ({100 * (1 - after / before):.1f}% fewer)"
+              f"{' (dry run)' if args.dry_run else ''}")
+    if args.report:
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(report[0]) if report else ["frame"])
+            writer.writeheader()
+            writer.writerows(report)
@@ -0,0 +1,160 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+from collections import OrderedDict
+import threading
+import logging
+import cv2
+from PIL import Image
+
+# Max display size, small enough that the buttons below the image stay visible
+MAX_DISPLAY_WIDTH = 1000
+MAX_DISPLAY_HEIGHT = 500
+
+
+def display_size(width, height, max_width=MAX_DISPLAY_WIDTH, max_height=MAX_DISPLAY_HEIGHT):
+    """Fit (width, height) to the display area, preserving aspect ratio."""
+    aspect_ratio = height / width
+
+    # Resize based on width, but don't exceed max height
+    target_width = max_width
+    target_height = int(target_width * aspect_ratio)
+
+    if target_height > max_height:
+        target_height = max_height
+        target_width = int(target_height / aspect_ratio)
+    return target_width, target_height
+
+
+def scale_for_display(frame, max_width=MAX_DISPLAY_WIDTH, max_height=MAX_DISPLAY_HEIGHT):
+    """Scale a BGR frame to display size and return it as an RGB PIL image."""
+    original_height, original_width = frame.shape[:2]
+    target_width, target_height = display_size(original_width, original_height, max_width, max_height)
+    # Area averaging is both fast and alias-free when shrinking large sources;
+    # colour conversion runs after the resize, on the smaller image
+    interpolation = cv2.INTER_AREA if target_width < original_width else cv2.INTER_LINEAR
+    resized = cv2.resize(frame, (target_width, target_height), interpolation=interpolation)
+    return Image.fromarray(cv2.cvtColor(resized, cv2.COLOR_BGR2RGB))
+
+
+class DisplayFrameCache:
+    """Bounded LRU cache of display-size frames with background prefetching.
+
+    prefetch_around(index) asks the worker thread to fill the frames on both
+    sides of index, the side the slider is moving towards first;
+    prefetch_frames(indices) asks for an explicit list (e.g. the next sampled
+    frame). A newer request supersedes an older one, so frames the slider has
+    already moved past are never rendered. Each side is decoded in ascending
+    order, so a video is read sequentially after one seek, and the worker
+    reads through frame_source.open_reader() so a miss on the UI thread does
+    not wait behind it.
+    """
+
+    def __init__(self, frame_source, capacity=48, prefetch_radius=12,
+                 max_width=MAX_DISPLAY_WIDTH, max_height=MAX_DISPLAY_HEIGHT):
+        self.frame_source = frame_source
+        self.capacity = capacity
+        self.prefetch_radius = min(prefetch_radius, capacity // 2)
+        self.max_width = max_width
+        self.max_height = max_height
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._center = None
+        self._direction = 1  # +1 while the slider moves forward, -1 backward
+        self._requested = None  # Explicit prefetch list, used instead of the neighbourhood of _center
+        self._generation = 0
+        self._closed = False
+        self._worker = threading.Thread(target=self._prefetch_loop, name="DisplayFramePrefetch", daemon=True)
+        self._worker.start()
+
+    def get(self, index):
+        """Return the display image for index, rendering it now on a miss."""
+        with self._lock:
+            image = self._images.get(index)
+            if image is not None:
+                self._images.move_to_end(index)
+                return image
+        image = self._render(index)
+        self._store(index, image)
+        return image
+
+    def prefetch_around(self, index):
+        """Prefetch the neighbourhood of index, dropping any older prefetch request."""
+        with self._wakeup:
+            if self._center is not None and index != self._center:
+                self._direction = 1 if index > self._center else -1
+            self._center = index
+            self._requested = None
+            self._generation += 1
+            self._wakeup.notify()
+
+    def prefetch_frames(self, indices):
+        """Prefetch exactly these frames, in order, dropping any older prefetch request."""
+        with self._wakeup:
+            self._requested = [index for index in indices if 0 <= index < self.frame_source.total_frames]
+            self._generation += 1
+            self._wakeup.notify()
+
+    def close(self):
+        with self._wakeup:
+            self._closed = True
+            self._wakeup.notify()
+
+    def _render(self, index, frame_source=None):
+        frame = (frame_source or self.frame_source).get_frame(index)
+        return scale_for_display(frame, self.max_width, self.max_height)
+
+    def _store(self, index, image):
+        with self._lock:
+            self._images[index] = image
+            self._images.move_to_end(index)
+            while len(self._images) > self.capacity:
+                self._images.popitem(last=False)
+
+    def _prefetch_order(self, center, direction):
+        """Frames within prefetch_radius of center: the side ahead in direction first, each side ascending."""
+        total = self.frame_source.total_frames
+        after = list(range(center + 1, min(center + self.prefetch_radius, total - 1) + 1))
+        before = list(range(max(center - self.prefetch_radius, 0), center))
+        return after + before if direction > 0 else before + after
+
+    def _prefetch_loop(self):
+        try:
+            reader = self.frame_source.open_reader()
+        except IOError:
+            logging.warning(f"Cannot open a prefetch reader for {self.frame_source.name}; sharing the source")
+            reader = self.frame_source
+        try:
+            self._serve_prefetch(reader)
+        finally:
+            if reader is not self.frame_source:
+                reader.close()
+
+    def _serve_prefetch(self, reader):
+        seen_generation = 0
+        while True:
+            with self._wakeup:
+                while not self._closed and self._generation == seen_generation:
+                    self._wakeup.wait()
+                if self._closed:
+                    return
+                seen_generation = self._generation
+                center = self._center
+                direction = self._direction
+                requested = self._requested
+
+            for index in requested if requested is not None else self._prefetch_order(center, direction):
+                with self._lock:
+                    if self._closed or self._generation != seen_generation:
+                        break  # Slider moved on; this request is stale
+                    if index in self._images:
+                        # Keep neighbours of the current position from being evicted first
+                        self._images.move_to_end(index)
+                        continue
+                try:
+                    image = self._render(index, reader)
+                except (IOError, IndexError):
+                    logging.warning(f"Prefetch failed for frame {index + 1} of {self.frame_source.name}")
+                    continue
+                self._store(index, image)
@@ -0,0 +1,286 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import cv2
+import numpy as np
+from frame_source import ArrayFrameSource, VideoFrameSource
+from instrumentation import tracer
+
+CACHE_VERSION = 1
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3  # 20 GB
+MANIFEST_NAME = "manifest.json"
+FRAMES_NAME = "frames.raw"
+
+
+def default_cache_dir():
+    """Cache location, overridable with the VOLUME_ESTIMATOR_CACHE_DIR environment variable."""
+    return os.environ.get(
+        "VOLUME_ESTIMATOR_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "VolumeEstimator3D", "frames"),
+    )
+
+
+class DecodeCancelled(Exception):
+    pass
+
+
+def _write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+class FrameCache:
+    """Persistent, content-addressed store of decoded frame stacks.
+
+    Each entry is a directory named after a hash of the video's content and
+    decode parameters, holding the raw frame stack (mapped with np.memmap) and
+    a manifest. Entries are evicted least-recently-used first once the cache
+    grows past max_bytes; videos whose decoded stack alone would exceed it are
+    not cached at all. open_source only maps entries that already exist and
+    otherwise reads the video lazily, so the cache speeds up reuse without
+    delaying the first view.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._hash_index_path = os.path.join(self.cache_dir, "hashes.json")
+
+    def known_hash(self, video_path):
+        """Memoized SHA-256 of the video if its size and mtime are unchanged, else None; never reads the file."""
+        stat = os.stat(video_path)
+        known = self._load_hash_index().get(os.path.abspath(video_path))
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return known["sha256"]
+        return None
+
+    def content_hash(self, video_path):
+        """SHA-256 of the video file, memoized on (size, mtime) so unchanged files are not re-read."""
+        known = self.known_hash(video_path)
+        if known is not None:
+            return known
+
+        stat = os.stat(video_path)
+        digest = hashlib.sha256()
+        with open(video_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        index = self._load_hash_index()
+        index[os.path.abspath(video_path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+        _write_json_atomic(self._hash_index_path, index)
+        return digest.hexdigest()
+
+    def cache_key(self, video_path, frame_step=1, content_hash=None):
+        """Key combining the content hash with every parameter that changes the decoded stack."""
+        params = {"version": CACHE_VERSION, "frame_step": frame_step}
+        digest = hashlib.sha256((content_hash or self.content_hash(video_path)).encode())
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()[:32]
+
+    def estimate_bytes(self, video_path, frame_step=1):
+        """Size of the decoded stack from the video's header (frame count x H x W x 3), or None if unknown."""
+        cap = cv2.VideoCapture(video_path)
+        try:
+            frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        finally:
+            cap.release()
+        if frame_count <= 0 or width <= 0 or height <= 0:
+            return None
+        return -(-frame_count // frame_step) * height * width * 3
+
+    def should_cache(self, video_path, frame_step=1):
+        """Whether the decoded stack is known to fit in max_bytes; larger or unknown stacks stay lazy."""
+        estimate = self.estimate_bytes(video_path, frame_step)
+        if estimate is None or estimate > self.max_bytes:
+            logging.info(f"Not caching {video_path}: decoded size {estimate} bytes vs a cap of {self.max_bytes}")
+            return False
+        return True
+
+    def get_frames(self, video_path, frame_step=1, cancel_event=None):
+        """Return the decoded (N, H, W, 3) stack as a read-only memmap, decoding it only on a miss.
+
+        Setting cancel_event abandons a decode in progress with DecodeCancelled.
+        """
+        key = self.cache_key(video_path, frame_step)
+        entry_dir = os.path.join(self.cache_dir, key)
+        manifest = self._read_manifest(entry_dir)
+        if manifest is None:
+            logging.info(f"Frame cache miss for {video_path}, decoding...")
+            with tracer.span("frame_cache_decode", video=os.path.basename(video_path)) as span:
+                self._decode_entry(video_path, key, frame_step, cancel_event)
+                manifest = self._read_manifest(entry_dir)
+                span.add_frames(manifest["frame_count"])
+                span.add_bytes(manifest["bytes"])
+            self.prune(keep=key)
+        else:
+            logging.info(f"Frame cache hit for {video_path} ({key})")
+        return self._map_entry(entry_dir, manifest)
+
+    def cached_frames(self, video_path, frame_step=1):
+        """The stack for video_path if it is already cached, else None; never decodes or hashes the video."""
+        content_hash = self.known_hash(video_path)
+        if content_hash is None:
+            return None
+        entry_dir = os.path.join(self.cache_dir, self.cache_key(video_path, frame_step, content_hash))
+        manifest = self._read_manifest(entry_dir)
+        return None if manifest is None else self._map_entry(entry_dir, manifest)
+
+    def _map_entry(self, entry_dir, manifest):
+        manifest["last_access"] = time.time()
+        _write_json_atomic(os.path.join(entry_dir, MANIFEST_NAME), manifest)
+        if manifest["frame_count"] == 0:
+            return np.empty((0, 0, 0, 3), dtype=np.uint8)
+        return np.memmap(os.path.join(entry_dir, FRAMES_NAME), dtype=manifest["dtype"],
+                         mode='r', shape=tuple(manifest["shape"]))
+
+    def open_source(self, video_path):
+        """FrameSource over the cached stack for video_path if there is one, else a lazy VideoFrameSource.
+
+        Never decodes the video up front; filling the cache is left to
+        get_frames, e.g. on VideoPipeline's background workers.
+        """
+        frames = self.cached_frames(video_path)
+        if frames is None:
+            return VideoFrameSource(video_path)
+        logging.info(f"Frame cache hit for {video_path}")
+        return ArrayFrameSource(frames, os.path.basename(video_path))
+
+    def _decode_entry(self, video_path, key, frame_step, cancel_event=None):
+        # Decode into a private directory and rename it into place, so a second
+        # reader never maps a half-written stack
+        tmp_dir = os.path.join(self.cache_dir, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        cap = cv2.VideoCapture(video_path)
+        frame_count = 0
+        source_index = 0
+        shape = None
+        try:
+            with open(os.path.join(tmp_dir, FRAMES_NAME), 'wb') as f:
+                while cap.isOpened():
+                    if cancel_event is not None and cancel_event.is_set():
+                        raise DecodeCancelled(video_path)
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    if source_index % frame_step == 0:
+                        if shape is None:
+                            shape = frame.shape
+                        f.write(np.ascontiguousarray(frame).tobytes())
+                        frame_count += 1
+                    source_index += 1
+        except DecodeCancelled:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        finally:
+            cap.release()
+
+        shape = shape or (0, 0, 3)
+        now = time.time()
+        manifest = {
+            "version": CACHE_VERSION,
+            "key": key,
+            "source": os.path.abspath(video_path),
+            "source_sha256": self.content_hash(video_path),
+            "frame_step": frame_step,
+            "frame_count": frame_count,
+            "shape": [frame_count, *shape],
+            "dtype": "uint8",
+            "bytes": os.path.getsize(os.path.join(tmp_dir, FRAMES_NAME)),
+            "created": now,
+            "last_access": now,
+        }
+        _write_json_atomic(os.path.join(tmp_dir, MANIFEST_NAME), manifest)
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # Another process finished the same entry first; keep theirs
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.info(f"Cached {frame_count} frames of {video_path} as {key}")
+
+    def _read_manifest(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, MANIFEST_NAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load_hash_index(self):
+        try:
+            with open(self._hash_index_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def entries(self):
+        """Manifests of all complete entries, most recently used first."""
+        manifests = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if os.path.isdir(entry_dir) and not name.endswith(".tmp"):
+                manifest = self._read_manifest(entry_dir)
+                if manifest is not None:
+                    manifests.append(manifest)
+        return sorted(manifests, key=lambda m: m["last_access"], reverse=True)
+
+    def total_bytes(self):
+        return sum(m["bytes"] for m in self.entries())
+
+    def remove(self, key):
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        logging.info(f"Removed frame cache entry {key}")
+
+    def prune(self, max_bytes=None, keep=None):
+        """Evict least-recently-used entries until the cache fits in max_bytes. Returns evicted keys."""
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = []
+        used = 0
+        for manifest in self.entries():
+            used += manifest["bytes"]
+            if used > max_bytes and manifest["key"] != keep:
+                self.remove(manifest["key"])
+                used -= manifest["bytes"]
+                evicted.append(manifest["key"])
+        return evicted
+
+    def clear(self):
+        return self.prune(max_bytes=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and prune the decoded frame cache.")
+    parser.add_argument("--cache-dir", default=None, help="Cache directory (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List cached videos, most recently used first")
+    prune_parser = subparsers.add_parser("prune", help="Evict least-recently-used entries")
+    prune_parser.add_argument("--max-gb", type=float, required=True, help="Size to prune the cache down to")
+    subparsers.add_parser("clear", help="Remove every entry")
+    args = parser.parse_args()
+
+    cache = FrameCache(args.cache_dir)
+    if args.command == "list":
+        for manifest in cache.entries():
+            last_access = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(manifest["last_access"]))
+            print(f"{manifest['key']}  {manifest['bytes'] / 1024 ** 2:10.1f} MB  "
+                  f"{manifest['frame_count']:6d} frames  {last_access}  {manifest['source']}")
+        print(f"Total: {cache.total_bytes() / 1024 ** 3:.2f} GB in {cache.cache_dir}")
+    elif args.command == "prune":
+        evicted = cache.prune(max_bytes=int(args.max_gb * 1024 ** 3))
+        print(f"Evicted {len(evicted)} entries")
+    elif args.command == "clear":
+        evicted = cache.clear()
+        print(f"Evicted {len(evicted)} entries")
@@ -1,25 +1,102 @@
 # Author: Andrew Effat
 # Email: andrew.effat@uhn.ca
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import cv2
 import os
+import logging
+
+
+def _extract_segment(video_path, output_dir, start, end, frame_step, extension, encode_threads):
+    """Decode frames [start, end) of a video (end=None reads to the end) and write every frame_step-th one.
+
+    Runs in a worker process; encoding and writing happen on a thread pool,
+    since cv2.imwrite releases the GIL.
+    """
+    cap = cv2.VideoCapture(video_path)
+    first = start + (-start) % frame_step  # First kept frame in the segment
+    if first > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+    written = 0
+    pending = deque()
+    max_pending = encode_threads * 4  # Bounds the number of decoded frames held in memory
+    index = first
+    with ThreadPoolExecutor(max_workers=encode_threads) as pool:
+        while end is None or index < end:
+            if index % frame_step == 0:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                frame_path = os.path.join(output_dir, f"frame_{index:04d}{extension}")
+                pending.append(pool.submit(cv2.imwrite, frame_path, frame))
+                if len(pending) > max_pending:
+                    written += bool(pending.popleft().result())
+            elif not cap.grab():  # Skipped frames are demuxed but never converted
+                break
+            index += 1
+        while pending:
+            written += bool(pending.popleft().result())
+    cap.release()
+    return written
+
 
 class FrameExtractor:
-    
+
     def __init__(self, video_path, output_dir, frame_rate=1):
+        """
+        video_path: Path to the source video.
+        output_dir: Directory the frames are written to as frame_%04d files.
+        frame_rate: Decimation factor; every frame_rate-th frame is kept and named by its source index.
+        """
         self.video_path = video_path
         self.output_dir = output_dir
-        self.frame_rate = frame_rate
-    
-    def extract_frames(self):
+        self.frame_rate = max(1, int(frame_rate))
+
+    def extract_frames(self, parallel=False, workers=None, extension=".png"):
+        """Extract frames to output_dir and return the number of frames written."""
         os.makedirs(self.output_dir, exist_ok=True)
+        if parallel:
+            return self.extract_frames_parallel(workers, extension)
         cap = cv2.VideoCapture(self.video_path)
         frame_count = 0
+        index = 0
         while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
+            if index % self.frame_rate == 0:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                cv2.imwrite(f"{self.output_dir}/frame_{index:04d}{extension}", frame)
+                frame_count += 1
+            elif not cap.grab():
                 break
-            cv2.imwrite(f"{self.output_dir}/frame_{frame_count:04d}.png", frame)
-            frame_count += 1
+            index += 1
         cap.release()
         return frame_count
+
+    def extract_frames_parallel(self, workers=None, extension=".png", encode_threads=2):
+        """Split the video into frame ranges and decode each range in its own process.
+
+        Produces the same files as the serial path. The last range reads to the
+        end of the stream, so an underreported frame count loses no frames.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        cap = cv2.VideoCapture(self.video_path)
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        cap.release()
+
+        workers = workers or os.cpu_count() or 1
+        # A few ranges per worker balances out segments that decode slower than others
+        num_segments = max(1, min(workers * 2, total_frames // 50))
+        bounds = [total_frames * i // num_segments for i in range(num_segments + 1)]
+        segments = [(bounds[i], bounds[i + 1] if i < num_segments - 1 else None) for i in range(num_segments)]
+        logging.info(f"Extracting {total_frames} frames of {self.video_path} in {num_segments} segments on {workers} workers")
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_extract_segment, self.video_path, self.output_dir, start, end,
+                            self.frame_rate, extension, encode_threads)
+                for start, end in segments
+            ]
+            return sum(future.result() for future in futures)
@@ -3,46 +3,66 @@
 
 import tkinter as tk
 from tkinter import filedialog, messagebox
-from PIL import Image, ImageTk
-import os
-import cv2
+from PIL import ImageTk
 import numpy as np
+import threading
 import logging
+from frame_source import open_frame_source
+from display_cache import DisplayFrameCache
+from app_window import AppWindow
+from frame_analysis import change_scores, adaptive_sample_indices, roi_features, presence_scores, suggest_range
 
 
 class FrameSelector:
-    def __init__(self, frames_folder, parent = None):
-        self.frames_folder = frames_folder
-        self.frames = sorted([f for f in os.listdir(frames_folder) if f.endswith(".png")])
+    def __init__(self, frame_source, parent = None, app=None):
+        """Show the selector in app (an AppWindow, created if None) and return once the range is confirmed."""
+        self.frame_source = frame_source
+        self.total_frames = frame_source.total_frames
         self.current_index = 0
         self.start_frame = None
         self.end_frame = None
+        self.display_cache = DisplayFrameCache(frame_source)
+        self._pending_display = None
+        self.roi = None  # (x0, y0, x1, y1) as fractions of the frame
+        self._drag_origin = None
+        self._auto_thread = None
+        self._auto_cancel = threading.Event()
+        self._auto_progress = (0, self.total_frames)
+        self._auto_result = None
+        self._pending_poll = None
         
 
-        # Set up the main window
-        self.root = tk.Tk()
-        self.root.title("Frame Selector")
-        self.root.geometry("1200x800")  # Adjust window size
+        # Set up the view in the application window
+        self.owns_app = app is None
+        self.app = app or AppWindow()
+        self.root = self.app.root
+        self.view = tk.Frame(self.root)
+        self.done = tk.BooleanVar(self.root, value=False)
   
-        # Image panel
-        self.image_panel = tk.Label(self.root)
-        self.image_panel.pack(expand=True, fill="both")
+        # Image panel; dragging on it draws the region Auto Range scores
+        self.image_panel = tk.Canvas(self.view, highlightthickness=0, cursor="crosshair")
+        self.image_panel.pack(expand=True)
+        self.image_item = self.image_panel.create_image(0, 0, anchor="nw")
+        self.roi_item = self.image_panel.create_rectangle(0, 0, 0, 0, outline="yellow", width=2, state="hidden")
+        self.image_panel.bind("<ButtonPress-1>", self.start_roi)
+        self.image_panel.bind("<B1-Motion>", self.drag_roi)
+        self.image_panel.bind("<ButtonRelease-1>", self.finish_roi)
 
         # Progress indicator
-        self.progress_label = tk.Label(self.root, text=f"Frame 1 of {len(self.frames)}")
+        self.progress_label = tk.Label(self.view, text=f"Frame 1 of {self.total_frames}")
         self.progress_label.pack(pady=5)
 
         # Slider for navigation
-        self.slider = tk.Scale(self.root, from_=1, to=len(self.frames),
+        self.slider = tk.Scale(self.view, from_=1, to=self.total_frames,
                                orient="horizontal", command=self.slider_update, length=700)
         self.slider.pack(fill="none", pady=10)
 
         # Selected frames indicator
-        self.selection_label = tk.Label(self.root, text="Start Frame: None | End Frame: None", font=("Helvetica", 12))
+        self.selection_label = tk.Label(self.view, text="Start Frame: None | End Frame: None", font=("Helvetica", 12))
         self.selection_label.pack(pady=5)
 
         # Frame selection controls
-        self.controls_frame = tk.Frame(self.root)
+        self.controls_frame = tk.Frame(self.view)
         self.controls_frame.pack(pady=10)
 
         # Rectangular buttons with consistent text visibility
@@ -54,58 +74,64 @@ class FrameSelector:
                                         command=self.set_end_frame, width=15, height=2)
         self.set_end_button.pack(side="left", padx=10)
 
+        self.auto_range_button = tk.Button(self.controls_frame, text="Auto Range",
+                                           command=self.auto_range, width=15, height=2)
+        self.auto_range_button.pack(side="left", padx=10)
+
         self.confirm_button = tk.Button(self.controls_frame, text="Confirm",
                                         command=self.confirm_selection, width=15, height=2)
         self.confirm_button.pack(side="left", padx=10)
 
+        self.auto_range_label = tk.Label(self.view, text="Drag a box around the lesion, then Auto Range to suggest start and end")
+        self.auto_range_label.pack(pady=5)
+
         # Display the first frame
+        self.app.show(self.view, "Frame Selector", "1200x800")
         self.display_frame(self.current_index)
-        self.root.mainloop()
+        self.display_cache.prefetch_around(self.current_index)
+        try:
+            self.app.wait(self.done)
+        finally:
+            self.display_cache.close()
+            self._auto_cancel.set()
+        for pending in (self._pending_display, self._pending_poll):
+            if pending is not None:
+                self.root.after_cancel(pending)
+        self.view.destroy()
+        if self.owns_app:
+            self.app.destroy()
 
     def display_frame(self, index):
         """Display the frame at the given index."""
-        frame_path = os.path.join(self.frames_folder, self.frames[index])
-        frame = cv2.imread(frame_path)
-        if frame is None:
-            messagebox.showerror("Error", f"Cannot load frame: {frame_path}")
+        try:
+            img_pil = self.display_cache.get(index)
+        except (IOError, IndexError):
+            messagebox.showerror("Error", f"Cannot load frame {index + 1} of {self.frame_source.name}")
             return
 
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img_pil = Image.fromarray(frame_rgb)
-
-        # Define max display size
-        max_width = 1000
-        max_height = 500  # so buttons are visible
-
-        # Original size
-        original_width, original_height = img_pil.size
-        aspect_ratio = original_height / original_width
-
-        # Resize based on width, but don't exceed max height
-        target_width = max_width
-        target_height = int(target_width * aspect_ratio)
-
-        if target_height > max_height:
-            target_height = max_height
-            target_width = int(target_height / aspect_ratio)
-
-        img_pil = img_pil.resize((target_width, target_height), Image.LANCZOS)
-
-
         img_tk = ImageTk.PhotoImage(img_pil)
 
         # Persist the reference to prevent garbage collection
-        self.image_panel.config(image=img_tk)
+        self.image_panel.config(width=img_tk.width(), height=img_tk.height())
+        self.image_panel.itemconfig(self.image_item, image=img_tk)
         self.image_panel.image = img_tk  # Store reference in the widget to keep it alive
 
         # Update progress label
-        self.progress_label.config(text=f"Frame {index + 1} of {len(self.frames)}")
+        self.progress_label.config(text=f"Frame {index + 1} of {self.total_frames}")
 
 
 
     def slider_update(self, value):
         """Update the frame display based on slider position."""
         self.current_index = int(value) - 1  # Adjust to 0-based index for internal logic
+        self.display_cache.prefetch_around(self.current_index)
+        # Coalesce fast slider motion: only the latest position is drawn once Tk is idle
+        if self._pending_display is None:
+            self._pending_display = self.root.after_idle(self.display_pending_frame)
+
+    def display_pending_frame(self):
+        """Display the frame at the slider's latest position."""
+        self._pending_display = None
         self.display_frame(self.current_index)
 
     def set_start_frame(self):
@@ -120,6 +146,70 @@ class FrameSelector:
         self.update_selection_label()
         logging.info(f"End frame set to {self.end_frame + 1}")
 
+    def start_roi(self, event):
+        self._drag_origin = (event.x, event.y)
+        self.image_panel.coords(self.roi_item, event.x, event.y, event.x, event.y)
+        self.image_panel.itemconfig(self.roi_item, state="normal")
+
+    def drag_roi(self, event):
+        if self._drag_origin is not None:
+            self.image_panel.coords(self.roi_item, *self._drag_origin, event.x, event.y)
+
+    def finish_roi(self, event):
+        """Keep the dragged box as the region of interest; a click without a drag clears it."""
+        if self._drag_origin is None:
+            return
+        (x0, y0), self._drag_origin = self._drag_origin, None
+        width, height = self.image_panel.image.width(), self.image_panel.image.height()
+        x0, x1 = sorted((min(max(x0, 0), width), min(max(event.x, 0), width)))
+        y0, y1 = sorted((min(max(y0, 0), height), min(max(event.y, 0), height)))
+        if x1 - x0 < 5 or y1 - y0 < 5:
+            self.roi = None
+            self.image_panel.itemconfig(self.roi_item, state="hidden")
+            return
+        self.image_panel.coords(self.roi_item, x0, y0, x1, y1)
+        self.roi = (x0 / width, y0 / height, x1 / width, y1 / height)
+
+    def auto_range(self):
+        """Score every frame's region of interest in the background and suggest a start and end."""
+        if self._auto_thread is not None and self._auto_thread.is_alive():
+            return
+        self._auto_result = None
+        self._auto_progress = (0, self.total_frames)
+        self._auto_thread = threading.Thread(target=self._auto_range_worker, args=(self.roi,),
+                                             name="AutoRange", daemon=True)
+        self._auto_thread.start()
+        self.auto_range_button.config(state="disabled")
+        self._pending_poll = self.root.after(100, self._poll_auto_range)
+
+    def _auto_range_worker(self, roi):
+        try:
+            features = roi_features(self.frame_source, roi, cancel_event=self._auto_cancel,
+                                    progress=lambda done, total: setattr(self, "_auto_progress", (done, total)))
+            if features is not None:
+                self._auto_result = suggest_range(presence_scores(features))
+        except (IOError, IndexError) as e:
+            logging.warning(f"Auto range failed for {self.frame_source.name}: {e}")
+
+    def _poll_auto_range(self):
+        """Report the pass's progress and, once it has finished, preload its suggestion."""
+        self._pending_poll = None
+        if self._auto_thread.is_alive():
+            done, total = self._auto_progress
+            self.auto_range_label.config(text=f"Scanning frames... {100 * done // max(total, 1)}%")
+            self._pending_poll = self.root.after(100, self._poll_auto_range)
+            return
+        self.auto_range_button.config(state="normal")
+        if self._auto_result is None:
+            self.auto_range_label.config(text="No clear lesion range found; set start and end by hand")
+            return
+        self.start_frame, self.end_frame = self._auto_result
+        self.update_selection_label()
+        self.auto_range_label.config(text=f"Suggested frames {self.start_frame + 1}-{self.end_frame + 1}; "
+                                          f"check them and adjust before confirming")
+        logging.info(f"Auto range suggested frames {self.start_frame + 1} to {self.end_frame + 1}")
+        self.slider.set(self.start_frame + 1)
+
     def update_selection_label(self):
         """Update the label showing the selected start and end frames."""
         start = self.start_frame + 1 if self.start_frame is not None else "None"
@@ -133,26 +223,44 @@ class FrameSelector:
                 with open("frame_selection.txt", "w") as f:
                     f.write(f"{self.start_frame},{self.end_frame}")
                 logging.info("Start and end frames saved.")
-                self.root.destroy()
+                self.done.set(True)
             else:
                 messagebox.showerror("Error", "Start frame must be less than the end frame.")
         else:
             messagebox.showerror("Error", "Please select both start and end frames.")
 
-    def get_sampled_frames(self):
-        """Get evenly sampled frames between start and end frames."""
+    def get_sampled_frames(self, sample_fraction=0.1, mode="uniform", budget=None):
+        """Get the indices of the frames to annotate between start and end frames.
+
+        sample_fraction: Fraction of the range to annotate; shape interpolation
+        in VolumeCalculator can make up for fractions below the default 10%.
+        mode: "uniform" spaces samples evenly; "adaptive" places them where the
+        image changes between frames and skips stable stretches.
+        budget: Number of frames to annotate, overriding sample_fraction.
+        """
         if self.start_frame is None or self.end_frame is None:
             raise ValueError("Start and end frames must be set before sampling.")
         
         total_frames = self.end_frame - self.start_frame + 1
-        num_samples = max(2, int(total_frames * 0.1))  # Ensure at least 2 frames are selected
+        num_samples = max(2, int(total_frames * sample_fraction))  # Ensure at least 2 frames are selected
+        if budget is not None:
+            num_samples = max(2, budget)
+
+        if mode == "adaptive":
+            scores = change_scores(self.frame_source, self.start_frame, self.end_frame)
+            sampled_indices = adaptive_sample_indices(scores, self.start_frame, num_samples)
+            logging.info(f"Adaptive sampling picked {len(sampled_indices)} of {total_frames} frames")
+            return sampled_indices
+        if mode != "uniform":
+            raise ValueError(f"Unknown sampling mode: {mode}")
 
         # Select num_samples evenly spaced frames, including start and end      
         sampled_indices = np.linspace(self.start_frame, self.end_frame, num=num_samples, dtype=int)
-        return [os.path.join(self.frames_folder, self.frames[i]) for i in sampled_indices]
+        return [int(i) for i in sampled_indices]
 
 
 if __name__ == "__main__":
-    folder_path = filedialog.askdirectory(title="Select Folder Containing Frames")
-    if folder_path:
-        FrameSelector(folder_path)
+    video_path = filedialog.askopenfilename(title="Select Video", filetypes=[("Video files", "*.avi *.mp4 *.mov"), ("TIFF stacks", "*.tif *.tiff")])
+    if video_path:
+        with open_frame_source(video_path) as frame_source:
+            FrameSelector(frame_source)
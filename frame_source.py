@@ -0,0 +1,383 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+from collections import OrderedDict
+import threading
+import struct
+import re
+import cv2
+import os
+import logging
+import numpy as np
+from PIL import Image
+
+
+class FrameSource:
+    """Ordered stack of frames decoded on demand by index.
+
+    Subclasses implement _read_frame(index); decoded frames are kept in a
+    small LRU cache so moving back and forth around one position is cheap.
+    get_frame is safe to call from background threads.
+    """
+
+    def __init__(self, name, cache_size=32):
+        self.name = name
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.lock = threading.RLock()
+
+    @property
+    def total_frames(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.total_frames
+
+    def _read_frame(self, index):
+        raise NotImplementedError
+
+    def get_frame(self, index):
+        """Return the BGR frame at the given index (shared, do not modify in place)."""
+        if index < 0 or index >= self.total_frames:
+            raise IndexError(f"Frame {index} out of range for {self.name} ({self.total_frames} frames)")
+        with self.lock:
+            frame = self._cache.get(index)
+            if frame is not None:
+                self._cache.move_to_end(index)
+                return frame
+            frame = self._read_frame(index)
+            if frame is None:
+                raise IOError(f"Cannot decode frame {index} of {self.name}")
+            self._cache[index] = frame
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return frame
+
+    def iter_frames(self, start=0, stop=None):
+        """Yield (index, frame) in order without filling the cache, for streaming passes over a range."""
+        stop = self.total_frames if stop is None else stop
+        for index in range(start, stop):
+            # Lock per frame, not per pass, so interactive reads can interleave
+            with self.lock:
+                frame = self._cache.get(index)
+                if frame is None:
+                    frame = self._read_frame(index)
+            if frame is None:
+                raise IOError(f"Cannot decode frame {index} of {self.name}")
+            yield index, frame
+
+    def open_reader(self):
+        """Source for a background thread's reads; sources with a stateful decoder return an independent one."""
+        return self
+
+    def frame_name(self, index):
+        """Name used for files derived from this frame (annotations, saved frames)."""
+        return f"frame_{index:04d}"
+
+    def save_frame(self, index, output_dir):
+        """Write a single frame as PNG and return its path."""
+        os.makedirs(output_dir, exist_ok=True)
+        frame_path = os.path.join(output_dir, f"{self.frame_name(index)}.png")
+        cv2.imwrite(frame_path, self.get_frame(index))
+        return frame_path
+
+    def close(self):
+        self._cache.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class VideoFrameSource(FrameSource):
+    """Frame source backed by a video file opened once and read by seeking."""
+
+    def __init__(self, video_path, cache_size=32):
+        super().__init__(os.path.basename(video_path), cache_size)
+        self.video_path = video_path
+        self.cap = cv2.VideoCapture(video_path)
+        if not self.cap.isOpened():
+            raise IOError(f"Cannot open video: {video_path}")
+        self._total_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self._next_index = 0  # Index the capture will return on the next read()
+        logging.info(f"Opened {video_path} ({self._total_frames} frames)")
+
+    @property
+    def total_frames(self):
+        return self._total_frames
+
+    def _read_frame(self, index):
+        # Sequential reads are much cheaper than seeking, so only seek on a jump
+        if index != self._next_index:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, frame = self.cap.read()
+        if not ret:
+            self._next_index = -1
+            return None
+        self._next_index = index + 1
+        return frame
+
+    def open_reader(self):
+        # A second capture, so background reads neither wait on this one's lock nor move its position
+        return VideoFrameSource(self.video_path, cache_size=0)
+
+    def close(self):
+        with self.lock:
+            super().close()
+            self.cap.release()
+
+
+class ArrayFrameSource(FrameSource):
+    """Frame source over an already decoded (N, H, W, 3) stack, e.g. a memory-mapped cache entry.
+
+    frame_step maps stack positions back to source frame numbers when the stack was decimated.
+    """
+
+    def __init__(self, frames, name, frame_step=1):
+        # Slicing a memmap is already zero-copy, so no decoded-frame cache is needed
+        super().__init__(name, cache_size=0)
+        self.frames = frames
+        self.frame_step = frame_step
+
+    @property
+    def total_frames(self):
+        return len(self.frames)
+
+    def _read_frame(self, index):
+        return self.frames[index]
+
+    def frame_name(self, index):
+        return f"frame_{index * self.frame_step:04d}"
+
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov')
+TIFF_EXTENSIONS = ('.tif', '.tiff')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp') + TIFF_EXTENSIONS
+# Slices decoded to estimate a stack's intensity window, spread evenly through it
+WINDOW_SAMPLE_SLICES = 8
+
+
+def intensity_window(images):
+    """(low, high) intensity range over every deeper-than-8-bit image of a stack, or None if there are none.
+
+    Unsigned data starts at 0; signed and float data at its minimum.
+    """
+    low, high = np.inf, -np.inf
+    for image in images:
+        if image is None or image.dtype == np.uint8 or not image.size:
+            continue
+        low = min(low, 0.0 if image.dtype.kind == 'u' else float(image.min()))
+        high = max(high, float(image.max()))
+    return (low, high) if high > low else None
+
+
+def window_sample(total, index):
+    """Indices of up to WINDOW_SAMPLE_SLICES evenly spaced slices, always including index."""
+    sample = set(np.linspace(0, total - 1, min(total, WINDOW_SAMPLE_SLICES)).astype(int).tolist())
+    sample.add(index)
+    return sorted(sample)
+
+
+def to_bgr8(image, rgb=False, window=None):
+    """Convert a decoded image (gray, RGB(A)/BGR(A), 8 bit or deeper) to the 8-bit BGR frames the GUI expects.
+
+    Deeper images map window (low, high) onto 0-255. Stack sources pass one
+    window for all their slices so every slice shares the same scale; without
+    one, unsigned data uses the full range of its dtype.
+    """
+    if image.dtype != np.uint8:
+        if window is None:
+            window = (0.0, float(np.iinfo(image.dtype).max)) if image.dtype.kind == 'u' else \
+                (float(image.min()), float(image.max())) if image.size else (0.0, 1.0)
+        low, high = window
+        alpha = 255.0 / (high - low) if high > low else 1.0
+        image = cv2.convertScaleAbs(image, alpha=alpha, beta=-low * alpha)
+    if image.ndim == 2 or image.shape[2] == 1:
+        return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    if image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_RGBA2BGR if rgb else cv2.COLOR_BGRA2BGR)
+    return cv2.cvtColor(image, cv2.COLOR_RGB2BGR) if rgb else image
+
+
+def _natural_key(name):
+    """Sort key putting slice_2 before slice_10."""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+class ImageSequenceFrameSource(FrameSource):
+    """Frame source over a directory of image files (one slice per file), in natural name order.
+
+    Opening only lists the directory; each image is decoded when first asked for.
+    The first deeper-than-8-bit image read fixes one intensity window for the
+    whole sequence from a few evenly spaced slices, so all slices are scaled
+    alike without decoding the stack up front.
+    """
+
+    def __init__(self, directory, cache_size=32):
+        super().__init__(os.path.basename(os.path.normpath(directory)), cache_size)
+        self.directory = directory
+        self.paths = [os.path.join(directory, name)
+                      for name in sorted(os.listdir(directory), key=_natural_key)
+                      if name.lower().endswith(IMAGE_EXTENSIONS)]
+        self._window = None
+        logging.info(f"Indexed {len(self.paths)} images in {directory}")
+
+    @property
+    def total_frames(self):
+        return len(self.paths)
+
+    def _read_image(self, index):
+        return cv2.imread(self.paths[index], cv2.IMREAD_ANYDEPTH | cv2.IMREAD_ANYCOLOR)
+
+    def _read_frame(self, index):
+        image = self._read_image(index)
+        if image is None:
+            return None
+        if image.dtype != np.uint8 and self._window is None:
+            self._window = intensity_window(image if i == index else self._read_image(i)
+                                            for i in window_sample(len(self.paths), index))
+            logging.info(f"Intensity window of {self.name}: {self._window}")
+        return to_bgr8(image, window=self._window)
+
+
+# TIFF field types: struct format and size of one value
+_TIFF_TYPES = {1: ('B', 1), 2: ('B', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8), 6: ('b', 1), 7: ('B', 1),
+               8: ('h', 2), 9: ('i', 4), 11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8)}
+# ImageWidth, ImageLength, BitsPerSample, Compression, Photometric, StripOffsets,
+# SamplesPerPixel, StripByteCounts, PlanarConfiguration, TileWidth, SampleFormat
+_TIFF_TAGS = (256, 257, 258, 259, 262, 273, 277, 279, 284, 322, 339)
+
+
+def read_tiff_pages(data):
+    """Tags of every page (IFD) of a classic or Big TIFF held in a uint8 buffer, e.g. a memmap."""
+    order = {b'II': '<', b'MM': '>'}.get(bytes(data[:2]))
+    if order is None:
+        raise IOError("Not a TIFF file")
+    buffer = memoryview(data)
+    magic = struct.unpack_from(order + 'H', buffer, 2)[0]
+    if magic == 42:
+        offset_format, count_format, entry_size, inline_size = 'I', 'H', 12, 4
+        offset = struct.unpack_from(order + 'I', buffer, 4)[0]
+    elif magic == 43:
+        offset_format, count_format, entry_size, inline_size = 'Q', 'Q', 20, 8
+        offset = struct.unpack_from(order + 'Q', buffer, 8)[0]
+    else:
+        raise IOError("Not a TIFF file")
+
+    pages = []
+    seen = set()
+    while offset and offset not in seen:
+        seen.add(offset)
+        num_entries = struct.unpack_from(order + count_format, buffer, offset)[0]
+        first_entry = offset + struct.calcsize(count_format)
+        tags = {}
+        for entry in range(first_entry, first_entry + num_entries * entry_size, entry_size):
+            tag, field_type = struct.unpack_from(order + 'HH', buffer, entry)
+            if tag not in _TIFF_TAGS or field_type not in _TIFF_TYPES:
+                continue
+            count = struct.unpack_from(order + offset_format, buffer, entry + 4)[0]
+            value_format, value_size = _TIFF_TYPES[field_type]
+            value_position = entry + 4 + struct.calcsize(offset_format)
+            if count * value_size > inline_size:
+                value_position = struct.unpack_from(order + offset_format, buffer, value_position)[0]
+            tags[tag] = struct.unpack_from(f"{order}{count * len(value_format)}{value_format[0]}", buffer, value_position)
+        pages.append(tags)
+        offset = struct.unpack_from(order + offset_format, buffer, first_entry + num_entries * entry_size)[0]
+    return order, pages
+
+
+class TiffStackFrameSource(FrameSource):
+    """Frame source over a multi-page TIFF (microscopy Z-stack, exported CT/MRI series).
+
+    Opening parses only the page directories. Uncompressed, stripped pages
+    are views straight into a memory map of the file; compressed or unusual
+    pages are decoded lazily with Pillow when first asked for. The first
+    deeper-than-8-bit page read fixes one intensity window for the stack from
+    a few evenly spaced pages, so all slices are scaled alike.
+    """
+
+    def __init__(self, tiff_path, cache_size=32):
+        super().__init__(os.path.basename(tiff_path), cache_size)
+        self.tiff_path = tiff_path
+        self._data = np.memmap(tiff_path, dtype=np.uint8, mode='r')
+        order, pages = read_tiff_pages(self._data)
+        self.pages = [self._map_page(order, tags) for tags in pages]
+        self._pil_image = None
+        self._window = None
+        mapped = sum(page is not None for page in self.pages)
+        logging.info(f"Indexed {len(self.pages)} pages of {tiff_path} ({mapped} memory-mapped)")
+
+    def _map_page(self, order, tags):
+        """(array view, is_rgb) for an uncompressed page stored in one contiguous run, else None."""
+        try:
+            width, height = tags[256][0], tags[257][0]
+            bits = tags.get(258, (1,))[0]
+            samples = tags.get(277, (1,))[0]
+            offsets, counts = tags[273], tags[279]
+        except KeyError:
+            return None
+        photometric = tags.get(262, (1 if samples == 1 else 2,))[0]
+        if (tags.get(259, (1,))[0] != 1 or 322 in tags or tags.get(339, (1,))[0] != 1 or bits not in (8, 16)
+                or photometric not in (1, 2) or (samples > 1 and tags.get(284, (1,))[0] != 1)):
+            return None
+        if any(offsets[i] + counts[i] != offsets[i + 1] for i in range(len(offsets) - 1)):
+            return None
+        dtype = np.dtype(f"{order}u{bits // 8}")
+        count = width * height * samples
+        if offsets[0] + count * dtype.itemsize > len(self._data):
+            return None
+        page = np.frombuffer(self._data, dtype=dtype, count=count, offset=offsets[0])
+        return page.reshape(height, width, samples), photometric == 2
+
+    @property
+    def total_frames(self):
+        return len(self.pages)
+
+    def _read_page(self, index):
+        """(array, is_rgb) of a page before conversion to 8-bit BGR."""
+        page = self.pages[index]
+        if page is not None:
+            return page
+        # Compressed page: decode it with Pillow, keeping the file open between reads
+        if self._pil_image is None:
+            self._pil_image = Image.open(self.tiff_path)
+        self._pil_image.seek(index)
+        image = self._pil_image
+        if image.mode not in ('L', 'RGB', 'RGBA', 'I;16', 'I;16B', 'I;16L', 'I', 'F'):
+            image = image.convert('RGB')
+        return np.array(image), True
+
+    def _read_frame(self, index):
+        array, rgb = self._read_page(index)
+        if array.dtype != np.uint8 and self._window is None:
+            self._window = intensity_window(array if i == index else self._read_page(i)[0]
+                                            for i in window_sample(len(self.pages), index))
+            logging.info(f"Intensity window of {self.name}: {self._window}")
+        return to_bgr8(array, rgb=rgb, window=self._window)
+
+    def close(self):
+        with self.lock:
+            super().close()
+            if self._pil_image is not None:
+                self._pil_image.close()
+                self._pil_image = None
+
+
+def is_frame_input(path):
+    """Whether path is something open_frame_source can read: a video, a TIFF stack or a directory of images."""
+    if os.path.isdir(path):
+        return any(name.lower().endswith(IMAGE_EXTENSIONS) for name in os.listdir(path))
+    return path.lower().endswith(VIDEO_EXTENSIONS + TIFF_EXTENSIONS)
+
+
+def open_frame_source(path, frame_cache=None):
+    """FrameSource for any supported input; videos already in frame_cache (when given) are mapped from it."""
+    if os.path.isdir(path):
+        return ImageSequenceFrameSource(path)
+    if path.lower().endswith(TIFF_EXTENSIONS):
+        return TiffStackFrameSource(path)
+    if frame_cache is not None:
+        return frame_cache.open_source(path)
+    return VideoFrameSource(path)
@@ -0,0 +1,218 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import json
+import logging
+import os
+import threading
+import time
+
+# Seconds between resident set size samples while any span is open
+RSS_SAMPLE_INTERVAL_S = 0.05
+
+
+def current_rss_bytes():
+    """Current resident set size of this process, or None where it cannot be read (non-Linux)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def path_bytes(path):
+    """Size of a file, or of every file under a directory; 0 if it does not exist."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Span:
+    """One timed stage. Use as a context manager; count work with add_frames() and add_bytes().
+
+    peak_rss is the largest resident set size seen while the span was open:
+    sampled at its start and end and every RSS_SAMPLE_INTERVAL_S in between,
+    so a spike shorter than the interval can be missed.
+    """
+
+    __slots__ = ("tracer", "name", "args", "frames", "bytes_written", "start", "end", "thread_id", "peak_rss")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.frames = 0
+        self.bytes_written = 0
+        self.start = self.end = None
+        self.thread_id = None
+        self.peak_rss = None
+
+    def add_frames(self, count=1):
+        self.frames += count
+
+    def add_bytes(self, count):
+        self.bytes_written += count
+
+    def sample_rss(self, rss):
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def __enter__(self):
+        self.thread_id = threading.get_ident()
+        self.sample_rss(current_rss_bytes())
+        self.tracer.open_span(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end = time.perf_counter()
+        self.tracer.close_span(self)
+        self.sample_rss(current_rss_bytes())
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self)
+        return False
+
+
+class _NullSpan:
+    """Stand-in returned while tracing is disabled; every call is a no-op."""
+
+    __slots__ = ()
+
+    def add_frames(self, count=1):
+        pass
+
+    def add_bytes(self, count):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Collects spans from every thread and writes them as a Chrome trace.
+
+    While disabled, span() hands back a shared no-op object, so hooks left in
+    the code cost one attribute check. While spans are open, a background
+    thread samples the resident set size into each of them. Open the trace in
+    chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._spans = []
+        self._open_spans = set()
+        self._sampler = None
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, args)
+
+    def open_span(self, span):
+        with self._lock:
+            self._open_spans.add(span)
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_rss, name="TracerRSS", daemon=True)
+                self._sampler.start()
+
+    def close_span(self, span):
+        with self._lock:
+            self._open_spans.discard(span)
+
+    def _sample_rss(self):
+        # Runs while any span is open; the next open_span starts a new sampler
+        while True:
+            time.sleep(RSS_SAMPLE_INTERVAL_S)
+            rss = current_rss_bytes()
+            with self._lock:
+                if not self._open_spans or rss is None:
+                    self._sampler = None
+                    return
+                for span in self._open_spans:
+                    span.sample_rss(rss)
+
+    def record(self, span):
+        with self._lock:
+            self._spans.append(span)
+
+    def spans(self):
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans = []
+
+    def to_chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        for span in sorted(self.spans(), key=lambda s: s.start):
+            args = dict(span.args, frames=span.frames, bytes_written=span.bytes_written, peak_rss_bytes=span.peak_rss)
+            events.append({
+                "name": span.name,
+                "cat": "stage",
+                "ph": "X",
+                "ts": (span.start - self._origin) * 1e6,
+                "dur": span.duration * 1e6,
+                "pid": pid,
+                "tid": span.thread_id,
+                "args": args,
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_chrome_trace(), f)
+        os.replace(tmp_path, path)
+        logging.info(f"Trace written to {path}")
+
+    def summary(self):
+        """Per stage name, in first-seen order: count, total/mean/max seconds, frames, bytes and peak RSS."""
+        rows = {}
+        for span in sorted(self.spans(), key=lambda s: s.start):
+            row = rows.setdefault(span.name, {"name": span.name, "count": 0, "total_s": 0.0, "max_s": 0.0,
+                                              "frames": 0, "bytes_written": 0, "peak_rss_bytes": None})
+            row["count"] += 1
+            row["total_s"] += span.duration
+            row["max_s"] = max(row["max_s"], span.duration)
+            row["frames"] += span.frames
+            row["bytes_written"] += span.bytes_written
+            if span.peak_rss is not None:
+                row["peak_rss_bytes"] = max(row["peak_rss_bytes"] or 0, span.peak_rss)
+        for row in rows.values():
+            row["mean_s"] = row["total_s"] / row["count"]
+        return list(rows.values())
+
+    def format_summary(self):
+        lines = [f"{'Stage':28s} {'Count':>6s} {'Total s':>9s} {'Mean s':>9s} {'Max s':>9s} "
+                 f"{'Frames':>8s} {'Written MB':>11s} {'Peak RSS MB':>12s}"]
+        for row in self.summary():
+            peak = f"{row['peak_rss_bytes'] / 1024 ** 2:12.1f}" if row["peak_rss_bytes"] is not None else f"{'-':>12s}"
+            lines.append(f"{row['name']:28s} {row['count']:6d} {row['total_s']:9.3f} {row['mean_s']:9.3f} "
+                         f"{row['max_s']:9.3f} {row['frames']:8d} {row['bytes_written'] / 1024 ** 2:11.2f} {peak}")
+        return "\n".join(lines)
+
+
+# Shared by the pipeline modules; main.py enables it for interactive runs
+tracer = Tracer()
@@ -2,16 +2,30 @@
 # Email: andrew.effat@uhn.ca
 
 # Import required classes
-from frame_extractor import FrameExtractor
+from frame_cache import FrameCache
 from frame_selector import FrameSelector
 from tumour_annotator import TumourAnnotator
-from volume_calculator import VolumeCalculator
+from volume_calculator import VolumeCalculator, RESULTS_HEADER
+from annotation_container import AnnotationContainer, CONTAINER_NAME
+from contour_interpolator import DEFAULT_NUM_POINTS
+from contour_propagator import ContourPropagator
+from instrumentation import tracer, path_bytes
+from video_pipeline import VideoPipeline, STATUS_HEADER
+from run_manifest import RunManifest, first_unannotated, load_points, directory_fingerprint, input_fingerprint
+from frame_source import is_frame_input, open_frame_source
+from results_store import ResultsStore
+from uncertainty import UNCERTAINTY_HEADER
+from app_window import AppWindow
 from tkinter import filedialog, messagebox, simpledialog
 from datetime import datetime
 import os
 import csv
 import tkinter as tk
 import logging
+import re
+
+# Folders this program writes next to its inputs, which must not be taken for image-sequence inputs
+OUTPUT_DIR_PATTERN = re.compile(r"_(frames|annotations|calculated)_\d{8}_\d{6}$")
 
 # Configure logging
 
@@ -54,39 +68,46 @@ if __name__ == "__main__":
     try:
         logging.info("Application is starting...")
 
-        def get_user_inputs():
+        # One window for the whole session; dialogs, the selector and the annotator all live in it
+        app = AppWindow()
+
+        def get_user_inputs(parent):
             """Launch a GUI to get the video folder path and slice thickness from the user."""
-            root = tk.Tk()
-            root.withdraw()
             messagebox.showinfo(
                 "Instructions", 
-                "In the next window, select the folder containing your video files."
+                "In the next window, select the folder containing your video files.",
+                parent=parent
             )
-            folder_path = filedialog.askdirectory(title="Select Folder Containing Videos")
-            root.destroy()
+            folder_path = filedialog.askdirectory(title="Select Folder Containing Videos", parent=parent)
 
             if not folder_path:
-                messagebox.showerror("Error", "No folder selected. Exiting.")
-                return None, None, None
+                messagebox.showerror("Error", "No folder selected. Exiting.", parent=parent)
+                return None, None, None, None, None
 
-            root = tk.Tk()
+            root = tk.Toplevel(parent)
             root.title("Slice Thickness Configuration")
 
             slice_thickness_mm = None
             same_thickness = None
+            sampling_mode = None
+            record_results = None
+            estimate_uncertainty = None
 
             def on_confirm():
-                nonlocal slice_thickness_mm, same_thickness
+                nonlocal slice_thickness_mm, same_thickness, sampling_mode, record_results, estimate_uncertainty
                 try:
                     slice_thickness_mm = float(thickness_entry.get())
                     if slice_thickness_mm <= 0:
                         raise ValueError
                 except ValueError:
-                    messagebox.showerror("Error", "Please enter a valid positive number.")
+                    messagebox.showerror("Error", "Please enter a valid positive number.", parent=root)
                     return
 
                 same_thickness = checkbox_var.get()
-                root.quit()
+                sampling_mode = "adaptive" if adaptive_var.get() else "uniform"
+                record_results = database_var.get()
+                estimate_uncertainty = uncertainty_var.get()
+                root.destroy()
 
             tk.Label(root, text="Enter slice thickness (in mm):").pack(pady=5)
             thickness_entry = tk.Entry(root)
@@ -95,83 +116,236 @@ if __name__ == "__main__":
             checkbox_var = tk.BooleanVar(value=True)
             tk.Checkbutton(root, text="Use same slice thickness for all videos", variable=checkbox_var).pack(pady=5)
 
+            adaptive_var = tk.BooleanVar(value=False)
+            tk.Checkbutton(root, text="Sample frames where the anatomy changes (adaptive)", variable=adaptive_var).pack(pady=5)
+
+            database_var = tk.BooleanVar(value=False)
+            tk.Checkbutton(root, text="Also record results in the local results database", variable=database_var).pack(pady=5)
+
+            uncertainty_var = tk.BooleanVar(value=False)
+            tk.Checkbutton(root, text="Estimate volume uncertainty (95% interval)", variable=uncertainty_var).pack(pady=5)
+
             tk.Button(root, text="Confirm", command=on_confirm).pack(pady=10)
-            root.mainloop()
-            root.destroy()
+            parent.wait_window(root)  # Closing the dialog without confirming leaves the thickness unset
 
-            return folder_path, slice_thickness_mm, same_thickness
+            return folder_path, slice_thickness_mm, same_thickness, sampling_mode, record_results, estimate_uncertainty
         
         
 
-        folder_path, slice_thickness_mm, same_thickness = get_user_inputs()
+        folder_path, slice_thickness_mm, same_thickness, sampling_mode, record_results, estimate_uncertainty = get_user_inputs(app.root)
         if not folder_path or slice_thickness_mm is None:
             exit()
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         results_csv = os.path.join(folder_path, "tumour_volume_results_{}.csv".format(timestamp))
+        result_columns = RESULTS_HEADER + (UNCERTAINTY_HEADER if estimate_uncertainty else [])
         with open(results_csv, mode='w', newline='') as file:
             writer = csv.writer(file)
-            writer.writerow(['Video Name', 'Tumour Volume (mm^3)','Max Width (mm)', 'Avg Width (mm)', 'Max Depth (mm)', 'Avg Depth (mm)', 'Length (mm)', 'Slice Thickness (mm)', 'Pixel-to-mm Ratio', 'Timestamp'])
+            writer.writerow(result_columns + STATUS_HEADER)
+
+        # Stage timings go to a Chrome trace next to the results; set VOLUME_ESTIMATOR_TRACE=0 to turn them off
+        tracer.enabled = os.environ.get("VOLUME_ESTIMATOR_TRACE", "1") != "0"
+        trace_path = os.path.splitext(results_csv)[0] + "_trace.json"
+
+        # Decoded frames are cached across runs, keyed by video content
+        frame_cache = FrameCache()
+        # Optional history of every result, queryable with results_store.py
+        results_store = ResultsStore() if record_results else None
+
+        # Videos, multi-page TIFF stacks and folders of image slices
+        video_files = [name for name in os.listdir(folder_path)
+                       if not OUTPUT_DIR_PATTERN.search(name) and is_frame_input(os.path.join(folder_path, name))]
+        # Checkpoints every stage, so a rerun skips finished videos and resumes the rest
+        manifest = RunManifest(folder_path)
+        pending_files = [name for name in video_files if not manifest.completed(name, "annotated")]
+        # Prepares the next videos' frames and computes finished ones in the background
+        pipeline = VideoPipeline(frame_cache, [os.path.join(folder_path, name) for name in pending_files], results_csv,
+                                 row_length=len(result_columns))
+
+        def calculate_results(video_file, entry):
+            """Pack a video's annotations and compute its results row; runs on the pipeline's worker."""
+            video_name, annotation_dir, output_dir = entry["video_name"], entry["annotation_dir"], entry["output_dir"]
+            with tracer.span("calculation", video=video_name) as span:
+                # Pack the study into one binary container alongside the per-frame JSONs
+                container_path = os.path.join(annotation_dir, CONTAINER_NAME)
+                AnnotationContainer.from_json_dir(annotation_dir, entry["pixel_to_mm_ratio"], entry["slice_thickness_mm"]).save(container_path)
+
+                calculator = VolumeCalculator(
+                    annotated_frames=container_path,
+                    output_dir=output_dir,
+                    total_frames=entry["total_frames"],
+                    slice_thickness_mm=entry["slice_thickness_mm"],
+                    pixel_to_mm_ratio=entry["pixel_to_mm_ratio"],
+                    interpolation_points=DEFAULT_NUM_POINTS,  # Writes the in-between contours to output_dir
+                )
+                volume_mm3, max_width, avg_width, max_depth, avg_depth, length = calculator.run()
+                span.add_frames(len(entry["sampled_frames"]))
+                if tracer.enabled:
+                    span.add_bytes(path_bytes(container_path) + path_bytes(output_dir))
+            row = [video_name, volume_mm3, max_width, avg_width, max_depth, avg_depth, length, entry["slice_thickness_mm"], entry["pixel_to_mm_ratio"], entry["timestamp"]]
+            if results_store is not None:
+                # Hashed here, off the UI thread; usually already memoized by the background frame cache fill
+                video_path = os.path.join(folder_path, video_file)
+                content_hash = entry.get("sha256") or (directory_fingerprint(video_path) if os.path.isdir(video_path)
+                                                       else frame_cache.content_hash(video_path))
+                manifest.update(video_file, sha256=content_hash)
+                results_store.record(row, content_hash, calculator.slice_metrics(), source=annotation_dir)
+            manifest.update(video_file, "calculated", results=row)
+            return with_uncertainty(video_file, entry, row, recompute=True)
+
+        def with_uncertainty(video_file, entry, row, recompute=False):
+            """row plus the volume's Monte Carlo SD and interval, if asked for; kept in the manifest for reruns."""
+            if not estimate_uncertainty:
+                return row
+            uncertainty = None if recompute else entry.get("uncertainty")
+            if uncertainty is None:
+                calculator = VolumeCalculator(
+                    annotated_frames=os.path.join(entry["annotation_dir"], CONTAINER_NAME),
+                    output_dir=entry["output_dir"],
+                    total_frames=entry["total_frames"],
+                    slice_thickness_mm=entry["slice_thickness_mm"],
+                    pixel_to_mm_ratio=entry["pixel_to_mm_ratio"],
+                )
+                uncertainty = list(calculator.run_uncertainty())
+                manifest.update(video_file, uncertainty=uncertainty)
+            return row + uncertainty
+
+        try:
+            for video_file in video_files:
+                video_path = os.path.join(folder_path, video_file)
+                video_name = video_file if os.path.isdir(video_path) else os.path.splitext(video_file)[0]
+                entry = manifest.entry(video_file, input_fingerprint(video_path))
+
+                if "calculated" in entry["stages"]:
+                    logging.info(f"{video_name} was finished in an earlier run; reusing its results")
+                    pipeline.submit_calculation(with_uncertainty, video_file, entry, entry["results"], row_name=video_name)
+                    continue
+                if "annotated" in entry["stages"]:
+                    logging.info(f"{video_name} is annotated but has no results; recomputing them")
+                    pipeline.submit_calculation(calculate_results, video_file, entry, row_name=video_name)
+                    continue
 
-        for video_name in os.listdir(folder_path):
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            if video_name.endswith(('.avi', '.mp4', '.mov')):
-                video_path = os.path.join(folder_path, video_name)
-                video_name = os.path.splitext(video_name)[0]
+                timestamp = entry.get("timestamp") or datetime.now().strftime("%Y%m%d_%H%M%S")
                 logging.info(f"Processing {video_name}...")
 
+                # A resumed video keeps the thickness it was started with
+                video_thickness_mm = entry.get("slice_thickness_mm", slice_thickness_mm)
                 # If "same thickness" is not checked, prompt user for slice thickness per video
-                if not same_thickness:
-                    application_window = tk.Tk()
-                    application_window.withdraw()
-                    application_window.title("Slice Thickness Configuration")
-                    slice_thickness_mm = simpledialog.askfloat(
+                if not same_thickness and "slice_thickness_mm" not in entry:
+                    video_thickness_mm = simpledialog.askfloat(
                         "Slice Thickness Configuration",
                         f"Enter slice thickness (in mm) for {video_name}:",
-                        parent=application_window
+                        parent=app.root
                     )
-                    if slice_thickness_mm is None:
-                        messagebox.showerror("Error", "No slice thickness entered. Exiting.")
+                    if video_thickness_mm is None:
+                        messagebox.showerror("Error", "No slice thickness entered. Exiting.", parent=app.root)
                         exit()
-                    application_window.destroy()
                     
 
-                output_dir = os.path.join(folder_path, f"{video_name}_frames_{timestamp}")
-                os.makedirs(output_dir, exist_ok=True)
+                with tracer.span("extraction", video=video_name) as span:
+                    if video_file in pending_files:
+                        frame_source = pipeline.open_source(pending_files.index(video_file))  # Usually prepared while the previous video was annotated
+                    else:
+                        frame_source = open_frame_source(video_path, frame_cache)  # Changed since it was annotated
+                    total_frames = frame_source.total_frames
+                    span.add_frames(total_frames)
+                logging.info(f"Total frames available: {total_frames}")
+                manifest.update(video_file, "extracted", video_name=video_name, timestamp=timestamp,
+                                total_frames=total_frames, slice_thickness_mm=video_thickness_mm)
 
-                frame_extractor = FrameExtractor(video_path, output_dir)
-                total_frames = frame_extractor.extract_frames()
-                logging.info(f"Total frames extracted: {total_frames}")
+                if "selected" in entry["stages"]:
+                    sampled_frames = entry["sampled_frames"]
+                    annotation_dir = entry["annotation_dir"]
+                    logging.info(f"Resuming {video_name} with its earlier sampled frames: {sampled_frames}")
+                else:
+                    with tracer.span("range_selection", video=video_name, mode=sampling_mode) as span:
+                        frame_selector = FrameSelector(frame_source, app=app)
+                        sampled_frames = [int(i) for i in frame_selector.get_sampled_frames(mode=sampling_mode)]
+                        span.add_frames(len(sampled_frames))
+                    logging.info(f"Sampled frames for annotation: {sampled_frames}")
 
-                frame_selector = FrameSelector(output_dir)
-                sampled_frames = frame_selector.get_sampled_frames()
-                logging.info(f"Sampled frames for annotation: {sampled_frames}")
+                    # Only the sampled frames are written to disk, for reference
+                    output_dir = os.path.join(folder_path, f"{video_name}_frames_{timestamp}")
+                    with tracer.span("save_frames", video=video_name) as span:
+                        for frame_index in sampled_frames:
+                            frame_source.save_frame(frame_index, output_dir)
+                        span.add_frames(len(sampled_frames))
+                        if tracer.enabled:
+                            span.add_bytes(path_bytes(output_dir))
 
-                annotation_dir = os.path.join(folder_path, f"{video_name}_annotations_{timestamp}")
+                    annotation_dir = os.path.join(folder_path, f"{video_name}_annotations_{timestamp}")
+                    manifest.update(video_file, "selected", sampled_frames=sampled_frames,
+                                    frames_dir=output_dir, annotation_dir=annotation_dir)
                 os.makedirs(annotation_dir, exist_ok=True)  # Ensure directory exists before saving
-                                    
-                for idx, frame_path in enumerate(sampled_frames):
-                    annotator = TumourAnnotator(frame_path, annotation_dir, idx, sampled_frames)
+
+                # Resume at the first frame without an annotation; the calibration is on the last one
+                frame_names = [frame_source.frame_name(frame_index) for frame_index in sampled_frames]
+                start = first_unannotated(annotation_dir, frame_names)
+                if start is None:
+                    start = len(sampled_frames) - 1
+                if start > 0:
+                    logging.info(f"Resuming {video_name} at frame {sampled_frames[start]}")
+
+                # Drafts each next contour in the background while the current frame is annotated
+                propagator = ContourPropagator(frame_source)
+                previous_points = load_points(annotation_dir, frame_names[start - 1]) if start > 0 else None
+                if previous_points:
+                    propagator.submit(previous_points, sampled_frames[start - 1], sampled_frames[start])
+                annotator = None  # One view per video; each frame is swapped into it
+                for idx in range(start, len(sampled_frames)):
+                    frame_index = sampled_frames[idx]
+                    # Open the frame at once with the best finished draft; a newer one still running is shown when ready
+                    draft = propagator.get_draft(frame_index) if idx > 0 else None
+                    pending_draft = propagator.pending_draft(frame_index) if idx > 0 else None
+                    if previous_points and idx + 1 < len(sampled_frames):
+                        # Early draft for the frame after this one, from the last saved contour
+                        propagator.submit(previous_points, sampled_frames[idx - 1], sampled_frames[idx + 1])
+                    with tracer.span("annotation", video=video_name, frame=int(frame_index)) as span:
+                        if annotator is None:
+                            annotator = TumourAnnotator(frame_source, frame_index, annotation_dir, idx, sampled_frames,
+                                                        initial_points=draft, app=app, pending_draft=pending_draft)
+                        else:
+                            annotator.annotate(frame_index, idx, initial_points=draft, pending_draft=pending_draft)
+                        span.add_frames()
+                        if tracer.enabled:
+                            span.add_bytes(path_bytes(os.path.join(annotation_dir, f"{frame_names[idx]}.json")))
+                    previous_points = annotator.saved_points
+                    if previous_points and idx + 1 < len(sampled_frames):
+                        # Refine the next draft from the contour just saved; it replaces the early one if ready in time
+                        propagator.submit(previous_points, frame_index, sampled_frames[idx + 1])
                     if idx == len(sampled_frames) - 1:  # Last frame
                         pixel_to_mm_ratio = annotator.get_pixel_to_mm_ratio()
                         if pixel_to_mm_ratio is None:
                             raise ValueError("Pixel-to-mm ratio not calculated.")
+                annotator.close()
+                propagator.shutdown()
+                frame_source.close()
 
                 logging.info("Annotation completed.")
+                manifest.update(video_file, "annotated", pixel_to_mm_ratio=pixel_to_mm_ratio,
+                                output_dir=os.path.join(folder_path, f"{video_name}_calculated_{timestamp}"))
 
-                calculator = VolumeCalculator(
-                    annotated_frames=sorted([os.path.join(annotation_dir, f) for f in os.listdir(annotation_dir) if f.endswith(".json")]),
-                    output_dir=os.path.join(folder_path, f"{video_name}_calculated_{timestamp}"),
-                    total_frames=total_frames,
-                    slice_thickness_mm=slice_thickness_mm,
-                    pixel_to_mm_ratio=pixel_to_mm_ratio,
-                )
-                volume_mm3, max_width, avg_width, max_depth, avg_depth, length = calculator.run()
-
-                with open(results_csv, mode='a', newline='') as file:
-                    writer = csv.writer(file)
-                    writer.writerow([video_name, volume_mm3, max_width, avg_width, max_depth, avg_depth, length, slice_thickness_mm,pixel_to_mm_ratio,timestamp])
+                # Computed in the background while the next video is annotated; rows reach the CSV in order
+                pipeline.submit_calculation(calculate_results, video_file, manifest.entry(video_file, entry["fingerprint"]),
+                                            row_name=video_name)
+                if tracer.enabled:
+                    tracer.write_chrome_trace(trace_path)  # Rewritten per video so an aborted run keeps its timings
+        finally:
+            # Quitting mid-batch abandons the prefetch but still writes every annotated video's row
+            pipeline.shutdown()
+            if results_store is not None:
+                results_store.close()
+        if tracer.enabled:
+            tracer.write_chrome_trace(trace_path)
         
         logging.info(f"Results saved to {results_csv}")
+        if pipeline.failed:
+            details = "\n".join(f"{name}: {error}" for name, error in pipeline.failed)
+            messagebox.showerror("Volume Calculation Failed",
+                                 f"No results for {len(pipeline.failed)} video(s); they are marked 'failed' in "
+                                 f"{os.path.basename(results_csv)}:\n\n{details}", parent=app.root)
+        if tracer.enabled and tracer.spans():
+            logging.info(f"Stage summary:\n{tracer.format_summary()}")
+        app.destroy()
 
     except Exception as e:
         logging.error("An error occurred", exc_info=True)
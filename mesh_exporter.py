@@ -0,0 +1,194 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import argparse
+import logging
+import os
+import struct
+import numpy as np
+from contour_store import ContourStore
+from contour_interpolator import DEFAULT_NUM_POINTS, align_contours, resample_contours
+from annotation_container import AnnotationContainer
+
+# Annotated contours resampled and aligned per batch, bounding memory on long stacks
+RESAMPLE_CHUNK = 256
+
+STL_TRIANGLE = np.dtype([("normal", "<f4", 3), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+
+
+def iter_rings(store, num_points=DEFAULT_NUM_POINTS, interpolate=True):
+    """Yield (frame, (num_points, 2) contour) for every slice of the mesh, in frame order.
+
+    Annotated contours are resampled and aligned a chunk at a time, and the
+    frames between two annotated contours are blended as they are reached,
+    matching contour_interpolator.interpolate_contours without building the
+    whole dense stack.
+    """
+    previous_frame, previous = None, None
+    for start in range(0, len(store), RESAMPLE_CHUNK):
+        stop = min(start + RESAMPLE_CHUNK, len(store))
+        offsets = store.offsets[start:stop + 1]
+        chunk = ContourStore(store.frame_indices[start:stop], store.vertices[offsets[0]:offsets[-1]], offsets - offsets[0])
+        rings = resample_contours(chunk, num_points)
+        if previous is not None:
+            # The previous ring is already aligned, so it anchors this chunk's start points
+            rings = align_contours(np.concatenate([previous[None], rings]))[1:]
+        else:
+            rings = align_contours(rings)
+
+        for frame, ring in zip(chunk.frame_indices, rings):
+            if interpolate and previous is not None:
+                for between in range(previous_frame + 1, frame):
+                    weight = (between - previous_frame) / (frame - previous_frame)
+                    yield between, (1 - weight) * previous + weight * ring
+            yield frame, ring
+            previous_frame, previous = frame, ring
+
+
+class MeshExporter:
+    """Closed triangle mesh of the tumour surface, streamed to binary STL or PLY.
+
+    Consecutive slice contours are stitched into a band of 2 * num_points
+    triangles and written out immediately, so only two rings are held at a
+    time; the first and last slices are closed with triangle fans.
+    Coordinates are in mm: x, y from the pixel-to-mm ratio and z from the
+    frame index times the slice thickness.
+    """
+
+    def __init__(self, store, slice_thickness_mm, pixel_to_mm_ratio, num_points=DEFAULT_NUM_POINTS, interpolate=True):
+        if len(store) < 2:
+            raise ValueError("At least two annotated slices are needed to build a mesh.")
+        self.store = store
+        self.slice_thickness_mm = slice_thickness_mm
+        self.pixel_to_mm_ratio = pixel_to_mm_ratio
+        self.num_points = num_points
+        self.interpolate = interpolate
+        frames = store.frame_indices
+        self.num_rings = int(frames[-1] - frames[0] + 1) if interpolate else len(store)
+
+    def iter_rings_mm(self):
+        """Yield each ring as a (num_points, 3) array in mm."""
+        for frame, ring in iter_rings(self.store, self.num_points, self.interpolate):
+            ring_mm = np.empty((self.num_points, 3))
+            ring_mm[:, :2] = ring / self.pixel_to_mm_ratio
+            ring_mm[:, 2] = frame * self.slice_thickness_mm
+            yield ring_mm
+
+    def band_faces(self, lower_start, upper_start):
+        """Vertex indices of the triangles joining two rings whose vertices start at the given indices."""
+        i = np.arange(self.num_points)
+        following = (i + 1) % self.num_points
+        a, a_next = lower_start + i, lower_start + following
+        b, b_next = upper_start + i, upper_start + following
+        return np.concatenate([np.stack([a, a_next, b_next], axis=1), np.stack([a, b_next, b], axis=1)])
+
+    def cap_faces(self, ring_start, centre, top):
+        i = np.arange(self.num_points)
+        following = (i + 1) % self.num_points
+        centre = np.full(self.num_points, centre)
+        if top:
+            return np.stack([centre, ring_start + i, ring_start + following], axis=1)
+        return np.stack([centre, ring_start + following, ring_start + i], axis=1)
+
+    @property
+    def num_triangles(self):
+        return (self.num_rings - 1) * 2 * self.num_points + 2 * self.num_points
+
+    def export(self, path):
+        """Write the mesh; the format follows the extension (.stl or .ply). Returns the triangle count."""
+        extension = os.path.splitext(path)[1].lower()
+        if extension == ".stl":
+            count = self.write_stl(path)
+        elif extension == ".ply":
+            count = self.write_ply(path)
+        else:
+            raise ValueError(f"Unsupported mesh format: {extension}")
+        logging.info(f"Exported {count} triangles to {path}")
+        return count
+
+    def write_stl(self, path):
+        with open(path, 'wb') as f:
+            f.write(b"VolumeEstimator3D tumour surface".ljust(80, b"\0"))
+            f.write(struct.pack('<I', 0))  # Patched once all triangles are written
+            count = 0
+            previous = None
+            for ring in self.iter_rings_mm():
+                if previous is None:
+                    count += self._write_stl_triangles(f, np.vstack([ring, ring.mean(axis=0)]),
+                                                       self.cap_faces(0, self.num_points, top=False))
+                else:
+                    both = np.vstack([previous, ring])
+                    count += self._write_stl_triangles(f, both, self.band_faces(0, self.num_points))
+                previous = ring
+            count += self._write_stl_triangles(f, np.vstack([previous, previous.mean(axis=0)]),
+                                               self.cap_faces(0, self.num_points, top=True))
+            f.seek(80)
+            f.write(struct.pack('<I', count))
+        return count
+
+    def _write_stl_triangles(self, f, vertices, faces):
+        corners = vertices[faces]  # (n, 3, 3)
+        normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        normals = np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+        triangles = np.zeros(len(faces), dtype=STL_TRIANGLE)
+        triangles["normal"] = normals
+        triangles["vertices"] = corners
+        f.write(triangles.tobytes())
+        return len(faces)
+
+    def write_ply(self, path):
+        num_vertices = self.num_rings * self.num_points + 2
+        header = (
+            "ply\nformat binary_little_endian 1.0\ncomment VolumeEstimator3D tumour surface (mm)\n"
+            f"element vertex {num_vertices}\nproperty float x\nproperty float y\nproperty float z\n"
+            f"element face {self.num_triangles}\nproperty list uchar int vertex_indices\nend_header\n"
+        )
+        face_dtype = np.dtype([("count", "u1"), ("indices", "<i4", 3)])
+        with open(path, 'wb') as f:
+            f.write(header.encode('ascii'))
+            # Vertices ring by ring; the two cap centres go last, at known indices
+            first_centre = last_centre = None
+            for ring in self.iter_rings_mm():
+                f.write(ring.astype('<f4').tobytes())
+                if first_centre is None:
+                    first_centre = ring.mean(axis=0)
+                last_centre = ring.mean(axis=0)
+            f.write(np.array([first_centre, last_centre], dtype='<f4').tobytes())
+
+            # Faces only depend on ring positions, so they are generated without the coordinates
+            for faces in self.iter_ply_faces():
+                records = np.empty(len(faces), dtype=face_dtype)
+                records["count"] = 3
+                records["indices"] = faces
+                f.write(records.tobytes())
+        return self.num_triangles
+
+    def iter_ply_faces(self):
+        """Face index blocks in PLY vertex numbering: bottom cap, one band per ring pair, top cap."""
+        bottom_centre = self.num_rings * self.num_points
+        yield self.cap_faces(0, bottom_centre, top=False)
+        for r in range(self.num_rings - 1):
+            yield self.band_faces(r * self.num_points, (r + 1) * self.num_points)
+        yield self.cap_faces((self.num_rings - 1) * self.num_points, bottom_centre + 1, top=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the tumour surface of an annotation container as STL or PLY.")
+    parser.add_argument("container", help="Path of an annotations.vea container")
+    parser.add_argument("output", help="Output mesh (.stl or .ply)")
+    parser.add_argument("--slice-thickness", type=float, default=None, help="Slice thickness in mm (default: the container's)")
+    parser.add_argument("--pixel-to-mm", type=float, default=None, help="Pixel-to-mm ratio (default: the container's)")
+    parser.add_argument("--points", type=int, default=DEFAULT_NUM_POINTS, help="Points per slice contour")
+    parser.add_argument("--no-interpolation", action="store_true", help="Only stitch the annotated slices")
+    args = parser.parse_args()
+
+    container = AnnotationContainer.load(args.container)
+    exporter = MeshExporter(
+        container.store,
+        args.slice_thickness if args.slice_thickness is not None else container.slice_thickness_mm,
+        args.pixel_to_mm if args.pixel_to_mm is not None else container.pixel_to_mm_ratio,
+        num_points=args.points,
+        interpolate=not args.no_interpolation,
+    )
+    print(f"Wrote {exporter.export(args.output)} triangles to {args.output}")
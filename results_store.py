@@ -0,0 +1,198 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Local SQLite history of every computed result, next to the per-run CSVs.
+
+Usage:
+    python results_store.py query --video tumour_01 --csv history.csv
+    python results_store.py slices tumour_01
+    python results_store.py import old_runs/tumour_volume_results_*.csv
+
+query prints (or exports with --csv) rows in the results CSV layout.
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from volume_calculator import RESULTS_HEADER
+
+DEFAULT_BATCH_SIZE = 32
+
+# The summary columns in RESULTS_HEADER order, then bookkeeping
+RESULT_COLUMNS = ["video_name", "volume_mm3", "max_width_mm", "avg_width_mm", "max_depth_mm", "avg_depth_mm",
+                  "length_mm", "slice_thickness_mm", "pixel_to_mm_ratio", "timestamp"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    video_name TEXT NOT NULL,
+    volume_mm3 REAL,
+    max_width_mm REAL,
+    avg_width_mm REAL,
+    max_depth_mm REAL,
+    avg_depth_mm REAL,
+    length_mm REAL,
+    slice_thickness_mm REAL,
+    pixel_to_mm_ratio REAL,
+    timestamp TEXT NOT NULL,
+    content_sha256 TEXT,
+    source TEXT,
+    recorded_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_video_name ON results (video_name);
+CREATE INDEX IF NOT EXISTS results_content_sha256 ON results (content_sha256);
+CREATE INDEX IF NOT EXISTS results_timestamp ON results (timestamp);
+CREATE TABLE IF NOT EXISTS slices (
+    result_id INTEGER NOT NULL REFERENCES results (id) ON DELETE CASCADE,
+    frame_index INTEGER NOT NULL,
+    area_mm2 REAL,
+    width_mm REAL,
+    depth_mm REAL,
+    PRIMARY KEY (result_id, frame_index)
+) WITHOUT ROWID;
+"""
+
+
+def default_db_path():
+    """Database location, overridable with the VOLUME_ESTIMATOR_RESULTS_DB environment variable."""
+    return os.environ.get(
+        "VOLUME_ESTIMATOR_RESULTS_DB",
+        os.path.join(os.path.expanduser("~"), ".local", "share", "VolumeEstimator3D", "results.sqlite"),
+    )
+
+
+class ResultsStore:
+    """Indexed history of results rows and their per-slice metrics.
+
+    record() buffers results and writes them batch_size at a time, each batch
+    in one transaction; flush() or close() writes the rest. Safe to share
+    between threads.
+    """
+
+    def __init__(self, db_path=None, batch_size=DEFAULT_BATCH_SIZE):
+        self.db_path = db_path or default_db_path()
+        self.batch_size = batch_size
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self.connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def record(self, row, content_hash=None, slices=None, source=None):
+        """Queue one results row (RESULTS_HEADER layout) with optional (frame, area_mm2, width_mm, depth_mm) slices."""
+        with self._lock:
+            self._pending.append((list(row), content_hash, list(slices or []), source))
+            if len(self._pending) >= self.batch_size:
+                self._write_pending()
+
+    def flush(self):
+        with self._lock:
+            self._write_pending()
+
+    def _write_pending(self):
+        if not self._pending:
+            return
+        now = time.time()
+        with self.connection:  # One transaction per batch
+            for row, content_hash, slices, source in self._pending:
+                cursor = self.connection.execute(
+                    f"INSERT INTO results ({', '.join(RESULT_COLUMNS)}, content_sha256, source, recorded_at) "
+                    f"VALUES ({', '.join('?' * (len(RESULT_COLUMNS) + 3))})",
+                    [*row, content_hash, source, now])
+                self.connection.executemany(
+                    "INSERT INTO slices (result_id, frame_index, area_mm2, width_mm, depth_mm) VALUES (?, ?, ?, ?, ?)",
+                    [(cursor.lastrowid, int(frame), float(area), float(width), float(depth))
+                     for frame, area, width, depth in slices])
+        logging.info(f"Recorded {len(self._pending)} results in {self.db_path}")
+        self._pending = []
+
+    def query(self, video_name=None, content_hash=None, since=None, until=None):
+        """Results rows in RESULTS_HEADER layout, oldest first; timestamps are YYYYmmdd_HHMMSS strings."""
+        self.flush()
+        clauses, params = [], []
+        for clause, value in (("video_name = ?", video_name), ("content_sha256 = ?", content_hash),
+                              ("timestamp >= ?", since), ("timestamp <= ?", until)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        return self.connection.execute(
+            f"SELECT {', '.join(RESULT_COLUMNS)} FROM results{where} ORDER BY timestamp, id", params).fetchall()
+
+    def slices(self, video_name, timestamp=None):
+        """(timestamp, frame_index, area_mm2, width_mm, depth_mm) of a video's results (or of one run)."""
+        self.flush()
+        sql = ("SELECT r.timestamp, s.frame_index, s.area_mm2, s.width_mm, s.depth_mm "
+               "FROM slices s JOIN results r ON r.id = s.result_id WHERE r.video_name = ?")
+        params = [video_name]
+        if timestamp is not None:
+            sql += " AND r.timestamp = ?"
+            params.append(timestamp)
+        return self.connection.execute(sql + " ORDER BY r.timestamp, r.id, s.frame_index", params).fetchall()
+
+    def import_csv(self, csv_path):
+        """Record every row of an existing results CSV; returns the number of rows."""
+        with open(csv_path, 'r', newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None or header[:len(RESULTS_HEADER)] != RESULTS_HEADER:
+                raise ValueError(f"{csv_path} is not a results CSV")
+            # Rows of videos whose calculation failed (main.py and batch_volume.py mark them) have no results
+            status = header.index("Status") if "Status" in header else None
+            count = 0
+            for row in reader:
+                if status is not None and status < len(row) and row[status] == "failed":
+                    continue
+                row = [None if value == "" else value for value in row[:len(RESULTS_HEADER)]]
+                self.record(row, source=os.path.abspath(csv_path))
+                count += 1
+        self.flush()
+        return count
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query and export the results database.")
+    parser.add_argument("--db", default=None, help="Database path (default: %s)" % default_db_path())
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser("query", help="Results in the CSV layout")
+    query_parser.add_argument("--video", default=None, help="Video name")
+    query_parser.add_argument("--hash", default=None, help="Video content SHA-256")
+    query_parser.add_argument("--since", default=None, help="Earliest timestamp, e.g. 20240101_000000")
+    query_parser.add_argument("--until", default=None, help="Latest timestamp")
+    query_parser.add_argument("--csv", default=None, help="Write to this CSV instead of standard output")
+    slices_parser = subparsers.add_parser("slices", help="Per-slice metrics of a video")
+    slices_parser.add_argument("video")
+    slices_parser.add_argument("--timestamp", default=None, help="Only this run")
+    import_parser = subparsers.add_parser("import", help="Record rows of existing results CSVs")
+    import_parser.add_argument("csv_files", nargs="+")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    if args.command == "query":
+        rows = store.query(args.video, args.hash, args.since, args.until)
+        file = open(args.csv, 'w', newline='') if args.csv else sys.stdout
+        writer = csv.writer(file)
+        writer.writerow(RESULTS_HEADER)
+        writer.writerows(rows)
+        if args.csv:
+            file.close()
+            print(f"Exported {len(rows)} rows to {args.csv}")
+    elif args.command == "slices":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["Timestamp", "Frame", "Area (mm^2)", "Width (mm)", "Depth (mm)"])
+        writer.writerows(store.slices(args.video, args.timestamp))
+    elif args.command == "import":
+        for csv_path in args.csv_files:
+            print(f"Imported {store.import_csv(csv_path)} rows from {csv_path}")
+    store.close()
@@ -0,0 +1,118 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+
+MANIFEST_NAME = "volume_estimator_run.json"
+# In the order a video goes through them
+STAGES = ("extracted", "selected", "annotated", "calculated")
+
+
+class RunManifest:
+    """Per-folder checkpoint of a batch run, so a rerun picks up where the last one stopped.
+
+    Each video file has an entry holding its fingerprint (see
+    input_fingerprint), the stages it has completed, where its frames and
+    annotations went, its calibration and, once calculated, its content hash
+    and results row. An entry whose video has changed (different
+    fingerprint) starts over.
+    """
+
+    def __init__(self, folder_path, name=MANIFEST_NAME):
+        self.path = os.path.join(folder_path, name)
+        self._lock = threading.Lock()  # Results are recorded from the calculation worker
+        try:
+            with open(self.path, 'r') as f:
+                self.videos = json.load(f).get("videos", {})
+        except (OSError, ValueError):
+            self.videos = {}
+
+    def entry(self, video_file, fingerprint):
+        """Copy of the entry for video_file, reset if the file has changed since it was recorded."""
+        with self._lock:
+            entry = self.videos.get(video_file)
+            if entry is None or entry.get("fingerprint") != fingerprint:
+                if entry is not None:
+                    logging.info(f"{video_file} changed since the last run; starting it over")
+                entry = {"fingerprint": fingerprint, "stages": []}
+                self.videos[video_file] = entry
+                self._save()
+            return json.loads(json.dumps(entry))
+
+    def update(self, video_file, stage=None, **fields):
+        """Record fields for video_file and mark stage completed, writing the manifest at once."""
+        with self._lock:
+            entry = self.videos[video_file]
+            entry.update(fields)
+            if stage is not None and stage not in entry["stages"]:
+                entry["stages"].append(stage)
+            self._save()
+
+    def completed(self, video_file, stage):
+        with self._lock:
+            return stage in self.videos.get(video_file, {}).get("stages", [])
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"videos": self.videos}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def directory_fingerprint(directory):
+    """Hash of a directory's file names, sizes and modification times.
+
+    Stands in for a content hash of image-sequence inputs, which would mean
+    reading every slice.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(directory)):
+        stat = os.stat(os.path.join(directory, name))
+        digest.update(f"{name}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def input_fingerprint(path):
+    """Cheap change check of a video, TIFF stack or image directory: file sizes and modification times.
+
+    A full content hash of a multi-GB input would stall the caller for
+    seconds, so it is left to the background calculation.
+    """
+    if os.path.isdir(path):
+        return directory_fingerprint(path)
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def first_unannotated(annotation_dir, frame_names):
+    """Position in frame_names of the first frame without an annotation JSON, or None if all have one."""
+    for position, frame_name in enumerate(frame_names):
+        if not os.path.exists(os.path.join(annotation_dir, f"{frame_name}.json")):
+            return position
+    return None
+
+
+def load_points(annotation_dir, frame_name):
+    """Saved contour of one frame, or None."""
+    try:
+        with open(os.path.join(annotation_dir, f"{frame_name}.json"), 'r') as f:
+            return [tuple(point) for point in json.load(f)["points"]]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show how far the last run over a video folder got.")
+    parser.add_argument("folder", help="Folder of videos")
+    args = parser.parse_args()
+
+    manifest = RunManifest(args.folder)
+    for video_file, entry in sorted(manifest.videos.items()):
+        stage = entry["stages"][-1] if entry["stages"] else "not started"
+        volume = f"  {entry['results'][1]} mm^3" if "results" in entry else ""
+        print(f"{video_file:32s} {stage:12s}{volume}")
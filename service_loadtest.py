@@ -0,0 +1,140 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Load test for volume_service.py.
+
+Usage:
+    python service_loadtest.py --clients 16 --requests 4000
+    python service_loadtest.py --url http://127.0.0.1:8765 --binary --output load.json
+
+Without --url an in-process server is started on a free localhost port.
+Each client thread keeps one keep-alive connection open and posts a
+synthetic elliptical study back to back; latency is measured per request.
+Reports p50/p99 latency and throughput.
+"""
+
+from urllib.parse import urlsplit
+import argparse
+import http.client
+import json
+import logging
+import sys
+import threading
+import time
+import numpy as np
+from annotation_container import AnnotationContainer
+from contour_store import ContourStore
+from volume_service import DEFAULT_MAX_BATCH, DEFAULT_WORKERS, VolumeServer, VolumeService
+
+
+def synthetic_study(num_slices, num_points, seed=0):
+    """Ellipses whose size varies along the stack, annotated every fourth frame."""
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, num_points, endpoint=False)
+    annotations = {}
+    for i in range(num_slices):
+        scale = 1 + 0.5 * np.sin(np.pi * i / max(num_slices - 1, 1))
+        x = 320 + 60 * scale * np.cos(angles) + rng.normal(0, 0.5, num_points)
+        y = 240 + 40 * scale * np.sin(angles) + rng.normal(0, 0.5, num_points)
+        annotations[4 * i] = np.round(np.stack([x, y], axis=1), 2)
+    return annotations
+
+
+def request_body(annotations, slice_thickness_mm, pixel_to_mm_ratio, binary, method):
+    """(path, content type, body) of one request."""
+    if binary:
+        container = AnnotationContainer(ContourStore.from_annotations(annotations), pixel_to_mm_ratio, slice_thickness_mm)
+        return f"/volume?method={method}", "application/octet-stream", bytes(container.to_bytes())
+    payload = {"slice_thickness_mm": slice_thickness_mm, "pixel_to_mm_ratio": pixel_to_mm_ratio, "method": method,
+               "annotations": {str(frame): {"points": points.tolist()} for frame, points in annotations.items()}}
+    return "/volume", "application/json", json.dumps(payload).encode()
+
+
+def client_loop(host, port, path, content_type, body, count, latencies, errors):
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    headers = {"Content-Type": content_type, "Content-Length": str(len(body))}
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            connection.request("POST", path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+                continue
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(type(e).__name__)
+            connection.close()
+            connection = http.client.HTTPConnection(host, port, timeout=60)
+            continue
+        latencies.append(time.perf_counter() - start)
+    connection.close()
+
+
+def run_load(host, port, path, content_type, body, clients, requests):
+    """Post requests spread over clients concurrent connections; returns the report dict."""
+    latencies = []  # list.append is atomic, so the threads share one list
+    errors = []
+    per_client = [requests // clients + (1 if i < requests % clients else 0) for i in range(clients)]
+    threads = [threading.Thread(target=client_loop, args=(host, port, path, content_type, body, count, latencies, errors))
+               for count in per_client]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies_ms = np.array(latencies) * 1000
+    report = {"requests": requests, "clients": clients, "succeeded": len(latencies), "errors": len(errors),
+              "error_kinds": sorted({str(error) for error in errors}), "body_bytes": len(body),
+              "elapsed_s": round(elapsed, 3), "throughput_rps": round(len(latencies) / elapsed, 1)}
+    if len(latencies_ms):
+        report.update(p50_ms=round(float(np.percentile(latencies_ms, 50)), 3),
+                      p99_ms=round(float(np.percentile(latencies_ms, 99)), 3),
+                      max_ms=round(float(latencies_ms.max()), 3))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test the local volume service.")
+    parser.add_argument("--url", default=None, help="Running service, e.g. http://127.0.0.1:8765 (default: start one in-process)")
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent keep-alive connections")
+    parser.add_argument("--requests", type=int, default=4000, help="Total requests")
+    parser.add_argument("--slices", type=int, default=20, help="Annotated slices per study")
+    parser.add_argument("--points", type=int, default=200, help="Points per contour")
+    parser.add_argument("--binary", action="store_true", help="Send .vea container bodies instead of JSON")
+    parser.add_argument("--method", default="trapezoid", choices=("trapezoid", "shape", "voxel"))
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Workers of the in-process service")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH, help="Batch size of the in-process service")
+    parser.add_argument("--output", default=None, help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(message)s")
+
+    server = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        server = VolumeServer(("127.0.0.1", 0), VolumeService(args.workers, args.max_batch))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host, port = "127.0.0.1", server.server_port
+
+    path, content_type, body = request_body(synthetic_study(args.slices, args.points), 0.5, 10.0, args.binary, args.method)
+    try:
+        client_loop(host, port, path, content_type, body, min(args.clients, 20), [], [])  # Warm-up
+        report = run_load(host, port, path, content_type, body, args.clients, args.requests)
+        if server is not None:
+            report["server_batches"] = server.service.batches
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    print(f"{report['succeeded']}/{report['requests']} requests over {report['clients']} connections in {report['elapsed_s']} s: "
+          f"{report['throughput_rps']} req/s, p50 {report.get('p50_ms')} ms, p99 {report.get('p99_ms')} ms"
+          f"{', ' + str(report['errors']) + ' errors ' + str(report['error_kinds']) if report['errors'] else ''}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,211 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Cached per-slice pixel areas and extents, for re-evaluating studies under new calibrations.
+
+Usage:
+    python slice_table_cache.py sweep studies.csv --slice-thickness 0.4 0.5 0.6 --pixel-to-mm 11.5 12.0 --output sweep.csv
+    python slice_table_cache.py clear
+
+Volume scales with slice_thickness / ratio^2, widths and depths with
+1 / ratio and length with slice_thickness, so once a study's raw per-slice
+table is cached any (thickness, ratio) combination is a few multiplications.
+Tables are keyed by the SHA-256 of the annotation files, so editing a
+study's contours invalidates its table. The manifest is the same CSV/JSON
+batch_volume.py reads; a sweep without --slice-thickness or --pixel-to-mm
+uses each study's own value.
+"""
+
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import sys
+import numpy as np
+from annotation_container import AnnotationContainer, is_container
+from batch_volume import load_manifest, study_inputs
+
+SWEEP_HEADER = ['Video Name', 'Slice Thickness (mm)', 'Pixel-to-mm Ratio', 'Tumour Volume (mm^3)', 'Max Width (mm)',
+                'Avg Width (mm)', 'Max Depth (mm)', 'Avg Depth (mm)', 'Length (mm)']
+
+
+def default_table_dir():
+    """Cache location, overridable with the VOLUME_ESTIMATOR_SLICE_CACHE_DIR environment variable."""
+    return os.environ.get(
+        "VOLUME_ESTIMATOR_SLICE_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "VolumeEstimator3D", "slice_tables"),
+    )
+
+
+def annotation_hash(annotated_frames):
+    """SHA-256 of a .vea container, or of a list of annotation JSONs (names and contents)."""
+    digest = hashlib.sha256()
+    paths = [annotated_frames] if is_container(annotated_frames) else sorted(annotated_frames)
+    for path in paths:
+        digest.update(os.path.basename(path).encode() + b"\0")
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class SliceTable:
+    """A study's per-slice frame index, area (px^2), width and depth (px)."""
+
+    __slots__ = ("frame_indices", "areas_px", "widths_px", "depths_px")
+
+    def __init__(self, frame_indices, areas_px, widths_px, depths_px):
+        self.frame_indices = np.asarray(frame_indices, dtype=np.int64)
+        self.areas_px = np.asarray(areas_px, dtype=np.float64)
+        self.widths_px = np.asarray(widths_px, dtype=np.float64)
+        self.depths_px = np.asarray(depths_px, dtype=np.float64)
+
+    @classmethod
+    def from_store(cls, store):
+        widths, depths = store.extents()
+        return cls(store.frame_indices, store.areas(), widths, depths)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["frame_indices"], data["areas_px"], data["widths_px"], data["depths_px"])
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, **{name: getattr(self, name) for name in self.__slots__})
+        os.replace(tmp_path, path)
+
+    def unit_summary(self):
+        """(volume, max_width, avg_width, max_depth, avg_depth, length) at thickness 1 mm and ratio 1 px/mm."""
+        volume = float(np.sum((self.areas_px[:-1] + self.areas_px[1:]) / 2 * np.diff(self.frame_indices)))
+        return (volume, float(self.widths_px.max()), float(self.widths_px.mean()), float(self.depths_px.max()),
+                float(self.depths_px.mean()), float(self.frame_indices[-1] - self.frame_indices[0]))
+
+    def metrics(self, slice_thickness_mm, pixel_to_mm_ratio):
+        """VolumeCalculator.run()'s rounded trapezoid metrics under this calibration."""
+        return tuple(round(float(value), 3) for value in scale_summaries(
+            np.array([self.unit_summary()]), slice_thickness_mm, pixel_to_mm_ratio)[0])
+
+
+def scale_summaries(unit_summaries, slice_thickness_mm, pixel_to_mm_ratio):
+    """Metrics of (n, 6) unit summaries under per-row (or scalar) thickness and ratio; returns (n, 6)."""
+    thickness = np.asarray(slice_thickness_mm, dtype=np.float64)
+    ratio = np.asarray(pixel_to_mm_ratio, dtype=np.float64)
+    scales = np.stack(np.broadcast_arrays(thickness / ratio ** 2, 1 / ratio, 1 / ratio, 1 / ratio, 1 / ratio, thickness),
+                      axis=-1)
+    return unit_summaries * scales.reshape(-1, 6)
+
+
+class SliceTableCache:
+    """On-disk (and in-memory) SliceTables keyed by annotation hash."""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or default_table_dir()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._tables = {}
+        self.hits = 0
+        self.misses = 0
+
+    def table(self, annotated_frames):
+        """SliceTable of a container path or list of JSON paths, computed only when its files changed."""
+        key = annotation_hash(annotated_frames)
+        table = self._tables.get(key)
+        if table is not None:
+            self.hits += 1
+            return table
+        path = os.path.join(self.cache_dir, f"{key}.npz")
+        try:
+            table = SliceTable.load(path)
+            self.hits += 1
+        except (OSError, ValueError, KeyError):
+            if is_container(annotated_frames):
+                store = AnnotationContainer.load(annotated_frames).store
+            else:
+                store = AnnotationContainer.from_json_files(annotated_frames).store
+            table = SliceTable.from_store(store)
+            table.save(path)
+            self.misses += 1
+        self._tables[key] = table
+        return table
+
+    def clear(self):
+        removed = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".npz"):
+                os.remove(os.path.join(self.cache_dir, name))
+                removed += 1
+        self._tables.clear()
+        return removed
+
+
+def sweep(studies, cache, thicknesses=None, ratios=None):
+    """Rows of SWEEP_HEADER for every study under every (thickness, ratio) pair.
+
+    None for thicknesses or ratios means each study's own value. Studies that
+    cannot be read are logged and skipped. All combinations are scaled in one
+    array operation over the studies' unit summaries.
+    """
+    names, summaries, own_thickness, own_ratio = [], [], [], []
+    for study in studies:
+        # A swept parameter need not be known for the study itself
+        defaults = {"slice_thickness_mm": study["defaults"]["slice_thickness_mm"] if thicknesses is None else thicknesses[0],
+                    "pixel_to_mm_ratio": study["defaults"]["pixel_to_mm_ratio"] if ratios is None else ratios[0]}
+        try:
+            annotated_frames, thickness, ratio = study_inputs(dict(study, defaults=defaults))
+            summaries.append(cache.table(annotated_frames).unit_summary())
+        except (OSError, ValueError, KeyError) as e:
+            logging.error(f"{study['name']}: {type(e).__name__}: {e}; skipped")
+            continue
+        names.append(study["name"])
+        own_thickness.append(thickness)
+        own_ratio.append(ratio)
+    if not names:
+        return []
+
+    summaries = np.array(summaries)
+    thickness_grid = np.array(thicknesses if thicknesses is not None else [np.nan], dtype=np.float64)
+    ratio_grid = np.array(ratios if ratios is not None else [np.nan], dtype=np.float64)
+    # (studies, thicknesses, ratios) of every combination
+    shape = (len(names), len(thickness_grid), len(ratio_grid))
+    thickness = np.broadcast_to(thickness_grid[None, :, None], shape)
+    ratio = np.broadcast_to(ratio_grid[None, None, :], shape)
+    if thicknesses is None:
+        thickness = np.broadcast_to(np.array(own_thickness)[:, None, None], shape)
+    if ratios is None:
+        ratio = np.broadcast_to(np.array(own_ratio)[:, None, None], shape)
+    metrics = scale_summaries(np.repeat(summaries, shape[1] * shape[2], axis=0), thickness.ravel(), ratio.ravel())
+    metrics = np.round(metrics, 3)
+
+    study_index = np.repeat(np.arange(len(names)), shape[1] * shape[2])
+    return [[names[i], float(t), float(r), *values]
+            for i, t, r, values in zip(study_index, thickness.ravel(), ratio.ravel(), metrics.tolist())]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-evaluate annotated studies under new calibrations from cached slice tables.")
+    parser.add_argument("--cache-dir", default=None, help="Slice table cache (default: VOLUME_ESTIMATOR_SLICE_CACHE_DIR or ~/.cache)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sweep_parser = subparsers.add_parser("sweep", help="Metrics of every study for every thickness/ratio combination")
+    sweep_parser.add_argument("manifest", help="CSV or JSON manifest listing the studies (as for batch_volume.py)")
+    sweep_parser.add_argument("--slice-thickness", type=float, nargs="+", default=None, help="Slice thicknesses in mm (default: each study's)")
+    sweep_parser.add_argument("--pixel-to-mm", type=float, nargs="+", default=None, help="Pixel-to-mm ratios (default: each study's)")
+    sweep_parser.add_argument("--output", default=None, help="Results CSV (default: stdout)")
+    subparsers.add_parser("clear", help="Delete every cached table")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    cache = SliceTableCache(args.cache_dir)
+
+    if args.command == "clear":
+        logging.info(f"Removed {cache.clear()} tables from {cache.cache_dir}")
+    elif args.command == "sweep":
+        studies = load_manifest(args.manifest)
+        rows = sweep(studies, cache, args.slice_thickness, args.pixel_to_mm)
+        file = open(args.output, 'w', newline='') if args.output else sys.stdout
+        writer = csv.writer(file)
+        writer.writerow(SWEEP_HEADER)
+        writer.writerows(rows)
+        if args.output:
+            file.close()
+        logging.info(f"{len(rows)} rows for {len(studies)} studies ({cache.hits} cached tables, {cache.misses} computed)")
@@ -3,29 +3,61 @@
 
 import tkinter as tk
 from tkinter import messagebox
-import cv2
-from PIL import Image, ImageTk
+from PIL import ImageTk
 import json
 import os
 import logging
+from display_cache import DisplayFrameCache
+from app_window import AppWindow
+from contour_simplifier import simplify_contour, DEFAULT_MAX_AREA_DEVIATION
+
+# Motion events arriving within this many ms are drawn as one canvas item
+STROKE_FLUSH_MS = 16
+# Saved contours are simplified to within this many pixels of the stroke, and within
+# DEFAULT_MAX_AREA_DEVIATION of its area; 0 keeps every (deduplicated) point
+SIMPLIFY_TOLERANCE_PX = 1.0
+# How often a shown frame checks whether its refined contour draft has finished
+DRAFT_POLL_MS = 50
+
 
 class TumourAnnotator:
-    def __init__(self, frame_path, annotation_dir,current_frame_index,frame_paths):
-        self.current_frame_index = current_frame_index
-        self.frame_path = frame_path
-        self.frame_paths = frame_paths
+    """Contour annotation view. The constructor annotates the first frame; annotate() reuses the view for later ones.
+
+    While a frame is shown, the next sampled frame is decoded and scaled in
+    the background, so moving on only swaps the canvas image. A frame opens
+    at once with the best draft available; a better draft still being
+    propagated replaces it when ready, unless the user has started drawing.
+    """
+
+    def __init__(self, frame_source, frame_index, annotation_dir, current_frame_index, sampled_frames, initial_points=None, app=None,
+                 pending_draft=None):
+        self.frame_source = frame_source
+        self.sampled_frames = sampled_frames
         self.annotation_dir = annotation_dir
         self.points = []
+        self.saved_points = None  # Contour as last written by save_annotation
         self.measuring_5mm = False
         self.pixel_to_mm_ratio = None
-
-        self.root = tk.Tk()
-        self.root.title("Tumour Annotator")
-        self.image_panel = tk.Label(self.root)
+        self._pending_stroke = []  # Display coordinates not yet drawn on the canvas
+        self._stroke_flush = None
+        self._closed = False
+        self._pending_draft = None  # Future of a draft still being propagated for this frame
+        self._draft_poll = None
+        self._edited = False  # The user has drawn or undone on this frame
+        # Holds the current and the next sampled frame, already scaled for display
+        self.display_cache = DisplayFrameCache(frame_source, capacity=4, prefetch_radius=0)
+
+        self.owns_app = app is None
+        self.app = app or AppWindow()
+        self.root = self.app.root
+        self.view = tk.Frame(self.root)
+        self.done = tk.BooleanVar(self.root, value=False)
+        # The frame is drawn once as a pre-scaled canvas image; strokes are vector items on top
+        self.image_panel = tk.Canvas(self.view, highlightthickness=0)
         self.image_panel.pack()
 
         # Controls
-        self.controls_frame = tk.Frame(self.root)
+        self.controls_frame = tk.Frame(self.view)
         self.controls_frame.pack(pady=10)
 
         self.undo_button = tk.Button(self.controls_frame, text="Undo", command=self.undo_last_action, width=15)
@@ -34,7 +66,7 @@ class TumourAnnotator:
         self.next_button = tk.Button(self.controls_frame, text="Next Frame", command=self.next_frame, width=15)
         self.next_button.pack(side="left", padx=5)
 
-        self.status_label = tk.Label(self.root, text="")
+        self.status_label = tk.Label(self.view, text="")
         self.status_label.pack(pady=5)
 
         # Image panel bindings for drawing
@@ -42,64 +74,141 @@ class TumourAnnotator:
         self.image_panel.bind("<B1-Motion>", self.draw)
         self.image_panel.bind("<ButtonRelease-1>", self.stop_drawing)
 
-        self.load_frame(self.frame_path)
+        self.app.show(self.view, "Tumour Annotator")
+        self.annotate(frame_index, current_frame_index, initial_points, pending_draft)
 
-        self.root.mainloop()
+    def annotate(self, frame_index, current_frame_index, initial_points=None, pending_draft=None):
+        """Show a sampled frame in the view and return once the user has moved on from it.
 
-    def load_frame(self, frame_path):
-        """Load and display the current frame."""
-        self.points = []  # Reset points for new frame
-        self.img = cv2.imread(frame_path)
-        
-        if self.img is None:
-            messagebox.showerror("Error", f"Cannot load image: {frame_path}")
-            self.root.quit()
+        pending_draft is a Future of a better draft than initial_points; it is
+        shown when it finishes, without blocking the view in the meantime.
+        """
+        self.frame_index = frame_index
+        self.current_frame_index = current_frame_index
+        self.saved_points = None
+        self._edited = False
+        self.status_label.config(text="")
+        if not self.load_frame():
+            return
+        if initial_points:
+            self.show_draft(initial_points)
+        if pending_draft is not None:
+            self._pending_draft = pending_draft
+            self._draft_poll = self.root.after(DRAFT_POLL_MS, self.poll_draft)
+        if current_frame_index + 1 < len(self.sampled_frames):
+            self.display_cache.prefetch_frames([self.sampled_frames[current_frame_index + 1]])
+
+        try:
+            self.app.wait(self.done)
+        except SystemExit:
+            self.display_cache.close()
+            raise
+        finally:
+            self.stop_draft_poll()
+        if self.current_frame_index == len(self.sampled_frames) - 1:
+            self.close()  # Calibrated on the last frame; the view is finished
+
+    def close(self):
+        """Remove the view (and the window, if the annotator created it); safe to call twice."""
+        if self._closed:
             return
+        self._closed = True
+        self.stop_draft_poll()
+        self.cancel_pending_stroke()
+        self.display_cache.close()
+        self.view.destroy()
+        if self.owns_app:
+            self.app.destroy()
+
+    def load_frame(self):
+        """Load and display the current frame; returns False if it cannot be read."""
+        self.points = []  # Reset points for new frame
+        try:
+            # Only read, never drawn on, so the source's cached frame can be shared
+            self.img = self.frame_source.get_frame(self.frame_index)
+        except (IOError, IndexError):
+            messagebox.showerror("Error", f"Cannot load frame {self.frame_index + 1} of {self.frame_source.name}")
+            return False
 
         self.update_display_image()
+        return True
 
     def update_display_image(self):
-        """Update the displayed image after any change."""
-        img_rgb = cv2.cvtColor(self.img, cv2.COLOR_BGR2RGB)
-        img_pil = Image.fromarray(img_rgb)
-
-        # Limit displayed image size to avoid overlapping UI
-        max_width = 1000
-        max_height = 500  # or less, depending on your layout
-
-        # Preserve aspect ratio
-        original_width, original_height = img_pil.size
-        aspect_ratio = original_height / original_width
-
-        target_width = max_width
-        target_height = int(target_width * aspect_ratio)
-
-        if target_height > max_height:
-            target_height = max_height
-            target_width = int(target_height / aspect_ratio)
-
-        img_pil = img_pil.resize((target_width, target_height), Image.LANCZOS)
-
-        
-        # Persist the PhotoImage object to avoid garbage collection
-        self.tk_image = ImageTk.PhotoImage(img_pil)
-        self.image_panel.config(image=self.tk_image)
-        self.image_panel.image = self.tk_image  # Keep a reference to avoid being garbage collected
+        """Show the display-size frame (usually prefetched) as the canvas background."""
+        self.tk_image = ImageTk.PhotoImage(self.display_cache.get(self.frame_index))
+        self.clear_overlay()
+        self.image_panel.delete("base")
+        self.image_panel.config(width=self.tk_image.width(), height=self.tk_image.height())
+        self.image_panel.create_image(0, 0, anchor="nw", image=self.tk_image, tags="base")
+        self.image_panel.tag_lower("base")
+
+        # Full-resolution pixels per display pixel
+        self.scale_x = self.img.shape[1] / self.tk_image.width()
+        self.scale_y = self.img.shape[0] / self.tk_image.height()
+
+    def show_draft(self, points):
+        """Pre-fill the contour with a draft (e.g. propagated from the previous frame).
+
+        Clicking Next accepts it as is; drawing a new stroke or Undo replaces it.
+        """
+        self.points = [tuple(point) for point in points]
+        display_points = [self.to_display_coordinates(x, y) for x, y in self.points]
+        display_points.append(display_points[0])  # Show the draft closed
+        self.image_panel.create_line(*display_points, fill="#00ff00", width=2, dash=(4, 2), tags="overlay")
+        self.status_label.config(text="Draft contour from the previous frame: click 'Next Frame' to accept it or draw to replace it.")
+
+    def poll_draft(self):
+        """Show the pending draft once it has finished, if the user has not drawn in the meantime."""
+        self._draft_poll = None
+        future = self._pending_draft
+        if future is None:
+            return
+        if not future.done():
+            self._draft_poll = self.root.after(DRAFT_POLL_MS, self.poll_draft)
+            return
+        self._pending_draft = None
+        if self._edited or self.measuring_5mm:
+            return
+        try:
+            draft = future.result(timeout=0)
+        except Exception:
+            return  # Cancelled or failed; the earlier draft (if any) stays
+        if draft:
+            self.clear_overlay()
+            self.show_draft(draft)
+
+    def stop_draft_poll(self):
+        self._pending_draft = None
+        if self._draft_poll is not None:
+            self.root.after_cancel(self._draft_poll)
+            self._draft_poll = None
+
+    def clear_overlay(self):
+        """Remove every stroke and marker, keeping the cached base image."""
+        self.cancel_pending_stroke()
+        self.image_panel.delete("overlay")
 
     def save_annotation(self):
         """Save the annotation for the current frame."""
-        annotation_name = os.path.basename(self.frame_path).replace('.png', '.json')
+        self.flush_stroke()
+        if len(self.points) >= 3:
+            raw_count = len(self.points)
+            self.points = [tuple(point) for point in
+                           simplify_contour(self.points, SIMPLIFY_TOLERANCE_PX, DEFAULT_MAX_AREA_DEVIATION).tolist()]
+            logging.info(f"Simplified contour from {raw_count} to {len(self.points)} points")
+        annotation_name = f"{self.frame_source.frame_name(self.frame_index)}.json"
         annotation_path = os.path.join(self.annotation_dir, annotation_name)
         os.makedirs(self.annotation_dir, exist_ok=True)
         with open(annotation_path, 'w') as f:
             json.dump({"points": self.points}, f)
+        self.saved_points = list(self.points)
         logging.info(f"Annotation saved for {annotation_name}")
 
     def next_frame(self):
         """Handle frame progression and ensure last frame calibration."""
         self.save_annotation()
-        if self.current_frame_index < len(self.frame_paths) - 1:
-            self.root.destroy()  # Proceed to next frame
+        if self.current_frame_index < len(self.sampled_frames) - 1:
+            self.done.set(True)  # Proceed to next frame
         else:
             self.next_button.config(state=tk.DISABLED)  # Temporarily disable button
             self.measure_5mm_line()  # Transition to calibration mode
@@ -107,35 +216,42 @@ class TumourAnnotator:
 
     def start_drawing(self, event):
         """Start drawing with corrected coordinates."""
+        self._edited = True
+        self.clear_overlay()
+        self.status_label.config(text="")
         corrected_x, corrected_y = self.correct_coordinates(event.x, event.y)
         self.points = [(corrected_x, corrected_y)]
+        self._pending_stroke = [self.to_display_coordinates(corrected_x, corrected_y)]
 
     def draw(self, event):
-        """Draw a line with corrected coordinates."""
+        """Record a point and queue its line segment for the next canvas flush."""
         corrected_x, corrected_y = self.correct_coordinates(event.x, event.y)
-        if len(self.points) > 0:
-            last_point = self.points[-1]
+        # Motion events often repeat the last image pixel; those add nothing to the contour
+        if len(self.points) > 0 and self.points[-1] != (corrected_x, corrected_y):
             self.points.append((corrected_x, corrected_y))
-            cv2.line(self.img, last_point, (corrected_x, corrected_y), (0, 255, 0), 2)
-            self.update_display_image()  # Refresh to show the line
+            self._pending_stroke.append(self.to_display_coordinates(corrected_x, corrected_y))
+            if self._stroke_flush is None:
+                self._stroke_flush = self.root.after(STROKE_FLUSH_MS, self.flush_stroke)
+
+    def flush_stroke(self):
+        """Draw all queued segments as a single canvas line item."""
+        self._stroke_flush = None
+        if len(self._pending_stroke) > 1:
+            self.image_panel.create_line(*self._pending_stroke, fill="#00ff00", width=2, tags="overlay")
+            # The next batch starts where this one ended
+            self._pending_stroke = self._pending_stroke[-1:]
+
+    def cancel_pending_stroke(self):
+        if self._stroke_flush is not None:
+            self.root.after_cancel(self._stroke_flush)
+            self._stroke_flush = None
+        self._pending_stroke = []
 
     def correct_coordinates(self, x, y):
-        """Correct the mouse coordinates for image scaling and centering."""
-        widget_width = self.image_panel.winfo_width()
-        widget_height = self.image_panel.winfo_height()
-
-        img_width, img_height = self.tk_image.width(), self.tk_image.height()
-
-        # Calculate scaling factor and offsets
-        scale_x = self.img.shape[1] / img_width
-        scale_y = self.img.shape[0] / img_height
-
-        offset_x = (widget_width - img_width) // 2
-        offset_y = (widget_height - img_height) // 2
-
+        """Correct the mouse coordinates for image scaling."""
         # Correct the coordinates
-        corrected_x = int((x - offset_x) * scale_x)
-        corrected_y = int((y - offset_y) * scale_y)
+        corrected_x = int(self.image_panel.canvasx(x) * self.scale_x)
+        corrected_y = int(self.image_panel.canvasy(y) * self.scale_y)
 
         # Ensure coordinates are within bounds
         corrected_x = max(0, min(corrected_x, self.img.shape[1] - 1))
@@ -143,28 +259,33 @@ class TumourAnnotator:
 
         return corrected_x, corrected_y
 
+    def to_display_coordinates(self, x, y):
+        """Map full-resolution image coordinates back to canvas coordinates."""
+        return x / self.scale_x, y / self.scale_y
+
     def stop_drawing(self, event):
-        pass
+        self.flush_stroke()
 
     def undo_last_action(self):
         """Undo the last drawn action."""
+        self._edited = True
         self.points = []
-        self.load_frame(self.frame_path)
+        self.clear_overlay()
         if self.measuring_5mm:
             self.measure_5mm_line()
 
     def get_pixel_to_mm_ratio(self):
         """Return the pixel-to-mm ratio after calibration."""
         return getattr(self, 'pixel_to_mm_ratio', None)
-        
+
     def measure_5mm_line(self):
         """Enable the user to draw a 5mm calibration line with exactly two points."""
         self.measuring_5mm = True
-        self.load_frame(self.frame_path)  # Reload the frame for calibration
+        self.clear_overlay()  # Clear the contour for calibration
         self.status_label.config(text="Click two points to draw a 5mm calibration line.")
-        
+
         # Clear points and unbind any drawing events
-        self.points = []  
+        self.points = []
         self.image_panel.unbind("<Button-1>")
         self.image_panel.unbind("<B1-Motion>")
         self.image_panel.unbind("<ButtonRelease-1>")
@@ -188,16 +309,16 @@ class TumourAnnotator:
 
     def display_point_feedback(self, x, y):
         """Draw a small circle or marker to indicate the clicked point."""
-        cv2.circle(self.img, (x, y), 2, (0, 0, 255), -1)  # red marker
-        self.update_display_image()
+        display_x, display_y = self.to_display_coordinates(x, y)
+        self.image_panel.create_oval(display_x - 2, display_y - 2, display_x + 2, display_y + 2,
+                                     fill="#ff0000", outline="#ff0000", tags="overlay")  # red marker
 
     def draw_calibration_line(self):
         """Draw a line between the two calibration points."""
         if len(self.points) == 2:
-            x1, y1 = self.points[0]
-            x2, y2 = self.points[1]
-            cv2.line(self.img, (x1, y1), (x2, y2), (0,0, 255), 2)  # Red line for calibration
-            self.update_display_image()
+            start = self.to_display_coordinates(*self.points[0])
+            end = self.to_display_coordinates(*self.points[1])
+            self.image_panel.create_line(*start, *end, fill="#ff0000", width=2, tags="overlay")  # Red line for calibration
 
     def calculate_pixel_to_mm_ratio(self):
         """Calculate and display the pixel-to-mm ratio based on the calibration line."""
@@ -209,13 +330,4 @@ class TumourAnnotator:
 
     def exit_annotation(self):
         """Exit the annotation process after calibration is complete."""
-        self.root.destroy()
-        #self.root.quit()
-        
-
-
-
-
-
-
-
+        self.done.set(True)
@@ -0,0 +1,208 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Monte Carlo confidence intervals for the trapezoidal tumour volume.
+
+Usage:
+    python uncertainty.py study_annotations/annotations.vea --draws 10000
+    python uncertainty.py study_annotations/annotations.vea --check 2000
+
+Each draw perturbs every contour vertex, the traced boundary as a whole, the
+two endpoints of the 5 mm calibration line (and the 3-decimal rounding of the
+stored ratio) and the slice thickness, then recomputes the volume. Vertex
+jitter and the boundary offset are drawn per slice from an analytic model of
+the area change; --check re-validates that model against explicitly
+perturbing every vertex, with calibration and thickness held fixed.
+"""
+
+import argparse
+import sys
+import time
+import numpy as np
+from annotation_container import AnnotationContainer
+
+DEFAULT_DRAWS = 10000
+DEFAULT_CONFIDENCE = 0.95
+# Independent per-vertex tracing jitter, in pixels
+DEFAULT_VERTEX_SIGMA_PX = 1.0
+# Whole-contour inward/outward offset per slice (tracing inside or outside the edge), in pixels
+DEFAULT_BOUNDARY_SIGMA_PX = 0.5
+# Click error of each calibration endpoint, per axis, in pixels
+DEFAULT_CALIBRATION_SIGMA_PX = 1.0
+# Relative standard deviation of the slice thickness
+DEFAULT_THICKNESS_REL_SIGMA = 0.02
+CALIBRATION_LENGTH_MM = 5.0
+# Draws x slices evaluated per batch, bounding memory on long stacks
+MAX_BATCH_ELEMENTS = 4_000_000
+# Largest relative difference between the analytic and brute-force volume SDs --check accepts
+CHECK_TOLERANCE = 0.05
+
+UNCERTAINTY_HEADER = ['Volume SD (mm^3)', 'Volume CI Low (mm^3)', 'Volume CI High (mm^3)']
+
+
+def outward_normals(store):
+    """Unit normal of every vertex, perpendicular to v_next - v_prev and pointing out of its contour."""
+    vertices = store.vertices.astype(np.float64)
+    following = store._next_vertex()
+    chord = vertices[following] - vertices[store._previous_vertex()]
+    normals = np.stack([chord[:, 1], -chord[:, 0]], axis=1) / np.hypot(chord[:, 0], chord[:, 1])[:, None]
+    # Flip the normals of contours wound the other way, so they all point outwards
+    cross = vertices[:, 0] * vertices[following, 1] - vertices[following, 0] * vertices[:, 1]
+    winding = np.sign(np.add.reduceat(cross, store.offsets[:-1]))
+    return normals * np.repeat(winding, np.diff(store.offsets))[:, None]
+
+
+def area_noise_model(store, vertex_sigma_px):
+    """Per-slice (area, offset_rate, offset_curvature, area_sd) in pixels.
+
+    With every vertex moved by N(0, sigma^2) per axis, the shoelace area
+    changes by a linear term, exactly normal with variance
+    sigma^2 / 4 * sum |v_next - v_prev|^2, plus a zero-mean quadratic term
+    with variance n * sigma^4 / 2 that is a sum of n independent products
+    and is drawn as a normal of that variance. The two are uncorrelated, so
+    a draw of all n vertices reduces to one normal per slice (area_sd).
+
+    Moving every vertex by d along its outward normal changes the area by
+    exactly offset_rate * d + offset_curvature * d^2, with
+    offset_rate = sum |v_next - v_prev| / 2 and
+    offset_curvature = sum cross(n_i, n_next) / 2 (about pi for a smooth
+    closed contour). brute_force_volume_draws checks both against explicit
+    perturbation.
+    """
+    vertices = store.vertices.astype(np.float64)
+    starts = store.offsets[:-1]
+    following = store._next_vertex()
+    chord = vertices[following] - vertices[store._previous_vertex()]
+    linear_var = vertex_sigma_px ** 2 / 4 * np.add.reduceat((chord ** 2).sum(axis=1), starts)
+    quadratic_var = np.diff(store.offsets) * vertex_sigma_px ** 4 / 2
+    offset_rate = np.add.reduceat(np.hypot(chord[:, 0], chord[:, 1]), starts) / 2
+    normals = outward_normals(store)
+    turning = normals[:, 0] * normals[following, 1] - normals[following, 0] * normals[:, 1]
+    offset_curvature = np.add.reduceat(turning, starts) / 2
+    return store.areas(), offset_rate, offset_curvature, np.sqrt(linear_var + quadratic_var)
+
+
+def trapezoid_weights(frame_indices):
+    """Weights w with trapezoid_volume(areas) == areas @ w * slice_thickness."""
+    gaps = np.diff(frame_indices).astype(np.float64)
+    weights = np.zeros(len(frame_indices))
+    weights[:-1] += gaps / 2
+    weights[1:] += gaps / 2
+    return weights
+
+
+def volume_draws(store, slice_thickness_mm, pixel_to_mm_ratio, draws=DEFAULT_DRAWS,
+                 vertex_sigma_px=DEFAULT_VERTEX_SIGMA_PX, boundary_sigma_px=DEFAULT_BOUNDARY_SIGMA_PX,
+                 calibration_sigma_px=DEFAULT_CALIBRATION_SIGMA_PX,
+                 thickness_rel_sigma=DEFAULT_THICKNESS_REL_SIGMA, seed=None):
+    """Volume (mm^3) of every Monte Carlo draw, as a (draws,) array.
+
+    Slice areas are drawn as a (draws, slices) float32 array and integrated
+    with one matrix-vector product; calibration and thickness are drawn per draw.
+    """
+    rng = np.random.default_rng(seed)
+    areas, offset_rate, offset_curvature, area_sd = (values.astype(np.float32)
+                                                     for values in area_noise_model(store, vertex_sigma_px))
+    weights = trapezoid_weights(store.frame_indices).astype(np.float32)
+    num_slices = len(areas)
+
+    volume_px = np.empty(draws)
+    batch = max(1, MAX_BATCH_ELEMENTS // max(num_slices, 1))
+    for start in range(0, draws, batch):
+        size = min(batch, draws - start)
+        offset = rng.standard_normal((size, num_slices), dtype=np.float32) * np.float32(boundary_sigma_px)
+        drawn = rng.standard_normal((size, num_slices), dtype=np.float32) * area_sd
+        drawn += areas
+        drawn += (offset_rate + offset_curvature * offset) * offset
+        volume_px[start:start + size] = np.maximum(drawn, 0.0, out=drawn) @ weights
+
+    return _calibrate_draws(rng, volume_px, slice_thickness_mm, pixel_to_mm_ratio, calibration_sigma_px,
+                            thickness_rel_sigma)
+
+
+def _calibrate_draws(rng, volume_px, slice_thickness_mm, pixel_to_mm_ratio, calibration_sigma_px, thickness_rel_sigma):
+    """Volumes in mm^3 of per-draw pixel volumes, each under its own drawn calibration and thickness."""
+    draws = len(volume_px)
+    # The stored ratio was rounded to 3 decimals, so the measured line lies within half a unit of it
+    line_px = (pixel_to_mm_ratio + rng.uniform(-0.0005, 0.0005, draws)) * CALIBRATION_LENGTH_MM
+    # Moving both endpoints by N(0, s^2) moves their difference by N(0, 2 s^2); the line's direction does not matter
+    error = rng.standard_normal((draws, 2)) * (np.sqrt(2) * calibration_sigma_px)
+    ratio = np.hypot(line_px + error[:, 0], error[:, 1]) / CALIBRATION_LENGTH_MM
+    thickness = slice_thickness_mm * (1 + thickness_rel_sigma * rng.standard_normal(draws))
+    return volume_px * thickness / ratio ** 2
+
+
+def brute_force_volume_draws(store, slice_thickness_mm, pixel_to_mm_ratio, draws=2000,
+                             vertex_sigma_px=DEFAULT_VERTEX_SIGMA_PX, boundary_sigma_px=DEFAULT_BOUNDARY_SIGMA_PX,
+                             calibration_sigma_px=DEFAULT_CALIBRATION_SIGMA_PX,
+                             thickness_rel_sigma=DEFAULT_THICKNESS_REL_SIGMA, seed=None):
+    """Reference for volume_draws: every vertex jittered and offset along its normal, areas by the shoelace formula.
+
+    Much slower; used by --check to re-validate area_noise_model.
+    """
+    rng = np.random.default_rng(seed)
+    vertices = store.vertices.astype(np.float64)
+    starts = store.offsets[:-1]
+    lengths = np.diff(store.offsets)
+    following = store._next_vertex()
+    normals = outward_normals(store)
+    weights = trapezoid_weights(store.frame_indices)
+
+    volume_px = np.empty(draws)
+    batch = max(1, MAX_BATCH_ELEMENTS // max(2 * len(vertices), 1))
+    for start in range(0, draws, batch):
+        size = min(batch, draws - start)
+        offset = np.repeat(rng.standard_normal((size, len(lengths))) * boundary_sigma_px, lengths, axis=1)
+        moved = vertices + rng.standard_normal((size, len(vertices), 2)) * vertex_sigma_px + offset[:, :, None] * normals
+        cross = moved[:, :, 0] * moved[:, following, 1] - moved[:, following, 0] * moved[:, :, 1]
+        volume_px[start:start + size] = np.abs(np.add.reduceat(cross, starts, axis=1)) / 2 @ weights
+    return _calibrate_draws(rng, volume_px, slice_thickness_mm, pixel_to_mm_ratio, calibration_sigma_px,
+                            thickness_rel_sigma)
+
+
+def volume_interval(store, slice_thickness_mm, pixel_to_mm_ratio, confidence=DEFAULT_CONFIDENCE, **kwargs):
+    """(sd, low, high) of the volume in mm^3: the standard deviation and a central confidence interval."""
+    volumes = volume_draws(store, slice_thickness_mm, pixel_to_mm_ratio, **kwargs)
+    tail = (1 - confidence) / 2
+    low, high = np.quantile(volumes, [tail, 1 - tail])
+    return float(volumes.std()), float(low), float(high)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monte Carlo confidence interval of a study's volume.")
+    parser.add_argument("container", help="Path of an annotations.vea container")
+    parser.add_argument("--slice-thickness", type=float, default=None, help="Slice thickness in mm (default: the container's)")
+    parser.add_argument("--pixel-to-mm", type=float, default=None, help="Pixel-to-mm ratio (default: the container's)")
+    parser.add_argument("--draws", type=int, default=DEFAULT_DRAWS)
+    parser.add_argument("--confidence", type=float, default=DEFAULT_CONFIDENCE)
+    parser.add_argument("--vertex-sigma", type=float, default=DEFAULT_VERTEX_SIGMA_PX, help="Per-vertex jitter in px")
+    parser.add_argument("--boundary-sigma", type=float, default=DEFAULT_BOUNDARY_SIGMA_PX, help="Per-slice boundary offset in px")
+    parser.add_argument("--calibration-sigma", type=float, default=DEFAULT_CALIBRATION_SIGMA_PX, help="Calibration click error in px")
+    parser.add_argument("--thickness-sigma", type=float, default=DEFAULT_THICKNESS_REL_SIGMA, help="Relative slice thickness error")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--check", type=int, default=None, metavar="DRAWS",
+                        help="Compare the volume SD with this many brute-force draws instead")
+    args = parser.parse_args()
+
+    container = AnnotationContainer.load(args.container)
+    thickness = args.slice_thickness if args.slice_thickness is not None else container.slice_thickness_mm
+    ratio = args.pixel_to_mm if args.pixel_to_mm is not None else container.pixel_to_mm_ratio
+    noise = dict(vertex_sigma_px=args.vertex_sigma, boundary_sigma_px=args.boundary_sigma,
+                 calibration_sigma_px=args.calibration_sigma, thickness_rel_sigma=args.thickness_sigma)
+    if args.check is not None:
+        # Calibration and thickness are drawn the same way by both, so leave them out to compare the area model alone
+        noise.update(calibration_sigma_px=0.0, thickness_rel_sigma=0.0)
+        analytic_sd = volume_draws(container.store, thickness, ratio, draws=args.draws, seed=args.seed, **noise).std()
+        brute_sd = brute_force_volume_draws(container.store, thickness, ratio, draws=args.check, seed=args.seed, **noise).std()
+        difference = (analytic_sd - brute_sd) / brute_sd
+        passed = abs(difference) <= CHECK_TOLERANCE
+        print(f"Volume SD from contour noise: analytic {analytic_sd:.3f} mm^3 ({args.draws} draws), brute force "
+              f"{brute_sd:.3f} mm^3 ({args.check} draws), difference {difference:+.1%}  {'ok' if passed else 'FAIL'}")
+        sys.exit(0 if passed else 1)
+
+    start = time.perf_counter()
+    sd, low, high = volume_interval(container.store, thickness, ratio, args.confidence, draws=args.draws,
+                                    seed=args.seed, **noise)
+    elapsed = time.perf_counter() - start
+    print(f"Volume SD {sd:.3f} mm^3, {args.confidence:.0%} interval [{low:.3f}, {high:.3f}] mm^3 "
+          f"({args.draws} draws in {elapsed * 1000:.1f} ms)")
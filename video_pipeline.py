@@ -0,0 +1,128 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import logging
+import os
+import threading
+from frame_cache import DecodeCancelled
+from frame_source import VIDEO_EXTENSIONS, open_frame_source
+from instrumentation import tracer
+
+# Videos decoded ahead of the one being annotated; each holds a full frame stack on disk
+DEFAULT_PREFETCH_DEPTH = 2
+# Appended to every results row, as in batch_volume.py: 'ok' or 'failed' and the error
+STATUS_HEADER = ['Status', 'Error']
+
+
+class VideoPipeline:
+    """Overlaps the slow, headless stages of a folder run with annotation.
+
+    While the operator annotates video N, a background worker fills the frame
+    cache for this and the next prefetch_depth videos, so opening them is
+    usually a cache hit; a video whose fill is still running opens lazily.
+    Image directories and TIFF stacks are read in place and need no preparation.
+    Finished videos are handed to submit_calculation() and computed on
+    another worker; their result rows are appended to the results CSV in
+    submission order, whatever order they finish in. A calculation that
+    raises still gets a row: its name, empty results of row_length columns
+    and 'failed' with the error; the names and errors are kept in failed.
+    """
+
+    def __init__(self, frame_cache, video_paths, results_csv, prefetch_depth=DEFAULT_PREFETCH_DEPTH, calculation_workers=1,
+                 row_length=None):
+        self.frame_cache = frame_cache
+        self.video_paths = list(video_paths)
+        self.results_csv = results_csv
+        self.prefetch_depth = max(0, prefetch_depth)
+        self._prepare_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="VideoPrepare")
+        self._calculation_pool = ThreadPoolExecutor(max_workers=calculation_workers, thread_name_prefix="VolumeCalculation")
+        self._prepared = {}  # video index -> future filling its cache entry
+        self._closed = threading.Event()
+
+        # Rows wait here until every earlier submission has finished
+        self._rows_lock = threading.Lock()
+        self._finished_rows = {}
+        self._next_submission = 0
+        self._next_row = 0
+        self.row_length = row_length
+        self.failed = []  # (name, error) of every calculation that raised
+
+    def _prepare(self, index):
+        if self._closed.is_set():
+            return
+        video_path = self.video_paths[index]
+        if not video_path.lower().endswith(VIDEO_EXTENSIONS) or not self.frame_cache.should_cache(video_path):
+            return
+        with tracer.span("prepare", video=os.path.basename(video_path)):
+            self.frame_cache.get_frames(video_path, cancel_event=self._closed)
+        logging.info(f"Prepared frames of {video_path} in the background")
+
+    def _schedule_prepare(self, index):
+        if index < len(self.video_paths) and index not in self._prepared and not self._closed.is_set():
+            self._prepared[index] = self._prepare_pool.submit(self._prepare, index)
+
+    def open_source(self, index):
+        """FrameSource for video index, opened at once without waiting for its background preparation.
+
+        The cached stack is used if the preparation has already finished (or
+        an earlier run cached it); otherwise the video is read lazily. Also
+        queues preparation of the following videos, never more than
+        prefetch_depth ahead of this one.
+        """
+        self._schedule_prepare(index)
+        for ahead in range(index + 1, index + 1 + self.prefetch_depth):
+            self._schedule_prepare(ahead)
+        future = self._prepared[index]
+        error = future.exception() if future.done() and not future.cancelled() else None
+        if error is not None and not isinstance(error, DecodeCancelled):
+            logging.warning(f"Background preparation of {self.video_paths[index]} failed", exc_info=error)
+        return open_frame_source(self.video_paths[index], self.frame_cache)
+
+    def submit_calculation(self, calculate, *args, row_name=None, **kwargs):
+        """Run calculate(*args, **kwargs) in the background; it returns the CSV row, or None for no row.
+
+        row_name names the row written if calculate raises.
+        """
+        with self._rows_lock:
+            position = self._next_submission
+            self._next_submission += 1
+        future = self._calculation_pool.submit(calculate, *args, **kwargs)
+        future.add_done_callback(lambda done: self._finish(position, done, row_name))
+        return future
+
+    def _finish(self, position, future, row_name):
+        try:
+            row = future.result()
+            if row is not None:
+                row = list(row) + ['ok', '']
+        except Exception as e:
+            logging.error(f"Background volume calculation of {row_name} failed", exc_info=True)
+            error = f"{type(e).__name__}: {e}"
+            row = [row_name] + [None] * ((self.row_length or 1) - 1) + ['failed', error]
+            with self._rows_lock:
+                self.failed.append((row_name, error))
+        with self._rows_lock:
+            self._finished_rows[position] = row
+            # Append every row whose predecessors are all written
+            rows = []
+            while self._next_row in self._finished_rows:
+                rows.append(self._finished_rows.pop(self._next_row))
+                self._next_row += 1
+            rows = [r for r in rows if r is not None]
+            if rows:
+                with open(self.results_csv, mode='a', newline='') as file:
+                    csv.writer(file).writerows(rows)
+
+    def shutdown(self, wait=True):
+        """Stop preparing videos and, if wait, let submitted calculations finish and write their rows.
+
+        Preparations that have not started are cancelled and one already
+        decoding is abandoned, leaving no partial entry in the cache.
+        """
+        self._closed.set()
+        for future in self._prepared.values():
+            future.cancel()
+        self._prepare_pool.shutdown(wait=wait)
+        self._calculation_pool.shutdown(wait=wait)
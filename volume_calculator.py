@@ -5,28 +5,59 @@ import numpy as np
 import json
 import os
 import logging
+from contour_store import ContourStore, trapezoid_volume, summary_metrics
+from annotation_container import AnnotationContainer, is_container
+from contour_interpolator import DEFAULT_NUM_POINTS, INTERPOLATED_NAME, merge_stores, write_interpolated
+from voxel_volume import VoxelVolumeEngine
+from mesh_exporter import MeshExporter
+from instrumentation import tracer, path_bytes
+from uncertainty import DEFAULT_DRAWS, volume_interval
+
+# Columns of the results CSV, one row per video
+RESULTS_HEADER = ['Video Name', 'Tumour Volume (mm^3)','Max Width (mm)', 'Avg Width (mm)', 'Max Depth (mm)', 'Avg Depth (mm)', 'Length (mm)', 'Slice Thickness (mm)', 'Pixel-to-mm Ratio', 'Timestamp']
 
 
 class VolumeCalculator:
-    def __init__(self, annotated_frames, output_dir, total_frames, slice_thickness_mm, pixel_to_mm_ratio):
+    def __init__(self, annotated_frames, output_dir, total_frames, slice_thickness_mm, pixel_to_mm_ratio,
+                 interpolation_points=None, volume_method="trapezoid"):
         """
-        annotated_frames: List of paths to annotated frames (JSON files).
+        annotated_frames: List of paths to annotated frames (JSON files), the path of a .vea annotation container, or an AnnotationContainer.
         output_dir: Directory to save extrapolated frames.
         total_frames: Total number of frames to extrapolate over.
-        slice_thickness_mm: Thickness between slices in mm.
-        pixel_to_mm_ratio: Pixel-to-mm conversion ratio.
+        slice_thickness_mm: Thickness between slices in mm (None: use the container's).
+        pixel_to_mm_ratio: Pixel-to-mm conversion ratio (None: use the container's).
+        interpolation_points: If set, contours for every unannotated frame are interpolated with this many points and written to output_dir.
+        volume_method: "trapezoid" integrates the annotated areas; "shape" measures the annotated plus interpolated contours of every frame;
+                       "voxel" rasterizes those contours and counts voxels (see VoxelVolumeEngine).
         """
         self.annotated_frames = annotated_frames
         self.output_dir = output_dir
         self.total_frames = total_frames
+        if isinstance(annotated_frames, AnnotationContainer):
+            self.container = annotated_frames
+        else:
+            self.container = AnnotationContainer.load(annotated_frames) if is_container(annotated_frames) else None
+        if self.container is not None:
+            slice_thickness_mm = slice_thickness_mm if slice_thickness_mm is not None else self.container.slice_thickness_mm
+            pixel_to_mm_ratio = pixel_to_mm_ratio if pixel_to_mm_ratio is not None else self.container.pixel_to_mm_ratio
+        if slice_thickness_mm is None or pixel_to_mm_ratio is None:
+            raise ValueError("Slice thickness and pixel-to-mm ratio are required.")
         self.slice_thickness_mm = slice_thickness_mm
         self.pixel_to_mm_ratio = pixel_to_mm_ratio
+        if volume_method not in ("trapezoid", "shape", "voxel"):
+            raise ValueError(f"Unknown volume method: {volume_method}")
+        self.volume_method = volume_method
+        if volume_method in ("shape", "voxel") and interpolation_points is None:
+            interpolation_points = DEFAULT_NUM_POINTS
+        self.interpolation_points = interpolation_points
         # Create a unique subfolder for each run
 
         os.makedirs(self.output_dir, exist_ok=True)
 
     def load_annotations(self):
-        """Load annotated points from JSON files."""
+        """Load annotated points from JSON files (or the container)."""
+        if self.container is not None:
+            return self.container.store.to_annotations()
         annotations = {}
         for frame_path in self.annotated_frames:
             frame_number = int(os.path.basename(frame_path).split('_')[1].split('.')[0])
@@ -35,26 +66,23 @@ class VolumeCalculator:
             annotations[frame_number] = np.array(data['points'])
         return annotations
 
+    def load_contour_store(self):
+        """All contours as a ContourStore; a container is mapped without per-frame parsing."""
+        if self.container is not None:
+            return self.container.store
+        return ContourStore.from_annotations(self.load_annotations())
 
     def calculate_volume(self, areas, frame_indices):
         """Estimate the tumor volume using the trapezoidal rule."""
-        volume = 0
-        for i in range(len(areas) - 1):
-            frame_distance = (frame_indices[i + 1] - frame_indices[i]) * self.slice_thickness_mm
-            volume += (areas[i] + areas[i + 1]) / 2 * frame_distance
-        
+        volume = trapezoid_volume(areas, frame_indices, self.slice_thickness_mm)
         volume_mm3 = volume / (self.pixel_to_mm_ratio ** 2)  # Convert pixels² to mm²
         return volume, volume_mm3
     def calculate_width_depth_per_frame(self, annotations):
         """Calculate width and depth for each frame."""
-        frame_metrics = {}
-        for frame_number, points in annotations.items():
-            x_coords = points[:, 0]
-            y_coords = points[:, 1]
-            width = (max(x_coords) - min(x_coords))/self.pixel_to_mm_ratio
-            depth = (max(y_coords) - min(y_coords))/self.pixel_to_mm_ratio
-            frame_metrics[frame_number] = {'width': width, 'depth': depth}
-        return frame_metrics
+        store = ContourStore.from_annotations(annotations)
+        widths, depths = store.extents()
+        return {int(frame_number): {'width': width / self.pixel_to_mm_ratio, 'depth': depth / self.pixel_to_mm_ratio}
+                for frame_number, width, depth in zip(store.frame_indices, widths, depths)}
 
     def aggregate_width_depth(self, frame_metrics):
         """Aggregate maximum and average width and depth across frames."""
@@ -69,21 +97,59 @@ class VolumeCalculator:
 
     def run(self):
         """Run the extrapolation and volume estimation pipeline."""
-        annotations = self.load_annotations()
-
-        # Calculate areas of each  polygon
-        frame_indices = sorted(annotations.keys())
-        areas = [self.calculate_polygon_area(annotations[frame]) for frame in frame_indices]
-        frame_metrics = self.calculate_width_depth_per_frame(annotations)
-        max_width, avg_width, max_depth, avg_depth = self.aggregate_width_depth(frame_metrics)
-        length = (frame_indices[-1] - frame_indices[0]) * self.slice_thickness_mm
-        # Estimate tumor volume
-        volume, volume_mm3 = self.calculate_volume(areas, frame_indices)
+        with tracer.span("volume_calculation", method=self.volume_method) as span:
+            store = self.load_contour_store()
+            span.add_frames(len(store))
+            if self.interpolation_points is not None:
+                interpolated = write_interpolated(store, self.output_dir, self.pixel_to_mm_ratio,
+                                                  self.slice_thickness_mm, self.interpolation_points)
+                if tracer.enabled:
+                    span.add_bytes(path_bytes(os.path.join(self.output_dir, INTERPOLATED_NAME)))
+                if self.volume_method in ("shape", "voxel"):
+                    store = merge_stores(store, interpolated)
+            if self.volume_method == "voxel":
+                return self.run_voxel(store)
+
+            # Areas, extents and the trapezoidal volume of every slice in a few array passes
+            volume_mm3, max_width, avg_width, max_depth, avg_depth, length = summary_metrics(
+                store, self.slice_thickness_mm, self.pixel_to_mm_ratio)
+        volume = volume_mm3 * (self.pixel_to_mm_ratio ** 2)
         logging.info(f"Estimated tumor volume: {round(volume,3)} squared pixels * millimeters")
         logging.info(f"Estimated tumor volume: {round(volume_mm3,3)} cubic millimeters")
         return (round(volume_mm3, 3),round(max_width, 3),round(avg_width, 3),round(max_depth, 3),round(avg_depth, 3),round(length, 3)
     )
 
+    def run_uncertainty(self, draws=DEFAULT_DRAWS, **kwargs):
+        """(sd, ci_low, ci_high) of the trapezoidal volume in mm^3 from a Monte Carlo over the annotated contours."""
+        with tracer.span("volume_uncertainty", draws=draws) as span:
+            store = self.load_contour_store()
+            span.add_frames(len(store))
+            sd, low, high = volume_interval(store, self.slice_thickness_mm, self.pixel_to_mm_ratio, draws=draws, **kwargs)
+        logging.info(f"Volume uncertainty: SD {round(sd, 3)} mm^3, confidence interval [{round(low, 3)}, {round(high, 3)}] mm^3")
+        return round(sd, 3), round(low, 3), round(high, 3)
+
+    def slice_metrics(self):
+        """(frame, area_mm2, width_mm, depth_mm) of every annotated slice."""
+        store = self.load_contour_store()
+        areas = store.areas() / (self.pixel_to_mm_ratio ** 2)
+        widths, depths = store.extents()
+        return list(zip(store.frame_indices.tolist(), areas.tolist(), (widths / self.pixel_to_mm_ratio).tolist(),
+                        (depths / self.pixel_to_mm_ratio).tolist()))
+
+    def run_voxel(self, store):
+        """Volume and extents of an (already interpolated) store from its rasterized voxels."""
+        result = VoxelVolumeEngine(store, self.slice_thickness_mm, self.pixel_to_mm_ratio, interpolate=False).run()
+        widths = result["slice_width_mm"]
+        depths = result["slice_depth_mm"]
+        length = (store.frame_indices[-1] - store.frame_indices[0]) * self.slice_thickness_mm
+        return (round(result["volume_mm3"], 3), round(float(widths.max()), 3), round(float(widths.mean()), 3),
+                round(float(depths.max()), 3), round(float(depths.mean()), 3), round(float(length), 3))
+
+    def export_mesh(self, mesh_path, num_points=DEFAULT_NUM_POINTS):
+        """Write the tumour surface, through the annotated and interpolated slices, as binary STL or PLY."""
+        exporter = MeshExporter(self.load_contour_store(), self.slice_thickness_mm, self.pixel_to_mm_ratio, num_points)
+        return exporter.export(mesh_path)
+
     def calculate_polygon_area(self, coords):
         """Calculate area of a polygon given its vertices."""
         if not np.array_equal(coords[0], coords[-1]):  # Close polygon if not closed
@@ -0,0 +1,340 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+"""Local HTTP service computing tumour volumes from contours.
+
+Usage:
+    python volume_service.py --port 8765 --workers 4
+
+POST /volume with either
+    Content-Type: application/json
+        {"slice_thickness_mm": 0.5, "pixel_to_mm_ratio": 12.3, "method": "trapezoid",
+         "annotations": {"12": {"points": [[x, y], ...]}, "frame_0016.json": {"points": ...}, ...}}
+    (annotations keyed by frame number or annotation file name, values in the
+    frame_XXXX.json schema or bare point lists), or
+    Content-Type: application/octet-stream
+        the bytes of a .vea annotation container, with optional
+        ?slice_thickness_mm=...&pixel_to_mm_ratio=...&method=... overriding its calibration.
+Container bodies are used in place (no parsing of point lists), so they are
+several times cheaper than JSON for large studies. The response is the
+VolumeCalculator.run() metrics as JSON. GET /health
+reports the queue. The server binds to localhost and needs no network access.
+
+Connections are HTTP/1.1 keep-alive. Requests are queued for a fixed pool of
+workers; each worker takes whatever trapezoid requests are waiting (up to
+max_batch) and computes them in one batch_metrics pass. "shape" and "voxel"
+requests run VolumeCalculator one at a time on the same workers. A full
+queue answers 503.
+"""
+
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import argparse
+import json
+import logging
+import os
+import queue
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from annotation_container import AnnotationContainer, frame_number_from_path
+from contour_store import ContourStore, batch_metrics
+from volume_calculator import VolumeCalculator
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_BATCH = 64
+# How long a worker holding one request waits for more to batch with it
+DEFAULT_BATCH_WAIT_S = 0.002
+DEFAULT_MAX_PENDING = 1024
+MAX_BODY_BYTES = 64 * 1024 * 1024
+# Idle keep-alive connections are closed after this many seconds
+CONNECTION_TIMEOUT_S = 30
+# Keys of the response, in the order of VolumeCalculator.run()'s tuple
+METRIC_NAMES = ("volume_mm3", "max_width_mm", "avg_width_mm", "max_depth_mm", "avg_depth_mm", "length_mm")
+_BATCH_KEYS = ("volume_mm3", "max_width", "avg_width", "max_depth", "avg_depth", "length")
+
+
+class ServiceBusy(Exception):
+    """The request queue is full."""
+
+
+class VolumeRequest:
+    """One study to compute; result is a Future resolved by a worker."""
+
+    __slots__ = ("store", "slice_thickness_mm", "pixel_to_mm_ratio", "method", "result")
+
+    def __init__(self, store, slice_thickness_mm, pixel_to_mm_ratio, method="trapezoid"):
+        if slice_thickness_mm is None or pixel_to_mm_ratio is None:
+            raise ValueError("slice_thickness_mm and pixel_to_mm_ratio are required")
+        try:
+            self.slice_thickness_mm = float(slice_thickness_mm)
+            self.pixel_to_mm_ratio = float(pixel_to_mm_ratio)
+        except (TypeError, ValueError):
+            raise ValueError("slice_thickness_mm and pixel_to_mm_ratio must be numbers") from None
+        if not (self.slice_thickness_mm > 0 and self.pixel_to_mm_ratio > 0):
+            raise ValueError("slice_thickness_mm and pixel_to_mm_ratio must be positive")
+        if method not in ("trapezoid", "shape", "voxel"):
+            raise ValueError(f"Unknown volume method: {method}")
+        self.store = validated_store(store)
+        self.method = method
+        self.result = Future()
+
+
+def validated_store(store):
+    """store, checked for the layout batch_metrics relies on (a container body is untrusted input)."""
+    if len(store) == 0:
+        raise ValueError("No contours in the request")
+    if store.vertices.ndim != 2 or store.vertices.shape[1] != 2:
+        raise ValueError("Contour points must be (x, y) pairs")
+    if store.offsets[0] != 0 or store.offsets[-1] != len(store.vertices):
+        raise ValueError("Contour offsets do not cover the vertex array")
+    if np.any(np.diff(store.frame_indices) <= 0):
+        raise ValueError("Frame indices must be increasing and unique")
+    if not np.all(np.isfinite(store.vertices)):
+        raise ValueError("Contour points must be finite")
+    return store
+
+
+def parse_json_request(body):
+    """VolumeRequest from a JSON body."""
+    try:
+        payload = json.loads(body)
+        annotations = {}
+        for key, value in payload["annotations"].items():
+            frame = int(key) if str(key).lstrip("-").isdigit() else frame_number_from_path(key)
+            points = value["points"] if isinstance(value, dict) else value
+            annotations[frame] = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    except (ValueError, KeyError, TypeError, AttributeError, IndexError) as e:
+        raise ValueError(f"Malformed annotation payload: {e}") from None
+    if not annotations:
+        raise ValueError("No contours in the request")
+    return VolumeRequest(ContourStore.from_annotations(annotations), payload.get("slice_thickness_mm"),
+                         payload.get("pixel_to_mm_ratio"), payload.get("method", "trapezoid"))
+
+
+def parse_container_request(body, params):
+    """VolumeRequest from .vea container bytes; query parameters override the stored calibration."""
+    try:
+        container = AnnotationContainer.from_bytes(body)
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        raise ValueError(f"Malformed annotation container: {e}") from None
+    thickness = params.get("slice_thickness_mm", container.slice_thickness_mm)
+    ratio = params.get("pixel_to_mm_ratio", container.pixel_to_mm_ratio)
+    return VolumeRequest(container.store, thickness, ratio, params.get("method", "trapezoid"))
+
+
+class VolumeService:
+    """Bounded worker pool computing VolumeRequests, batching the ones that wait together."""
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_batch=DEFAULT_MAX_BATCH,
+                 batch_wait_s=DEFAULT_BATCH_WAIT_S, max_pending=DEFAULT_MAX_PENDING):
+        self.max_batch = max_batch
+        self.batch_wait_s = batch_wait_s
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._scratch_dir = tempfile.mkdtemp(prefix="volume_service_")
+        self.completed = 0
+        self.batches = 0
+        self._stats_lock = threading.Lock()
+        self._workers = [threading.Thread(target=self._worker_loop, name=f"VolumeWorker-{i}", daemon=True)
+                         for i in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, request):
+        """Queue a request and return its Future; raises ServiceBusy when the queue is full."""
+        try:
+            self._queue.put_nowait(request)
+        except queue.Full:
+            raise ServiceBusy() from None
+        return request.result
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def close(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        shutil.rmtree(self._scratch_dir, ignore_errors=True)
+
+    def _worker_loop(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            batch = [request]
+            deadline = time.monotonic() + self.batch_wait_s
+            while len(batch) < self.max_batch:
+                try:
+                    request = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)  # Leave the stop signal for this worker's next loop
+                    break
+                batch.append(request)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        trapezoid = [request for request in batch if request.method == "trapezoid"]
+        if trapezoid:
+            try:
+                metrics = batch_metrics([request.store for request in trapezoid],
+                                        [request.slice_thickness_mm for request in trapezoid],
+                                        [request.pixel_to_mm_ratio for request in trapezoid])
+                for i, request in enumerate(trapezoid):
+                    request.result.set_result(tuple(round(float(metrics[key][i]), 3) for key in _BATCH_KEYS))
+            except Exception:
+                # One bad study fails the whole batch pass; compute them singly to isolate it
+                for request in trapezoid:
+                    self._run_single(request)
+        for request in batch:
+            if request.method != "trapezoid":
+                self._run_single(request)
+        with self._stats_lock:
+            self.completed += len(batch)
+            self.batches += 1
+
+    def _run_single(self, request):
+        if request.result.done():
+            return
+        output_dir = tempfile.mkdtemp(dir=self._scratch_dir)
+        try:
+            calculator = VolumeCalculator(
+                annotated_frames=AnnotationContainer(request.store),
+                output_dir=output_dir,
+                total_frames=int(request.store.frame_indices[-1]) + 1,
+                slice_thickness_mm=request.slice_thickness_mm,
+                pixel_to_mm_ratio=request.pixel_to_mm_ratio,
+                volume_method=request.method,
+            )
+            request.result.set_result(tuple(float(value) for value in calculator.run()))
+        except Exception as e:
+            request.result.set_exception(e)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+
+class VolumeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive by default
+    timeout = CONNECTION_TIMEOUT_S
+    # Headers and body go out in separate writes; with Nagle on, every
+    # keep-alive response would wait out the client's delayed ACK
+    disable_nagle_algorithm = True
+    server_version = "VolumeEstimator3D"
+
+    def do_GET(self):
+        if urlsplit(self.path).path != "/health":
+            self._send_json(404, {"error": "Not found"})
+            return
+        service = self.server.service
+        self._send_json(200, {"status": "ok", "pending": service.pending,
+                              "completed": service.completed, "batches": service.batches})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/volume":
+            self._send_json(404, {"error": "Not found"})
+            return
+        length = self.headers.get("Content-Length")
+        if length is None:
+            self._send_json(411, {"error": "Content-Length is required"}, close=True)
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self._send_json(400, {"error": "Content-Length must be a non-negative integer"}, close=True)
+            return
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {"error": f"Body larger than {MAX_BODY_BYTES} bytes"}, close=True)
+            return
+        body = self.rfile.read(length)
+
+        try:
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                request = parse_json_request(body)
+            else:
+                params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                request = parse_container_request(body, params)
+            result = self.server.service.submit(request).result()
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except ServiceBusy:
+            self._send_json(503, {"error": "Too many pending requests"}, headers={"Retry-After": "1"})
+            return
+        except Exception as e:
+            logging.exception("Volume computation failed")
+            self._send_json(500, {"error": str(e)})
+            return
+        response = dict(zip(METRIC_NAMES, result))
+        response.update(slice_thickness_mm=request.slice_thickness_mm,
+                        pixel_to_mm_ratio=request.pixel_to_mm_ratio, method=request.method)
+        self._send_json(200, response)
+
+    def _send_json(self, status, payload, headers=None, close=False):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if close:
+            # The unread body would otherwise be parsed as the next request
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+
+class VolumeServer(ThreadingHTTPServer):
+    """One thread per connection for I/O; the computation runs on service's worker pool."""
+
+    daemon_threads = True
+
+    def __init__(self, address=(DEFAULT_HOST, DEFAULT_PORT), service=None):
+        self.service = service or VolumeService()
+        super().__init__(address, VolumeRequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve tumour volume computations over local HTTP.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Address to bind (default: localhost only)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Computation threads")
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH, help="Most requests computed in one pass")
+    parser.add_argument("--batch-wait-ms", type=float, default=DEFAULT_BATCH_WAIT_S * 1000, help="Wait for more requests to batch")
+    parser.add_argument("--max-pending", type=int, default=DEFAULT_MAX_PENDING, help="Queued requests before answering 503")
+    parser.add_argument("--verbose", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s [%(levelname)s] %(message)s")
+
+    service = VolumeService(args.workers, args.max_batch, args.batch_wait_ms / 1000, args.max_pending)
+    server = VolumeServer((args.host, args.port), service)
+    logging.info(f"Serving volumes on http://{args.host}:{server.server_port}/volume (pid {os.getpid()})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,194 @@
+# Author: Andrew Effat
+# Email: andrew.effat@uhn.ca
+
+import argparse
+import logging
+import os
+import sys
+import cv2
+import numpy as np
+from contour_store import ContourStore
+from frame_source import VideoFrameSource
+from contour_interpolator import DEFAULT_NUM_POINTS, interpolate_contours, merge_stores
+
+# Sub-pixel precision for cv2.fillPoly (vertices are scaled by 2**FILL_SHIFT)
+FILL_SHIFT = 4
+# Bytes of bit-packed masks per chunk when chunk_slices is not given
+CHUNK_BUDGET_BYTES = 8 * 1024 * 1024
+# Set bits of every byte value
+POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint8)
+
+# Expected volumes from the README for validation_videos/, with a 5 mm reference
+# (circle diameter, square edge) spanning 100 pixels and 1 mm slices
+VALIDATION_PIXEL_TO_MM = 20.0
+VALIDATION_SLICE_THICKNESS_MM = 1.0
+VALIDATION_EXPECTED_MM3 = {
+    "circle_video.avi": 1943.86,
+    "square_video.avi": 2475.0,
+    "variable_circle.avi": 2105.98,
+}
+
+
+class VoxelVolumeEngine:
+    """Volume, per-slice extents and centroid from rasterized contour masks.
+
+    Each slice's contour is filled into a mask cropped to the tumour's
+    bounding box across the whole stack and bit-packed along x. Slices are
+    processed chunk_slices at a time (by default as many as fit in
+    CHUNK_BUDGET_BYTES of packed masks) and the metrics are reduced from the
+    packed bytes without unpacking them, so peak memory stays near the budget
+    however long the stack or large the frames. Gaps between annotated
+    frames are filled with shape-interpolated contours first.
+    """
+
+    def __init__(self, store, slice_thickness_mm, pixel_to_mm_ratio, chunk_slices=None,
+                 interpolate=True, num_points=DEFAULT_NUM_POINTS):
+        if interpolate and len(store) > 1:
+            store = merge_stores(store, interpolate_contours(store, num_points))
+        self.store = store
+        self.slice_thickness_mm = slice_thickness_mm
+        self.pixel_to_mm_ratio = pixel_to_mm_ratio
+
+        vertices = np.asarray(store.vertices, dtype=np.float64)
+        self.origin = np.floor(vertices.min(axis=0)).astype(np.int64)
+        far_corner = np.ceil(vertices.max(axis=0)).astype(np.int64)
+        self.box_width, self.box_height = (far_corner - self.origin + 1).tolist()
+        self.packed_width = (self.box_width + 7) // 8
+        if chunk_slices is None:
+            chunk_slices = max(1, CHUNK_BUDGET_BYTES // (self.box_height * self.packed_width))
+        self.chunk_slices = chunk_slices
+
+    def slice_weights(self):
+        """Thickness (mm) each slice stands for, using the same trapezoidal weighting as calculate_volume."""
+        frames = self.store.frame_indices
+        weights = np.zeros(len(frames))
+        if len(frames) > 1:
+            gaps = np.diff(frames) * self.slice_thickness_mm
+            weights[:-1] += gaps / 2
+            weights[1:] += gaps / 2
+        return weights
+
+    def rasterize(self, i, mask):
+        """Fill contour i into the (zeroed) uint8 mask in bounding-box coordinates."""
+        points = (np.asarray(self.store.contour(i), dtype=np.float64) - self.origin) * (1 << FILL_SHIFT)
+        cv2.fillPoly(mask, [np.round(points).astype(np.int32)], 1, lineType=cv2.LINE_8, shift=FILL_SHIFT)
+
+    def iter_chunks(self):
+        """Yield (frame_indices, packed_masks) per chunk; masks are bit-packed along x with np.packbits."""
+        mask = np.zeros((self.box_height, self.box_width), dtype=np.uint8)
+        for start in range(0, len(self.store), self.chunk_slices):
+            stop = min(start + self.chunk_slices, len(self.store))
+            packed = np.empty((stop - start, self.box_height, self.packed_width), dtype=np.uint8)
+            for i in range(start, stop):
+                mask.fill(0)
+                self.rasterize(i, mask)
+                packed[i - start] = np.packbits(mask, axis=1)
+            yield self.store.frame_indices[start:stop], packed
+
+    def run(self, occupancy_dir=None):
+        """Compute the metrics; optionally save each packed chunk to occupancy_dir as it is produced."""
+        num_slices = len(self.store)
+        counts = np.zeros(num_slices, dtype=np.int64)
+        widths = np.zeros(num_slices, dtype=np.int64)
+        depths = np.zeros(num_slices, dtype=np.int64)
+        x_moments = np.zeros(num_slices)
+        y_moments = np.zeros(num_slices)
+        y_positions = np.arange(self.box_height)
+        # Column of bit b (most significant first) of packed byte j is 8 * j + b
+        bit_x_positions = np.arange(self.packed_width)[:, None] * 8 + np.arange(8)
+
+        if occupancy_dir:
+            os.makedirs(occupancy_dir, exist_ok=True)
+        start = 0
+        for frames, packed in self.iter_chunks():
+            if occupancy_dir:
+                np.save(os.path.join(occupancy_dir, f"occupancy_{frames[0]:04d}.npy"), packed)
+            stop = start + len(frames)
+            row_counts = POPCOUNT[packed].sum(axis=2, dtype=np.int64)  # (chunk, box_height)
+            column_counts = _packed_column_counts(packed)[:, :self.box_width]  # (chunk, box_width)
+            counts[start:stop] = row_counts.sum(axis=1)
+            x_moments[start:stop] = column_counts @ bit_x_positions.ravel()[:self.box_width]
+            y_moments[start:stop] = row_counts @ y_positions
+            widths[start:stop] = _occupied_span(column_counts)
+            depths[start:stop] = _occupied_span(row_counts)
+            start = stop
+
+        pixel_area_mm2 = 1.0 / self.pixel_to_mm_ratio ** 2
+        weights = self.slice_weights()
+        weighted_voxels = float(np.dot(counts, weights))
+        volume_mm3 = weighted_voxels * pixel_area_mm2
+        if weighted_voxels > 0:
+            centroid_px = (float(np.dot(x_moments, weights)) / weighted_voxels + self.origin[0],
+                           float(np.dot(y_moments, weights)) / weighted_voxels + self.origin[1])
+            centroid_z = float(np.dot(counts * weights, self.store.frame_indices)) / weighted_voxels
+        else:
+            centroid_px, centroid_z = (float('nan'), float('nan')), float('nan')
+        logging.info(f"Voxel volume: {round(volume_mm3, 3)} cubic millimeters over {num_slices} slices")
+        return {
+            "volume_mm3": volume_mm3,
+            "voxel_count": int(counts.sum()),
+            "frame_indices": self.store.frame_indices,
+            "slice_area_mm2": counts * pixel_area_mm2,
+            "slice_width_mm": widths / self.pixel_to_mm_ratio,
+            "slice_depth_mm": depths / self.pixel_to_mm_ratio,
+            # x and y in mm from the image origin, z in mm from frame 0
+            "centroid_mm": (centroid_px[0] / self.pixel_to_mm_ratio, centroid_px[1] / self.pixel_to_mm_ratio,
+                            centroid_z * self.slice_thickness_mm),
+        }
+
+
+def _packed_column_counts(packed):
+    """Set bits per x column of (chunk, rows, bytes) masks packed with np.packbits; returns (chunk, 8 * bytes)."""
+    column_counts = np.empty((packed.shape[0], packed.shape[2], 8), dtype=np.int64)
+    bits = np.empty_like(packed)
+    for bit in range(8):
+        np.right_shift(packed, 7 - bit, out=bits)
+        np.bitwise_and(bits, 1, out=bits)
+        column_counts[:, :, bit] = bits.sum(axis=1, dtype=np.int64)
+    return column_counts.reshape(packed.shape[0], -1)
+
+
+def _occupied_span(counts):
+    """Distance between the first and last occupied position of each row of counts (0 if empty)."""
+    occupied = counts > 0
+    first = np.argmax(occupied, axis=1)
+    last = counts.shape[1] - 1 - np.argmax(occupied[:, ::-1], axis=1)
+    return np.where(occupied.any(axis=1), last - first, 0)
+
+
+def segment_phantom(video_path, threshold=127):
+    """Contours of the bright phantom shape in every frame of a validation video."""
+    annotations = {}
+    # The phantoms are drawn as coloured segments split by thin dark lines; closing joins them
+    kernel = np.ones((5, 5), dtype=np.uint8)
+    with VideoFrameSource(video_path) as frame_source:
+        for index in range(frame_source.total_frames):
+            mask = (frame_source.get_frame(index).max(axis=2) > threshold).astype(np.uint8)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+            if contours:
+                annotations[index] = max(contours, key=cv2.contourArea).reshape(-1, 2)
+    return ContourStore.from_annotations(annotations)
+
+
+def validate(video_dir, tolerance=0.03):
+    """Compare voxel volumes of the validation phantoms with the README; returns (name, volume, expected, error, passed) rows."""
+    rows = []
+    for video_name, expected in VALIDATION_EXPECTED_MM3.items():
+        store = segment_phantom(os.path.join(video_dir, video_name))
+        result = VoxelVolumeEngine(store, VALIDATION_SLICE_THICKNESS_MM, VALIDATION_PIXEL_TO_MM).run()
+        error = (result["volume_mm3"] - expected) / expected
+        rows.append((video_name, result["volume_mm3"], expected, error, abs(error) <= tolerance))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the voxel volume engine against the phantom videos.")
+    parser.add_argument("video_dir", nargs="?", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "validation_videos"))
+    parser.add_argument("--tolerance", type=float, default=0.03, help="Allowed relative volume error (default: %(default)s)")
+    args = parser.parse_args()
+
+    rows = validate(args.video_dir, args.tolerance)
+    for video_name, volume, expected, error, passed in rows:
+        print(f"{video_name:22s} {volume:10.2f} mm^3  expected {expected:10.2f}  error {error:+.2%}  {'ok' if passed else 'FAIL'}")
+    sys.exit(0 if all(row[-1] for row in rows) else 1)